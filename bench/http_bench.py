@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure how many requests a single client can make to a testify server.
+
+Starts a tornado server in a background thread that answers POSTs to /results
+the way the test runner server does, then has one client post N results with
+a new connection per request (urllib2.urlopen, as clients used to) and over a
+keep-alive ConnectionPool, and prints the request rate of each.
+
+    python bench/http_bench.py [--requests N]
+"""
+from optparse import OptionParser
+import os
+import sys
+import threading
+import time
+import urllib2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.web
+
+from testify.utils.connection_pool import ConnectionPool
+
+RESULT = '{"method": {"full_name": "bench BenchTestCase.test_method"}, "success": true, "run_time": 0.01}'
+
+
+class ResultsHandler(tornado.web.RequestHandler):
+    def post(self):
+        self.finish("kthx")
+
+
+def start_server():
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(r"/results", ResultsHandler)]))
+    server.listen(0, 'localhost')
+    port = server._sockets.values()[0].getsockname()[1]
+    thread = threading.Thread(target=tornado.ioloop.IOLoop.instance().start)
+    thread.daemon = True
+    thread.start()
+    return 'localhost:%d' % port
+
+
+def time_urlopen(addr, requests):
+    url = 'http://%s/results?runner=bench' % addr
+    start = time.time()
+    for _ in xrange(requests):
+        urllib2.urlopen(url, RESULT).read()
+    return time.time() - start
+
+
+def time_pool(addr, requests):
+    pool = ConnectionPool(addr)
+    start = time.time()
+    for _ in xrange(requests):
+        pool.request('POST', '/results?runner=bench', RESULT)
+    elapsed = time.time() - start
+    pool.close()
+    return elapsed
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--requests', action="store", dest="requests", type="int", default=2000, help="Number of requests to make each way. Defaults to %default.")
+    options, _ = parser.parse_args()
+
+    addr = start_server()
+    for name, time_requests in [("urlopen", time_urlopen), ("ConnectionPool", time_pool)]:
+        elapsed = time_requests(addr, options.requests)
+        print "%-16s %7.0f requests/s  (%d in %.2fs)" % (name, options.requests / elapsed, options.requests, elapsed)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure how long testify takes to start up.
+
+Times `python -c 'import testify'` and `testify --help` in fresh processes and
+prints the best and median wall clock time of each. With --budget-ms, exits
+non-zero if any best time is over budget, so it can guard against regressions
+in the import graph.
+
+    python bench/startup_bench.py [--runs N] [--budget-ms MS]
+"""
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [
+    ("import testify", [sys.executable, '-c', 'import testify']),
+    ("testify --help", [sys.executable, os.path.join(ROOT, 'bin', 'testify'), '--help']),
+]
+
+
+def time_command(args, runs):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    # Don't let a running daemon answer --help for us.
+    env.pop('TESTIFY_DAEMON_SOCKET', None)
+    devnull = open(os.devnull, 'w')
+    timings = []
+    try:
+        for _ in xrange(runs):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull, stderr=devnull, env=env, cwd=ROOT)
+            timings.append(time.time() - start)
+    finally:
+        devnull.close()
+    timings.sort()
+    return timings[0], timings[len(timings) / 2]
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--runs', action="store", dest="runs", type="int", default=20, help="Number of times to run each command. Defaults to %default.")
+    parser.add_option('--budget-ms', action="store", dest="budget_ms", type="float", default=None, help="Fail if the best time of any command is over this many milliseconds.")
+    options, _ = parser.parse_args()
+
+    over_budget = False
+    for name, args in COMMANDS:
+        best, median = time_command(args, options.runs)
+        print "%-16s best %7.1fms  median %7.1fms" % (name, best * 1000, median * 1000)
+        if options.budget_ms is not None and best * 1000 > options.budget_ms:
+            over_budget = True
+
+    if over_budget:
+        print >>sys.stderr, "Over the startup budget of %.1fms." % options.budget_ms
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,46 @@
+from testify import assert_equal, assert_lt, assert_raises, run, test_case
+from testify.binary_transport import Decoder, Encoder, Name, TransportError, decode_result, encode_result
+
+
+class EncoderTestCase(test_case.TestCase):
+    def test_round_trip(self):
+        value = [None, True, False, 0, -3, 2 ** 40, 1.5, 'bytes', u'\u2603', ['nested', ('tuple',)], {'key': {'inner': 1}}]
+        expected = value[:9] + [['nested', ['tuple']], {'key': {'inner': 1}}]
+        assert_equal(Decoder().loads(Encoder().dumps(value)), expected)
+
+    def test_names_are_sent_once_per_session(self):
+        encoder, decoder = Encoder(), Decoder()
+        first = encoder.dumps([Name('test.some_module SomeTestCase'), Name('test_method')])
+        second = encoder.dumps([Name('test.some_module SomeTestCase'), Name('test_method')])
+        assert_lt(len(second), len(first) / 2)
+        assert_equal(decoder.loads(first), ['test.some_module SomeTestCase', 'test_method'])
+        assert_equal(decoder.loads(second), ['test.some_module SomeTestCase', 'test_method'])
+
+        # A new session starts over.
+        assert_equal(Encoder().dumps([Name('test_method')]), Encoder().dumps([Name('test_method')]))
+
+    def test_garbage_raises_transport_error(self):
+        assert_raises(TransportError, Decoder().loads, 'l\x00\x00\x00\x02N')
+        assert_raises(TransportError, Decoder().loads, '#\x00\x00\x00\x00')
+        assert_raises(TransportError, Decoder().loads, 'NN')
+
+
+class ResultEncodingTestCase(test_case.TestCase):
+    def test_round_trip(self):
+        method = {'module': 'test.some_module', 'class': 'SomeTestCase', 'name': 'test_method', 'full_name': 'test.some_module SomeTestCase.test_method', 'fixture_type': None}
+        previous_run = {'method': method, 'success': False, 'exception_info': ['Traceback...'], 'previous_run': None}
+        result = {'method': method, 'success': True, 'run_time': 0.25, 'runner_id': 'runner1', 'previous_run': previous_run, 'extra': 'kept'}
+
+        decoded = decode_result(Decoder().loads(Encoder().dumps(encode_result(result))))
+        assert_equal(decoded['method'], method)
+        assert_equal(decoded['success'], True)
+        assert_equal(decoded['run_time'], 0.25)
+        assert_equal(decoded['extra'], 'kept')
+        assert_equal(decoded['previous_run']['exception_info'], ['Traceback...'])
+        assert_equal(decoded['previous_run']['previous_run'], None)
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,104 @@
+import cStringIO
+import logging
+import os
+import signal
+import threading
+import time
+
+from testify import assert_equal, assert_in, run, setup, test_case
+from testify import isolation
+from testify.test_reporter import TestReporter
+from testify.test_runner import TestRunner
+
+
+class RecordingReporter(TestReporter):
+    def __init__(self):
+        super(RecordingReporter, self).__init__(None)
+        self.started = []
+        self.completed = []
+
+    def test_start(self, result):
+        self.started.append(result['method']['name'])
+
+    def test_complete(self, result):
+        self.completed.append(result)
+
+
+class PassingTestCase(test_case.TestCase):
+    __test__ = False
+    def test_one(self):
+        pass
+
+    def test_two(self):
+        assert False
+
+
+class DyingTestCase(test_case.TestCase):
+    __test__ = False
+    def test_a_passes(self):
+        pass
+
+    def test_b_dies(self):
+        os._exit(3)
+
+    def test_c_never_runs(self):
+        pass
+
+
+class IsolatedTestRunnerTestCase(test_case.TestCase):
+    @setup
+    def make_reporter(self):
+        self.reporter = RecordingReporter()
+
+    def test_results_are_streamed_back(self):
+        runner = TestRunner(PassingTestCase, test_reporters=[self.reporter], isolate=isolation.ISOLATE_CLASS)
+        runner.run()
+
+        assert_equal(self.reporter.started, ['test_one', 'test_two'])
+        assert_equal([(result['method']['name'], result['success']) for result in self.reporter.completed], [('test_one', True), ('test_two', None)])
+        assert_equal(runner.failure_count, 1)
+
+    def test_remaining_methods_error_when_child_dies(self):
+        runner = TestRunner(DyingTestCase, test_reporters=[self.reporter], isolate=isolation.ISOLATE_CLASS)
+        runner.run()
+
+        assert_equal(self.reporter.started, ['test_a_passes', 'test_b_dies', 'test_c_never_runs'])
+        results = dict((result['method']['name'], result) for result in self.reporter.completed)
+        assert results['test_a_passes']['success']
+        for name in ('test_b_dies', 'test_c_never_runs'):
+            assert results[name]['error']
+            assert_in('exited with status 3', results[name]['exception_info'][0])
+        assert_equal(runner.failure_count, 2)
+
+
+class ForkTestCase(test_case.TestCase):
+    def test_child_can_log_when_another_thread_was_logging(self):
+        handler = logging.StreamHandler(cStringIO.StringIO())
+        locked = threading.Event()
+        def hold_lock():
+            with handler.lock:
+                locked.set()
+                time.sleep(0.1)
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+
+        pid = isolation.fork()
+        if pid == 0:
+            handler.emit(logging.makeLogRecord({'msg': 'from the child'}))
+            os._exit(0)
+        thread.join()
+
+        start = time.time()
+        while os.waitpid(pid, os.WNOHANG) == (0, 0):
+            if time.time() - start > 5:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                assert False, "The child deadlocked on the handler's lock"
+            time.sleep(0.01)
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
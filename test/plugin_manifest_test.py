@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+
+from testify import assert_equal, assert_raises, run, setup_teardown, test_case
+from testify import plugin_manifest
+from testify import test_program
+
+
+EXPLOSIVE_PLUGIN = """
+raise ImportError("imported a plugin nobody asked for")
+
+TESTIFY_PLUGIN = {
+    'options': [
+        (('--explode',), {'action': 'store_true', 'dest': 'explode', 'default': False}),
+    ],
+    'activate_on': ['explode'],
+}
+"""
+
+FRIENDLY_PLUGIN = """
+TESTIFY_PLUGIN = {
+    'options': [
+        (('--friendly',), {'action': 'store', 'dest': 'friendly', 'type': 'string', 'default': None}),
+    ],
+    'activate_on': ['friendly'],
+}
+
+def build_test_reporters(options):
+    return []
+"""
+
+EAGER_PLUGIN = """
+def add_command_line_options(parser):
+    parser.add_option('--eager', action='store_true', dest='eager', default=False)
+"""
+
+
+class PluginManifestTestCase(test_case.TestCase):
+    @setup_teardown
+    def make_plugin_dir(self):
+        self.plugin_dir = tempfile.mkdtemp(prefix='testify_plugins')
+        for name, source in [('explosive', EXPLOSIVE_PLUGIN), ('friendly', FRIENDLY_PLUGIN), ('eager', EAGER_PLUGIN)]:
+            plugin_file = open(os.path.join(self.plugin_dir, name + '.py'), 'w')
+            plugin_file.write(source)
+            plugin_file.close()
+
+        old_plugin_path = os.environ.get('TESTIFY_PLUGIN_PATH')
+        os.environ['TESTIFY_PLUGIN_PATH'] = self.plugin_dir
+        yield
+        if old_plugin_path is None:
+            del os.environ['TESTIFY_PLUGIN_PATH']
+        else:
+            os.environ['TESTIFY_PLUGIN_PATH'] = old_plugin_path
+        shutil.rmtree(self.plugin_dir)
+
+    def plugin_names(self, plugins):
+        return sorted(getattr(plugin, 'name', None) or plugin.__name__ for plugin in plugins if os.path.dirname(getattr(plugin, 'path', None) or plugin.__file__) == self.plugin_dir)
+
+    def test_read_manifest(self):
+        manifest = plugin_manifest.read_manifest(os.path.join(self.plugin_dir, 'friendly.py'))
+        assert_equal(manifest['activate_on'], ['friendly'])
+        assert_equal(plugin_manifest.read_manifest(os.path.join(self.plugin_dir, 'eager.py')), None)
+
+    def test_only_active_plugins_are_imported(self):
+        plugins = test_program.load_plugins()
+        assert_equal(self.plugin_names(plugins), ['eager', 'explosive', 'friendly'])
+
+        _, _, test_runner_args, options = test_program.parse_test_runner_command_line_args(plugins, ['test', '--friendly', 'yes'])
+        assert_equal(options.explode, False)
+        active_plugins = test_runner_args['plugin_modules']
+        assert_equal(self.plugin_names(active_plugins), ['eager', 'friendly'])
+        assert not any(isinstance(plugin, plugin_manifest.LazyPlugin) for plugin in active_plugins)
+
+    def test_inactive_plugins_are_dropped(self):
+        plugins = test_program.load_plugins()
+        _, _, test_runner_args, _ = test_program.parse_test_runner_command_line_args(plugins, ['test'])
+        assert_equal(self.plugin_names(test_runner_args['plugin_modules']), ['eager'])
+
+    def test_activating_a_broken_plugin(self):
+        path = os.path.join(self.plugin_dir, 'explosive.py')
+        explosive = plugin_manifest.LazyPlugin('explosive', path, plugin_manifest.read_manifest(path))
+        assert_raises(AttributeError, getattr, explosive, 'build_test_reporters')
+
+        _, _, test_runner_args, _ = test_program.parse_test_runner_command_line_args([explosive], ['test', '--explode'])
+        assert_equal(test_runner_args['plugin_modules'], [])
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -1,4 +1,6 @@
 import threading
+import time
+import zlib
 import tornado.ioloop
 import tornado.httpserver
 import tornado.web
@@ -6,7 +8,7 @@ import Queue
 
 from testify import assert_equal, setup_teardown, TestCase
 from testify.test_runner import TestRunner
-from testify.plugins.http_reporter import HTTPReporter
+from testify.plugins.http_reporter import HeartbeatReporter, HTTPReporter
 
 try:
     import simplejson as json
@@ -22,6 +24,22 @@ class DummyTestCase(TestCase):
         pass
 
 
+class ThreeTestsTestCase(TestCase):
+    __test__ = False
+    def test_one(self):
+        pass
+    def test_two(self):
+        pass
+    def test_three(self):
+        pass
+
+
+class SlowTestCase(TestCase):
+    __test__ = False
+    def test_slow(self):
+        time.sleep(0.3)
+
+
 class HTTPReporterTestCase(TestCase):
     @setup_teardown
     def make_fake_server(self):
@@ -42,9 +60,24 @@ class HTTPReporterTestCase(TestCase):
             def get_error_html(handler, status, **kwargs    ):
                 return "error"
 
-        app = tornado.web.Application([(r"/results", ResultsHandler)])
+        class BatchResultsHandler(tornado.web.RequestHandler):
+            def post(handler):
+                assert_equal(handler.request.headers['Content-Encoding'], 'gzip')
+                batch = json.loads(zlib.decompress(handler.request.body, 16 + zlib.MAX_WBITS))
+                self.batches_reported.append(batch)
+                handler.finish(json.dumps({'errors': []}))
+
+        class HeartbeatHandler(tornado.web.RequestHandler):
+            def post(handler):
+                self.heartbeats.append((handler.get_argument('runner'), json.loads(handler.request.body)))
+                handler.finish("kthx")
+
+        self.batches_reported = []
+        self.heartbeats = []
+        app = tornado.web.Application([(r"/results", ResultsHandler), (r"/results/batch", BatchResultsHandler), (r"/heartbeat", HeartbeatHandler)])
         srv = tornado.httpserver.HTTPServer(app)
-        srv.listen(0)
+        # Just IPv4: listening on every address family would give each family a port of its own.
+        srv.listen(0, '127.0.0.1')
         portnum = self.get_port_number(srv)
 
         iol = tornado.ioloop.IOLoop.instance()
@@ -52,7 +85,7 @@ class HTTPReporterTestCase(TestCase):
         thread.daemon = True # If for some reason this thread gets blocked, don't prevent quitting.
         thread.start()
 
-        self.connect_addr = "localhost:%d" % portnum
+        self.connect_addr = "127.0.0.1:%d" % portnum
 
         yield
 
@@ -89,3 +122,31 @@ class HTTPReporterTestCase(TestCase):
         assert_equal(first['runner_id'], 'tries_twice')
         assert_equal(first, second)
 
+    def test_http_reporter_batches(self):
+        """Results go back in gzipped batches of up to batch_size, and report() sends the last partial batch right away."""
+        reporter = HTTPReporter(None, self.connect_addr, 'batcher', batch_size=2, batch_seconds=60)
+        start_time = time.time()
+        TestRunner(ThreeTestsTestCase, test_reporters=[reporter]).run()
+        assert time.time() - start_time < 30
+
+        assert_equal([len(batch) for batch in self.batches_reported], [2, 1])
+        assert_equal(self.results_reported, [])
+        names = sorted(result['method']['name'] for batch in self.batches_reported for result in batch)
+        assert_equal(names, ['test_one', 'test_three', 'test_two'])
+        assert all(result['runner_id'] == 'batcher' for batch in self.batches_reported for result in batch)
+
+    def test_heartbeats_say_what_is_running(self):
+        reporter = HeartbeatReporter(None, self.connect_addr, 'beater', 0.05)
+        TestRunner(SlowTestCase, test_reporters=[reporter]).run()
+        assert reporter.stopped.is_set()
+
+        assert self.heartbeats
+        running = [heartbeat['running'] for runner_id, heartbeat in self.heartbeats if heartbeat['running']]
+        assert running
+        ((class_path, method, elapsed),) = running[-1]
+        assert_equal(method, 'test_slow')
+        assert_equal(class_path, '%s SlowTestCase' % __name__)
+        assert 0 < elapsed < 1
+        assert all(runner_id == 'beater' for runner_id, _ in self.heartbeats)
+
+# vim: set ts=4 sts=4 sw=4 et:
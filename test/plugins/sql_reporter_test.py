@@ -1,4 +1,7 @@
+import os
+import shutil
 import sqlalchemy as SA
+import tempfile
 import time
 from optparse import OptionParser
 
@@ -11,8 +14,8 @@ except ImportError:
 
 
 from test.discovery_failure_test import BrokenImportTestCase
-from testify import TestCase, setup_teardown, assert_equal, assert_gt, assert_in_range
-from testify.plugins.sql_reporter import SQLReporter, add_command_line_options, Tests, Builds, TestResults
+from testify import TestCase, setup_teardown, assert_equal, assert_gt, assert_in_range, assert_not_in
+from testify.plugins.sql_reporter import SQLReporter, add_command_line_options, load_durations, Tests, Builds, TestResults
 from testify.test_result import TestResult
 from testify.test_runner import TestRunner
 
@@ -24,25 +27,29 @@ class DummyTestCase(TestCase):
     def test_fail(self):
         assert False
 
+def make_options(db_url):
+    parser = OptionParser()
+    add_command_line_options(parser)
+    (options, args) = parser.parse_args([
+        '--reporting-db-url', db_url,
+        '--sql-reporting-frequency', '0.05',
+        '--build-info', json.dumps({
+            'buildbot' : 1,
+            'buildnumber' : 1,
+            'branch' : 'a_branch_name',
+            'revision' : 'deadbeefdeadbeefdeadbeefdeadbeefdeadbeef',
+            'buildname' : 'a_build_name'
+        })
+    ])
+    return options
+
 class SQLReporterBaseTestCase(TestCase):
     __test__ = False
 
     @setup_teardown
     def make_reporter(self):
         """Make self.reporter, a SQLReporter that runs on an empty in-memory SQLite database."""
-        parser = OptionParser()
-        add_command_line_options(parser)
-        (options, args) = parser.parse_args([
-            '--reporting-db-url', 'sqlite://',
-            '--sql-reporting-frequency', '0.05',
-            '--build-info', json.dumps({
-                'buildbot' : 1,
-                'buildnumber' : 1,
-                'branch' : 'a_branch_name',
-                'revision' : 'deadbeefdeadbeefdeadbeefdeadbeefdeadbeef',
-                'buildname' : 'a_build_name'
-            })
-        ])
+        options = make_options('sqlite://')
         create_engine_opts = {
             'poolclass' : SA.pool.StaticPool,
             'connect_args' : {'check_same_thread' : False}
@@ -148,6 +155,64 @@ class SQLReporterTestCase(SQLReporterBaseTestCase):
         for result in test_results:
             assert_equal(result['method_name'], 'test_pass')
 
+    def test_load_durations(self):
+        """Durations for scheduling are the average run time of each method, leaving out cached results."""
+        test_case = DummyTestCase()
+        for run_time, cached in [(1.0, False), (3.0, False), (100.0, True)]:
+            result = TestResult(test_case.test_pass)
+            result.start()
+            result.end_in_success()
+            result_dict = result.to_dict()
+            result_dict['run_time'] = run_time
+            result_dict['cached'] = cached
+            self.reporter.test_complete(result_dict)
+        assert self.reporter.report()
+
+        durations = load_durations(self.reporter.conn)
+        assert_equal(durations, {('%s DummyTestCase' % __name__, 'test_pass'): 2.0})
+
+
+class OldSchemaSQLReporterTestCase(TestCase):
+    """Reporting into a database made before test_results had the cached column."""
+
+    @setup_teardown
+    def make_old_database(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db_url = 'sqlite:///%s' % os.path.join(self.tempdir, 'reporting.db')
+        old_test_results = SA.Table(TestResults.name, SA.MetaData(), *[column.copy() for column in TestResults.columns if column.name != 'cached'])
+        old_test_results.create(SA.create_engine(self.db_url))
+        yield
+        shutil.rmtree(self.tempdir)
+
+    def test_reports_without_cached_column(self):
+        reporter = SQLReporter(make_options(self.db_url))
+        runner = TestRunner(DummyTestCase, test_reporters=[reporter])
+        result = TestResult(DummyTestCase().test_pass)
+        result.start()
+        result.end_in_success()
+        result_dict = result.to_dict()
+        result_dict['cached'] = True
+        reporter.test_complete(result_dict)
+
+        assert runner.run()
+
+        test_results = list(reporter.conn.execute(SA.select([SA.text('*')], from_obj=SA.text(TestResults.name))))
+        assert_equal(len(test_results), 3)
+        assert_not_in('cached', test_results[0].keys())
+
+    def test_load_durations_without_cached_column(self):
+        reporter = SQLReporter(make_options(self.db_url))
+        for run_time in (1.0, 3.0):
+            result = TestResult(DummyTestCase().test_pass)
+            result.start()
+            result.end_in_success()
+            result_dict = result.to_dict()
+            result_dict['run_time'] = run_time
+            reporter.test_complete(result_dict)
+        assert reporter.report()
+
+        assert_equal(load_durations(reporter.conn), {('%s DummyTestCase' % __name__, 'test_pass'): 2.0})
+
 
 class SQLReporterDiscoveryFailureTestCase(SQLReporterBaseTestCase, BrokenImportTestCase):
     def test_sql_reporter_sets_discovery_failure_flag(self):
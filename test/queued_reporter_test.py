@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+from testify import assert_equal, run, test_case
+from testify.queued_reporter import QueuedReporter
+from testify.test_reporter import TestReporter
+from testify.utils.mock_logging import mock_logging
+
+
+class RecordingReporter(TestReporter):
+    def __init__(self, options, succeed=True, release=None):
+        super(RecordingReporter, self).__init__(options)
+        self.calls = []
+        self.succeed = succeed
+        self.release = release
+
+    def test_start(self, result):
+        if self.release:
+            self.release.wait()
+        self.calls.append(('test_start', result))
+
+    def test_complete(self, result):
+        self.calls.append(('test_complete', result))
+
+    def report(self):
+        return self.succeed
+
+
+class ExplodingReporter(TestReporter):
+    def test_start(self, result):
+        raise ValueError("boom")
+
+
+class QueuedReporterTestCase(test_case.TestCase):
+    def test_passes_calls_on_in_order(self):
+        reporter = RecordingReporter(None)
+        queued = QueuedReporter(None, [ExplodingReporter(None), reporter])
+        with mock_logging(['testify']) as mock_handler:
+            for name in ('one', 'two'):
+                queued.test_start(name)
+                queued.test_complete(name)
+            assert queued.report()
+        assert_equal(len(mock_handler.get(logging.ERROR)), 2)
+        assert_equal(reporter.calls, [('test_start', 'one'), ('test_complete', 'one'), ('test_start', 'two'), ('test_complete', 'two')])
+
+    def test_report_is_all_reporters_reports(self):
+        queued = QueuedReporter(None, [RecordingReporter(None), RecordingReporter(None, succeed=False)])
+        assert not queued.report()
+
+    def test_full_queue_blocks_and_is_counted(self):
+        release = threading.Event()
+        reporter = RecordingReporter(None, release=release)
+        queued = QueuedReporter(None, [reporter], max_size=1)
+
+        queued.test_start('one')
+        # Wait for it to be taken off the queue (and get stuck in the reporter).
+        while queued.stats()['depth']:
+            time.sleep(0.001)
+        queued.test_start('two') # Fills the queue.
+        blocked = threading.Thread(target=queued.test_start, args=('three',))
+        blocked.start()
+        blocked.join(0.05)
+        assert blocked.is_alive()
+
+        release.set()
+        blocked.join()
+        assert queued.report()
+        assert_equal([result for _, result in reporter.calls], ['one', 'two', 'three'])
+
+        stats = queued.stats()
+        assert_equal((stats['queued'], stats['depth'], stats['max_size']), (3, 0, 1))
+        assert_equal(stats['blocked'], 1)
+        assert stats['blocked_seconds'] > 0
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+
+from testify import assert_equal, run, setup_teardown, test_case
+from testify import server_journal
+
+
+def result(class_path, method, success=True):
+    module, _, class_name = class_path.partition(' ')
+    return {'method': {'module': module, 'class': class_name, 'name': method}, 'success': success}
+
+
+class ServerJournalTestCase(test_case.TestCase):
+    @setup_teardown
+    def make_journal(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'journal')
+        self.journal = server_journal.ServerJournal(self.path)
+        yield
+        shutil.rmtree(self.tempdir)
+
+    def test_rebuilds_state(self):
+        self.journal.queue(0, {'class_path': 'mod Done', 'methods': ['test']})
+        self.journal.queue(1, {'class_path': 'mod Half', 'methods': ['test_a', 'test_b']})
+        self.journal.queue(2, {'class_path': 'mod Waiting', 'methods': ['test']})
+        self.journal.checkout('runner1', 'mod Done')
+        self.journal.reported(result('mod Done', 'test'))
+        self.journal.checkin('mod Done')
+        self.journal.checkout('runner1', 'mod Half')
+        self.journal.reported(result('mod Half', 'test_a'))
+        self.journal.rerun('failed', 'mod Half', 'test_b', result('mod Half', 'test_b', success=False))
+        self.journal.close()
+
+        state = server_journal.load(self.path)
+        assert_equal(state.reported_results, [result('mod Done', 'test'), result('mod Half', 'test_a')])
+        assert_equal(state.failed_rerun_methods, set([('mod Half', 'test_b')]))
+        assert_equal(state.previous_run_results[('mod Half', 'test_b')]['success'], False)
+        # What runner1 was in the middle of goes first, less what it had finished.
+        assert_equal(state.tests_to_queue(), [
+            (-1, {'class_path': 'mod Half', 'methods': ['test_b']}),
+            (2, {'class_path': 'mod Waiting', 'methods': ['test']}),
+        ])
+
+    def test_ignores_torn_line(self):
+        self.journal.queue(0, {'class_path': 'mod Waiting', 'methods': ['test'], 'chunk': 'mod Waiting#0'})
+        self.journal.close()
+        with open(self.path, 'a') as journal_file:
+            journal_file.write('{"event": "checko')
+
+        state = server_journal.load(self.path)
+        assert_equal(state.tests_to_queue(), [(0, {'class_path': 'mod Waiting', 'methods': ['test'], 'chunk': 'mod Waiting#0'})])
+        assert_equal(state.checked_out, {})
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
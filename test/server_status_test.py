@@ -0,0 +1,58 @@
+from testify import assert_equal, run, test_case
+from testify import server_status
+
+
+class ResultRateTestCase(test_case.TestCase):
+    def test_counts_results_in_the_window(self):
+        rate = server_status.ResultRate(window=10.0)
+        for now in (100.0, 101.0, 105.0, 109.0):
+            rate.add(now)
+        assert_equal(rate.total, 4)
+        assert_equal(rate.per_second(110.0, 0.0), 0.3)
+
+    def test_short_runs_count_from_their_start(self):
+        rate = server_status.ResultRate(window=10.0)
+        rate.add(101.0)
+        rate.add(102.0)
+        assert_equal(rate.per_second(104.0, 100.0), 0.5)
+        assert_equal(rate.per_second(100.0, 100.0), 0.0)
+
+
+class FormatOpenMetricsTestCase(test_case.TestCase):
+    status = {
+        'time': 1000.0,
+        'shutting_down': False,
+        'discovering': True,
+        'queue': {'tests': 3, 'waiting_runners': 0},
+        'checked_out': [{'key': 'mod Slow', 'class_path': 'mod Slow', 'runner': 'r"1', 'methods': 2, 'age_seconds': 1.5}],
+        'results': {'total': 7, 'failures': 1, 'per_second': 0.25},
+        'reruns': {'failed': 1, 'timeout': 0},
+        'runners': {'r"1': {'results': 7, 'results_per_second': 0.5, 'checked_out': 1, 'idle_seconds': 0.0, 'last_seen_seconds': 2.0}},
+        'eta_seconds': None,
+        'reporter_queue': {'depth': 0, 'max_size': 1000, 'max_depth': 2, 'queued': 14, 'blocked': 0, 'blocked_seconds': 0.0},
+    }
+
+    def test_format(self):
+        lines = server_status.format_openmetrics(self.status).splitlines()
+        assert_equal(lines[-1], '# EOF')
+        assert 'testify_queued_tests 3' in lines
+        assert 'testify_shutting_down 0' in lines
+        assert 'testify_discovering 1' in lines
+        # Counters get a _total suffix on their samples, but not in their TYPE line.
+        assert '# TYPE testify_results counter' in lines
+        assert 'testify_results_total 7' in lines
+        assert 'testify_reruns_total{reason="failed"} 1' in lines
+        # Label values are escaped.
+        assert 'testify_checked_out_age_seconds{key="mod Slow",runner="r\\"1"} 1.5' in lines
+        assert 'testify_runner_results_total{runner="r\\"1"} 7' in lines
+
+    def test_unknown_eta_has_no_sample(self):
+        lines = server_status.format_openmetrics(self.status).splitlines()
+        assert '# TYPE testify_eta_seconds gauge' in lines
+        assert not [line for line in lines if line.startswith('testify_eta_seconds')]
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
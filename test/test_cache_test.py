@@ -0,0 +1,100 @@
+import cStringIO
+import os
+import shutil
+import tempfile
+
+from testify import assert_equal, assert_in, run, setup_teardown, test_case
+from testify import test_cache
+from testify.test_logger import TextTestLogger, VERBOSITY_NORMAL
+from testify.test_runner import TestRunner
+from testify.utils import turtle
+
+
+class CountingTestCase(test_case.TestCase):
+    __test__ = False
+    runs = []
+    should_fail = False
+
+    def test_one(self):
+        self.runs.append('test_one')
+
+    def test_two(self):
+        self.runs.append('test_two')
+        assert not self.should_fail
+
+
+class ResultCacheTestCase(test_case.TestCase):
+    @setup_teardown
+    def make_cache_dir(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='testify_result_cache')
+        CountingTestCase.runs = []
+        CountingTestCase.should_fail = False
+        yield
+        shutil.rmtree(self.cache_dir)
+
+    def run_tests(self, **kwargs):
+        self.stream = cStringIO.StringIO()
+        options = turtle.Turtle(verbosity=VERBOSITY_NORMAL, summary_mode=False)
+        self.runner = TestRunner(
+            CountingTestCase,
+            options=options,
+            test_reporters=[TextTestLogger(options, stream=self.stream)],
+            result_cache_dir=self.cache_dir,
+            **kwargs
+        )
+        result = self.runner.run()
+        runs, CountingTestCase.runs = CountingTestCase.runs, []
+        return result, runs
+
+    def test_cached_results_are_not_rerun(self):
+        assert_equal(self.run_tests(), (True, ['test_one', 'test_two']))
+        assert_equal(self.run_tests(), (True, []))
+        assert_in('2 passed (2 cached)', self.stream.getvalue())
+
+    def test_failures_are_not_cached(self):
+        CountingTestCase.should_fail = True
+        assert_equal(self.run_tests(), (False, ['test_one', 'test_two']))
+        CountingTestCase.should_fail = False
+        assert_equal(self.run_tests(), (True, ['test_one', 'test_two']))
+
+    def test_uncached_methods_still_run(self):
+        assert_equal(self.run_tests(), (True, ['test_one', 'test_two']))
+        cache = self.runner.result_cache
+        key = cache.keys['%s %s' % (__name__, CountingTestCase.__name__)]
+        entry = cache.get(key)
+        del entry['test_two']
+        os.remove(cache.entry_path(key))
+        cache.put(key, entry)
+
+        assert_equal(self.run_tests(), (True, ['test_two']))
+
+    def test_environment_is_part_of_the_key(self):
+        os.environ['TESTIFY_CACHE_TEST'] = 'a'
+        try:
+            assert_equal(self.run_tests(result_cache_env=['TESTIFY_CACHE_TEST']), (True, ['test_one', 'test_two']))
+            os.environ['TESTIFY_CACHE_TEST'] = 'b'
+            assert_equal(self.run_tests(result_cache_env=['TESTIFY_CACHE_TEST']), (True, ['test_one', 'test_two']))
+        finally:
+            del os.environ['TESTIFY_CACHE_TEST']
+
+    def test_key_covers_first_party_dependencies(self):
+        cache = test_cache.ResultCache(self.cache_dir)
+        closure = cache.source_closure(__name__)
+        assert_in(os.path.abspath(__file__.replace('.pyc', '.py')), closure)
+        assert_in(os.path.abspath(test_cache.__file__.replace('.pyc', '.py')), closure)
+
+    def test_evict_least_recently_used(self):
+        cache = test_cache.ResultCache(self.cache_dir, max_size=1)
+        cache.put('aa00', {'test_one': {}})
+        cache.put('bb00', {'test_one': {}})
+        os.utime(cache.entry_path('aa00'), (0, 0))
+        cache.max_size = os.path.getsize(cache.entry_path('bb00'))
+        cache.evict()
+        assert not os.path.exists(cache.entry_path('aa00'))
+        assert os.path.exists(cache.entry_path('bb00'))
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,92 @@
+import cStringIO
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from testify import assert_equal, assert_in, assert_raises, run, setup_teardown, test_case
+from testify import test_daemon
+
+
+class TestDaemonTestCase(test_case.TestCase):
+    @setup_teardown
+    def start_daemon(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tempdir, 'daemon.sock')
+        self.daemon = test_daemon.TestDaemon(self.socket_path, [], preload_test_path='test.subdir.test', poll_interval=0.01)
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.start()
+        while not os.path.exists(self.socket_path):
+            time.sleep(0.01)
+
+        yield
+
+        self.daemon.shutdown()
+        thread.join()
+        shutil.rmtree(self.tempdir)
+
+    def test_runs_tests_and_returns_exit_status(self):
+        stream = cStringIO.StringIO()
+        exit_code = test_daemon.run_via_daemon(self.socket_path, ['test.subdir.test', '--no-color'], stream=stream)
+
+        assert_equal(exit_code, 0)
+        assert_in('PASSED.  1 test / 1 case', stream.getvalue())
+
+    def test_failed_run_exit_status(self):
+        stream = cStringIO.StringIO()
+        exit_code = test_daemon.run_via_daemon(self.socket_path, ['test.does_not_exist', '--no-color'], stream=stream)
+
+        assert_equal(exit_code, 1)
+        assert_in('DISCOVERY FAILURE', stream.getvalue())
+
+    def test_no_daemon(self):
+        assert_equal(test_daemon.run_via_daemon(os.path.join(self.tempdir, 'nope.sock'), ['test.subdir.test']), None)
+
+    def test_wont_replace_other_files(self):
+        path = os.path.join(self.tempdir, 'not_a_socket')
+        open(path, 'w').close()
+
+        assert_raises(test_daemon.DaemonError, test_daemon.TestDaemon(path, []).listen)
+        assert os.path.isfile(path)
+
+
+class RunViaDaemonTestCase(test_case.TestCase):
+    """run_via_daemon against a fake daemon that replies with canned bytes."""
+    @setup_teardown
+    def make_socket(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tempdir, 'daemon.sock')
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(1)
+        yield
+        self.listener.close()
+        shutil.rmtree(self.tempdir)
+
+    def run_with_reply(self, reply):
+        def serve():
+            conn, _ = self.listener.accept()
+            conn.makefile().readline()
+            conn.sendall(reply)
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        stream = cStringIO.StringIO()
+        exit_code = test_daemon.run_via_daemon(self.socket_path, ['test.subdir.test'], stream=stream)
+        thread.join()
+        return exit_code, stream.getvalue()
+
+    def test_output_can_contain_anything(self):
+        output = 'a NUL \0 and the magic ' + test_daemon.EXIT_MAGIC + ' ' * test_daemon.READ_SIZE + 'end\n'
+        assert_equal(self.run_with_reply(output + test_daemon.EXIT_TRAILER.pack(test_daemon.EXIT_MAGIC, 3)), (3, output))
+
+    def test_no_trailer(self):
+        assert_equal(self.run_with_reply('partial output'), (1, 'partial output'))
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,93 @@
+import os
+import tempfile
+
+from testify import assert_equal, run, setup_teardown, test_case
+from testify import test_durations
+from testify import test_runner_server
+from testify.utils import turtle
+
+try:
+    import simplejson as json
+    _hush_pyflakes = [json]
+    del _hush_pyflakes
+except ImportError:
+    import json
+
+
+def result_line(class_name, method, run_time, fixture_type=None, cached=False):
+    return json.dumps({
+        'method': {'module': 'mod', 'class': class_name, 'name': method, 'fixture_type': fixture_type},
+        'run_time': run_time,
+        'cached': cached,
+    }) + '\n'
+
+
+class LoadJSONDurationsTestCase(test_case.TestCase):
+    @setup_teardown
+    def make_log(self):
+        fd, self.path = tempfile.mkstemp(prefix='testify_durations')
+        os.write(fd, ''.join([
+            result_line('Slow', 'test_one', 10.0),
+            result_line('Slow', 'test_one', 20.0),
+            result_line('Slow', 'classSetUp', 50.0, fixture_type='class_setup'),
+            result_line('Slow', 'test_two', 99.0, cached=True),
+            '{"torn": \n',
+            result_line('Fast', 'test_one', 0.5),
+            'RUN COMPLETE\n',
+        ]))
+        os.close(fd)
+        yield
+        os.remove(self.path)
+
+    def test_averages_test_methods(self):
+        assert_equal(test_durations.load_json_durations(self.path), {
+            ('mod Slow', 'test_one'): 15.0,
+            ('mod Fast', 'test_one'): 0.5,
+        })
+
+
+class EstimateTestCase(test_case.TestCase):
+    def test_estimate(self):
+        durations = {('mod Slow', 'test_one'): 15.0, ('mod Slow', 'test_two'): 5.0}
+        assert_equal(test_durations.estimate(durations, 'mod Slow', ['test_one', 'test_two', 'test_new']), 20.0)
+        assert_equal(test_durations.estimate(durations, 'mod New', ['test_one']), None)
+
+    def test_predict_wall_time(self):
+        assert_equal(test_durations.predict_wall_time([5.0, 4.0, 3.0, 3.0], 2), 8.0)
+        assert_equal(test_durations.predict_wall_time([5.0, 4.0], 0), 9.0)
+        assert_equal(test_durations.predict_wall_time([], 3), 0.0)
+
+    def test_predict_wall_time_with_busy_runners(self):
+        # One runner has 6s left on what it's running, so both 2s tests go to the other.
+        assert_equal(test_durations.predict_wall_time([2.0, 2.0], 2, busy=[6.0]), 6.0)
+        assert_equal(test_durations.predict_wall_time([2.0], 1, busy=[1.0, 4.0]), 4.0)
+        assert_equal(test_durations.predict_wall_time([], 0, busy=[3.0]), 3.0)
+
+
+class LongestFirstTestCase(test_case.TestCase):
+    def build_server(self, **kwargs):
+        options = turtle.Turtle(runner_timeout=1, server_timeout=10, revision=None, shutdown_delay_for_connection_close=0.001, shutdown_delay_for_outstanding_runners=1)
+        return test_runner_server.TestRunnerServer(None, options=options, serve_port=0, test_reporters=[], plugin_modules=[], **kwargs)
+
+    def test_longest_first(self):
+        server = self.build_server(durations_json='unused')
+        server.durations = {('mod Short', 'test'): 1.0, ('mod Long', 'test'): 30.0, ('mod Medium', 'test'): 10.0}
+        test_dicts = [{'class_path': class_path, 'methods': ['test']} for class_path in ['mod Short', 'mod Unknown', 'mod Long', 'mod Medium']]
+
+        # mod Unknown is assumed to take the average, 41/3 seconds.
+        prioritized = server.prioritize(test_dicts)
+        assert_equal([test_dict['class_path'] for _, test_dict in prioritized], ['mod Long', 'mod Unknown', 'mod Medium', 'mod Short'])
+        assert_equal([priority for priority, _ in prioritized], [0.0, 30.0 - 41.0 / 3, 20.0, 29.0])
+        assert all(priority > -1 for priority, _ in prioritized)
+
+    def test_discovery_order_without_durations(self):
+        server = self.build_server()
+        test_dicts = [{'class_path': class_path, 'methods': ['test']} for class_path in ['mod B', 'mod A']]
+        assert_equal(server.prioritize(test_dicts), [(0, test_dicts[0]), (1, test_dicts[1])])
+        assert_equal(server.predicted_estimates, None)
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,131 @@
+import os
+import tempfile
+
+from testify import assert_equal, assert_raises, run, setup_teardown, test_case
+from testify import test_history
+from testify.test_runner import TestRunner
+
+
+def make_result(class_name, method, success, run_time, module='test.test_history_test'):
+    return {
+        'success': success,
+        'run_time': run_time,
+        'method': {
+            'module': module,
+            'class': class_name,
+            'name': method,
+            'fixture_type': None,
+        },
+    }
+
+
+class FastTestCase(test_case.TestCase):
+    __test__ = False
+    def test_fast(self):
+        pass
+
+class SlowTestCase(test_case.TestCase):
+    __test__ = False
+    def test_slow(self):
+        pass
+
+class FlakyTestCase(test_case.TestCase):
+    __test__ = False
+    def test_flaky(self):
+        pass
+
+class NewTestCase(test_case.TestCase):
+    __test__ = False
+    def test_new(self):
+        pass
+
+
+class TestHistoryBaseTestCase(test_case.TestCase):
+    __test__ = False
+
+    @setup_teardown
+    def make_history_file(self):
+        fd, self.history_path = tempfile.mkstemp(prefix='testify_history')
+        os.close(fd)
+        yield
+        os.remove(self.history_path)
+
+
+class TestHistoryTestCase(TestHistoryBaseTestCase):
+    def test_last_record_wins(self):
+        history = test_history.TestHistory(self.history_path)
+        history.record([make_result('A', 'test_a', False, 1.0)])
+        history.record([make_result('A', 'test_a', True, 2.5)])
+
+        entries = test_history.TestHistory(self.history_path).load()
+        assert_equal(entries, {('test.test_history_test A', 'test_a'): (True, 2.5)})
+
+    def test_garbled_lines_are_skipped(self):
+        history = test_history.TestHistory(self.history_path)
+        history.record([make_result('A', 'test_a', True, 1.0)])
+        with_garbage = open(self.history_path, 'a')
+        with_garbage.write('test.test_history_test A\ttest_')
+        with_garbage.close()
+
+        entries = test_history.TestHistory(self.history_path).load()
+        assert_equal(entries.keys(), [('test.test_history_test A', 'test_a')])
+
+    def test_compact(self):
+        history = test_history.TestHistory(self.history_path)
+        for run_time in range(test_history.COMPACTION_RATIO * 2):
+            history.record([make_result('A', 'test_a', True, run_time)])
+        history.compact()
+
+        lines = open(self.history_path).readlines()
+        assert_equal(len(lines), 1)
+        assert_equal(test_history.TestHistory(self.history_path).load().values(), [(True, float(run_time))])
+
+    def test_parse_order(self):
+        assert_equal(test_history.parse_order('failed-first'), ('failed-first', None))
+        assert_equal(test_history.parse_order('random:42'), ('random', 42))
+        assert_raises(ValueError, test_history.parse_order, 'random')
+        assert_raises(ValueError, test_history.parse_order, 'alphabetical')
+
+
+class OrderTestCasesTestCase(TestHistoryBaseTestCase):
+    @setup_teardown
+    def record_history(self):
+        self.history = test_history.TestHistory(self.history_path)
+        self.history.record([
+            make_result('FastTestCase', 'test_fast', True, 0.1),
+            make_result('SlowTestCase', 'test_slow', True, 10.0),
+            make_result('FlakyTestCase', 'test_flaky', False, 1.0),
+        ])
+        self.test_cases = [FastTestCase(), NewTestCase(), SlowTestCase(), FlakyTestCase()]
+        yield
+
+    def ordered_names(self, order):
+        return [type(test_case).__name__ for test_case in test_history.order_test_cases(self.test_cases, order, self.history)]
+
+    def test_failed_first(self):
+        assert_equal(self.ordered_names('failed-first'), ['FlakyTestCase', 'FastTestCase', 'SlowTestCase', 'NewTestCase'])
+
+    def test_slowest_first(self):
+        assert_equal(self.ordered_names('slowest-first'), ['SlowTestCase', 'FlakyTestCase', 'FastTestCase', 'NewTestCase'])
+
+    def test_fastest_first(self):
+        assert_equal(self.ordered_names('fastest-first'), ['FastTestCase', 'FlakyTestCase', 'SlowTestCase', 'NewTestCase'])
+
+    def test_random_is_reproducible(self):
+        assert_equal(self.ordered_names('random:7'), self.ordered_names('random:7'))
+
+
+class TestRunnerHistoryTestCase(TestHistoryBaseTestCase):
+    def test_runner_records_history(self):
+        runner = TestRunner(FastTestCase, history_file=self.history_path)
+        assert runner.run()
+
+        entries = test_history.TestHistory(self.history_path).load()
+        assert_equal(entries.keys(), [('test.test_history_test FastTestCase', 'test_fast')])
+        assert entries[('test.test_history_test FastTestCase', 'test_fast')][0]
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
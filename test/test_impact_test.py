@@ -0,0 +1,164 @@
+import cStringIO
+import os
+import sys
+import tempfile
+
+from testify import assert_equal, run, setup_teardown, test_case
+from testify import test_impact
+from testify.plugins import coverage_map
+from testify.test_reporter import TestReporter
+from testify.test_runner import TestRunner
+from testify.utils import turtle
+
+
+SAMPLE_DIFF = """\
+diff --git a/lib/widget.py b/lib/widget.py
+index 1111111..2222222 100644
+--- a/lib/widget.py
++++ b/lib/widget.py
+@@ -3,4 +3,4 @@ import os
+ def widget():
+-    return 1
++    return 2
+
+ def gadget():
+@@ -20,2 +20,3 @@ def gizmo():
+     pass
++    pass
+
+diff --git a/lib/new.py b/lib/new.py
+new file mode 100644
+--- /dev/null
++++ b/lib/new.py
+@@ -0,0 +1 @@
++x = 1
+"""
+
+
+def traced_helper():
+    return 1
+
+
+class CoveredTestCase(test_case.TestCase):
+    __test__ = False
+
+    def test_calls_helper(self):
+        traced_helper()
+
+    def test_calls_nothing(self):
+        pass
+
+
+class ParseChangesTestCase(test_case.TestCase):
+    def test_unified_diff(self):
+        changes = test_impact.parse_changes(SAMPLE_DIFF)
+        # The replaced line, and the old lines on either side of the inserted one.
+        assert_equal(changes, {os.path.join('lib', 'widget.py'): set([4, 20, 21])})
+
+    def test_file_list(self):
+        changes = test_impact.parse_changes("lib/widget.py\n\nlib/gadget.py\n")
+        assert_equal(changes, {
+            os.path.join('lib', 'widget.py'): test_impact.WHOLE_FILE,
+            os.path.join('lib', 'gadget.py'): test_impact.WHOLE_FILE,
+        })
+
+    def test_encode_lines(self):
+        lines = set([1, 2, 3, 4, 9, 12, 13])
+        assert_equal(test_impact.encode_lines(lines), '1-4,9,12-13')
+        assert_equal(test_impact.decode_lines('1-4,9,12-13'), lines)
+
+
+class CoverageMapTestCase(test_case.TestCase):
+    @setup_teardown
+    def make_map_path(self):
+        fd, self.map_path = tempfile.mkstemp(prefix='testify_coverage_map')
+        os.close(fd)
+        os.remove(self.map_path)
+        yield
+        if os.path.exists(self.map_path):
+            os.remove(self.map_path)
+
+    def build_map(self):
+        cmap = test_impact.CoverageMap(self.map_path)
+        cmap.record('mod A', 'test_widget', {'lib/widget.py': set([3, 4]), 'lib/util.py': set([1])})
+        cmap.record('mod A', 'test_gadget', {'lib/widget.py': set([7, 8])})
+        cmap.record('mod A', test_impact.CLASS_LEVEL, {'lib/fixtures.py': set([10])})
+        cmap.save()
+        return test_impact.CoverageMap(self.map_path).load()
+
+    def test_round_trip(self):
+        cmap = self.build_map()
+        assert_equal(sorted(cmap.files), ['lib/fixtures.py', 'lib/util.py', 'lib/widget.py'])
+        widget_index = str(cmap.files.index('lib/widget.py'))
+        assert_equal(cmap.tests['mod A']['test_widget'][widget_index], '3-4')
+
+    def test_selects_methods_touching_changed_lines(self):
+        selection = self.build_map().affected({'lib/widget.py': set([4])})
+        assert_equal(selection.filter_methods('mod A', ['test_gadget', 'test_widget']), ['test_widget'])
+
+    def test_unchanged_lines_select_nothing(self):
+        selection = self.build_map().affected({'lib/widget.py': set([5])})
+        assert_equal(selection.filter_methods('mod A', ['test_gadget', 'test_widget']), [])
+
+    def test_whole_file_change(self):
+        selection = self.build_map().affected({'lib/widget.py': test_impact.WHOLE_FILE})
+        assert_equal(selection.filter_methods('mod A', ['test_gadget', 'test_widget']), ['test_gadget', 'test_widget'])
+
+    def test_class_level_change_selects_every_method(self):
+        selection = self.build_map().affected({'lib/fixtures.py': set([10])})
+        assert_equal(selection.filter_methods('mod A', ['test_gadget', 'test_widget']), ['test_gadget', 'test_widget'])
+
+    def test_unknown_tests_always_run(self):
+        selection = self.build_map().affected({})
+        assert_equal(selection.filter_methods('mod A', ['test_gadget', 'test_new']), ['test_new'])
+        assert_equal(selection.filter_methods('mod B', ['test_b']), ['test_b'])
+
+    def test_record_and_select(self):
+        """Record a map with the plugin, then use it to pick the tests affected by a change to traced_helper."""
+        options = turtle.Turtle(record_coverage_map=True, coverage_map=self.map_path, isolate=None)
+        runner = TestRunner(
+            CoveredTestCase,
+            options=options,
+            plugin_modules=[coverage_map],
+            test_reporters=coverage_map.build_test_reporters(options),
+        )
+        assert runner.run()
+
+        cmap = test_impact.CoverageMap(self.map_path).load()
+        class_path = '%s %s' % (__name__, CoveredTestCase.__name__)
+        assert 'test_calls_helper' in cmap.tests[class_path]
+        assert 'test_calls_nothing' in cmap.tests[class_path]
+
+        helper_line = traced_helper.func_code.co_firstlineno + 1
+        selection = cmap.affected({test_impact.normalize_path(__file__.replace('.pyc', '.py')): set([helper_line])})
+        assert_equal(selection.filter_methods(class_path, ['test_calls_helper', 'test_calls_nothing']), ['test_calls_helper'])
+
+        runner = TestRunner(CoveredTestCase, affected_tests=selection)
+        selected = runner.select_affected_methods(CoveredTestCase())
+        assert_equal([method.__name__ for method in selected.runnable_test_methods()], ['test_calls_helper'])
+
+    def test_nothing_affected_is_a_success(self):
+        class NothingRunner(TestRunner):
+            def discover(self):
+                # Like TestRunnerClient's, a generator.
+                for test_case in []:
+                    yield test_case
+
+        class FailingReporter(TestReporter):
+            def report(self):
+                return False
+
+        selection = test_impact.ImpactSelection({}, {})
+        runner = NothingRunner(CoveredTestCase, affected_tests=selection, test_reporters=[FailingReporter(None)])
+        stdout, sys.stdout = sys.stdout, cStringIO.StringIO()
+        try:
+            assert runner.run()
+            assert_equal(sys.stdout.getvalue(), '')
+        finally:
+            sys.stdout = stdout
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
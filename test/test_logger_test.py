@@ -1,8 +1,8 @@
 import cStringIO
 
 from test.discovery_failure_test import BrokenImportTestCase
-from testify import assert_in, run, setup, teardown
-from testify.test_logger import TextTestLogger, VERBOSITY_NORMAL
+from testify import assert_in, assert_not_in, run, setup, teardown, test_case
+from testify.test_logger import ColorlessTextTestLogger, TextTestLogger, VERBOSITY_NORMAL
 from testify.test_runner import TestRunner
 from testify.utils import turtle
 
@@ -34,6 +34,22 @@ class TestTextLoggerDiscoveryFailureTestCase(BrokenImportTestCase):
         assert_in('DISCOVERY FAILURE!', logger_output)
 
 
+class ColorlessTextTestLoggerTestCase(test_case.TestCase):
+    def test_failure_uses_plain_traceback(self):
+        stream = cStringIO.StringIO()
+        logger = ColorlessTextTestLogger(turtle.Turtle(verbosity=VERBOSITY_NORMAL), stream=stream)
+        logger._detect_color_support = lambda: self.fail("colorless loggers shouldn't look for color support")
+
+        logger.failure({
+            'method': {'module': 'mod', 'class': 'Cls', 'name': 'test_it'},
+            'exception_info': ['plain traceback'],
+            'exception_info_pretty': ['pretty traceback'],
+        })
+
+        assert_in('plain traceback', stream.getvalue())
+        assert_not_in('pretty traceback', stream.getvalue())
+
+
 if __name__ == '__main__':
     run()
 
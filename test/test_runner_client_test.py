@@ -0,0 +1,197 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from testify import assert_equal, run, setup, setup_teardown, test_case
+from testify.test_reporter import TestReporter
+from testify.test_runner_client import ModuleImporter, TestRunnerClient
+from testify.utils import turtle
+
+
+class ScriptedTestRunnerClient(TestRunnerClient):
+    """Hands out scripted batches instead of asking a server, and counts how many it's been asked for."""
+
+    def __init__(self, batches, **kwargs):
+        self.batches = list(batches)
+        self.requested = []
+        self.prefetched = threading.Event()
+        super(ScriptedTestRunnerClient, self).__init__(None, connect_addr='localhost:0', runner_id='runner1', **kwargs)
+
+    def get_next_tests(self, retry_interval=2, retry_limit=0, max_classes=None):
+        self.requested.append(max_classes)
+        if len(self.requested) > 1:
+            self.prefetched.set()
+        batch = self.batches.pop(0) if self.batches else ([], True, [])
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def load_test_case(self, class_path, methods):
+        return class_path, methods
+
+
+class TestRunnerClientTestCase(test_case.TestCase):
+    @setup
+    def build_batches(self):
+        self.batches = [
+            ([('fake One', ['test']), ('fake Two', ['test'])], False, ['later Four']),
+            ([('fake Three', ['test'])], False, []),
+            ([], True, []),
+        ]
+
+    def build_client(self, prefetch, import_ahead=0):
+        options = turtle.Turtle(revision=None, retry_limit=0, retry_interval=0, reconnect_retry_limit=0, batch_size=2, batch_seconds=None, prefetch=prefetch, import_ahead=import_ahead, slots=1)
+        return ScriptedTestRunnerClient(self.batches, options=options)
+
+    def test_runs_every_class_in_every_batch(self):
+        client = self.build_client(prefetch=False)
+        assert_equal([class_path for class_path, _ in client.discover()], ['fake One', 'fake Two', 'fake Three'])
+        assert_equal(len(client.requested), 3)
+
+    def test_prefetch_asks_while_running(self):
+        client = self.build_client(prefetch=True)
+        tests = client.discover()
+        assert_equal(tests.next(), ('fake One', ['test']))
+        # While we "run" the first class, the next batch gets requested.
+        client.prefetched.wait(1)
+        assert_equal(len(client.requested), 2)
+        assert_equal([class_path for class_path, _ in tests], ['fake Two', 'fake Three'])
+        assert_equal(len(client.requested), 3)
+
+    def test_asks_again_when_prefetching_fails(self):
+        self.batches.insert(1, ValueError('bad response'))
+        client = self.build_client(prefetch=True)
+        assert_equal([class_path for class_path, _ in client.discover()], ['fake One', 'fake Two', 'fake Three'])
+        assert_equal(len(client.requested), 4)
+
+    def test_imports_ahead(self):
+        client = self.build_client(prefetch=False, import_ahead=1)
+        client.importer = turtle.Turtle()
+        tests = client.discover()
+        tests.next()
+        # Not the test case we're about to run, but the rest of the batch and what the server expects we'll get.
+        assert_equal(client.importer.import_modules.calls, [((['fake', 'later'],), {})])
+        list(tests)
+        assert_equal(client.importer.import_modules.calls[1:], [(([],), {}), (([],), {})])
+
+
+class MeetingTestCase(test_case.TestCase):
+    """Only passes if MeetingTestCase and AlsoMeetingTestCase are running at the same time."""
+    __test__ = False
+    meeting_dir = None
+
+    def test(self):
+        open(os.path.join(self.meeting_dir, self.__class__.__name__), 'w').close()
+        start = time.time()
+        while len(os.listdir(self.meeting_dir)) < 2:
+            assert time.time() - start < 5, "The other test case never turned up"
+            time.sleep(0.01)
+
+
+class AlsoMeetingTestCase(MeetingTestCase):
+    __test__ = False
+
+
+class FailingTestCase(test_case.TestCase):
+    __test__ = False
+    def test(self):
+        assert False
+
+
+class ScriptedSlotsClient(ScriptedTestRunnerClient):
+    """Runs the test cases it's handed for real."""
+    load_test_case = TestRunnerClient.load_test_case
+
+
+class RecordingReporter(TestReporter):
+    def __init__(self):
+        super(RecordingReporter, self).__init__(None)
+        self.completed = []
+
+    def test_complete(self, result):
+        self.completed.append(result)
+
+
+class SlotsTestCase(test_case.TestCase):
+    @setup_teardown
+    def make_meeting_dir(self):
+        MeetingTestCase.meeting_dir = tempfile.mkdtemp()
+        yield
+        shutil.rmtree(MeetingTestCase.meeting_dir)
+        MeetingTestCase.meeting_dir = None
+
+    def test_runs_test_cases_side_by_side(self):
+        batches = [
+            ([('%s MeetingTestCase' % __name__, ['test']), ('%s AlsoMeetingTestCase' % __name__, ['test'])], False, []),
+            ([('%s FailingTestCase' % __name__, ['test'])], False, []),
+        ]
+        options = turtle.Turtle(revision=None, retry_limit=0, retry_interval=0, reconnect_retry_limit=0, batch_size=1, batch_seconds=None, prefetch=False, import_ahead=0, slots=2)
+        reporter = RecordingReporter()
+        client = ScriptedSlotsClient(batches, options=options, test_reporters=[reporter])
+
+        client.run()
+        # We asked for as many test cases as we had free slots.
+        assert_equal(client.requested[:2], [2, 1])
+        results = dict((result['method']['class'], result) for result in reporter.completed)
+        assert_equal(sorted(results), ['AlsoMeetingTestCase', 'FailingTestCase', 'MeetingTestCase'])
+        assert results['MeetingTestCase']['success']
+        assert results['AlsoMeetingTestCase']['success']
+        assert not results['FailingTestCase']['success']
+        assert_equal(client.failure_count, 1)
+
+    def test_stops_when_fetching_fails(self):
+        batches = [([('%s FailingTestCase' % __name__, ['test'])], False, []), ValueError('bad response')]
+        options = turtle.Turtle(revision=None, retry_limit=0, retry_interval=0, reconnect_retry_limit=0, batch_size=1, batch_seconds=None, prefetch=False, import_ahead=0, slots=2)
+        reporter = RecordingReporter()
+        client = ScriptedSlotsClient(batches, options=options, test_reporters=[reporter])
+
+        thread = threading.Thread(target=client.run)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        assert not thread.is_alive(), "The client hung waiting for tests"
+        assert_equal(len(reporter.completed), 1)
+
+    def test_closes_its_pipe_when_interrupted_mid_fetch(self):
+        release_fetch = threading.Event()
+        class InterruptedClient(ScriptedSlotsClient):
+            def get_next_tests(self, *args, **kwargs):
+                if self.requested:
+                    release_fetch.wait(5)
+                return ScriptedSlotsClient.get_next_tests(self, *args, **kwargs)
+
+            def report_isolated_event(self, event, result_dict):
+                raise KeyboardInterrupt
+
+        batches = [([('%s FailingTestCase' % __name__, ['test'])], False, [])]
+        options = turtle.Turtle(revision=None, retry_limit=0, retry_interval=0, reconnect_retry_limit=0, batch_size=1, batch_seconds=None, prefetch=False, import_ahead=0, slots=2)
+        client = InterruptedClient(batches, options=options, test_reporters=[RecordingReporter()])
+
+        open_fds = len(os.listdir('/proc/self/fd'))
+        client.run()
+        # The second fetch was still going when we were interrupted; once it's done, it closes the rest of the pipe.
+        release_fetch.set()
+        start = time.time()
+        while len(os.listdir('/proc/self/fd')) > open_fds:
+            assert time.time() - start < 5, "run_slots leaked its wake pipe"
+            time.sleep(0.01)
+
+
+class ModuleImporterTestCase(test_case.TestCase):
+    def test_imports_in_the_background_and_ignores_errors(self):
+        sys.modules.pop('colorsys', None)
+        ModuleImporter().import_modules(['testify_no_such_module', 'colorsys'])
+        start = time.time()
+        while 'colorsys' not in sys.modules:
+            assert time.time() - start < 5, "Timed out waiting for the import"
+            time.sleep(0.01)
+        assert 'testify_no_such_module' not in sys.modules
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,121 @@
+import Queue
+import threading
+import time
+
+from testify import assert_equal, run, setup_teardown, test_case
+from testify.test_runner_relay import TestRunnerRelay
+from testify.utils import turtle
+from test_runner_server_test import get_test
+
+
+class FakeUpstream(object):
+    """Stands in for the root server: hands out the leases put on self.leases, and records everything else."""
+
+    def __init__(self):
+        self.leases = Queue.Queue()
+        self.lease_requests = []
+        self.results = []
+        self.releases = []
+
+    def get_tests(self, max_classes):
+        self.lease_requests.append(max_classes)
+        return self.leases.get()
+
+    def report_results(self, results):
+        self.results.extend(results)
+        return []
+
+    def heartbeat(self):
+        pass
+
+    def release(self, class_path, methods, reason):
+        self.releases.append((class_path, methods, reason))
+
+    def close(self):
+        pass
+
+
+def wait_for(condition, timeout=5):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout, "Timed out waiting"
+        time.sleep(0.01)
+
+
+class TestRunnerRelayTestCase(test_case.TestCase):
+    @setup_teardown
+    def start_relay(self):
+        self.relay = TestRunnerRelay(
+            None,
+            options=turtle.Turtle(
+                runner_timeout=1,
+                server_timeout=10,
+                revision=None,
+                shutdown_delay_for_connection_close=0.001,
+                shutdown_delay_for_outstanding_runners=1,
+            ),
+            serve_port=0,
+            test_reporters=[turtle.Turtle()],
+            plugin_modules=[],
+            relay_addr='root:0',
+            relay_id='relay1',
+            lease_size=2,
+        )
+        self.upstream = FakeUpstream()
+        self.relay.lease_upstream = self.upstream
+        self.relay.send_upstream = self.upstream
+
+        self.thread = threading.Thread(target=self.relay.run)
+        self.thread.start()
+        yield
+        # Let go of the lease thread if it's waiting on us, then shut down.
+        self.upstream.leases.put(([], True))
+        self.relay.shutdown()
+        self.thread.join()
+
+    def result(self, class_path, method, success=True):
+        module, _, class_name = class_path.partition(' ')
+        return {'method': {'module': module, 'class': class_name, 'name': method, 'full_name': '%s.%s' % (class_path, method)}, 'success': success, 'runner_id': 'runner1'}
+
+    def test_leases_tests_and_forwards_results(self):
+        self.upstream.leases.put(([('fake A', ['test_a', 'test_b'])], False))
+        test_dict = get_test(self.relay, 'runner1')
+        assert_equal((test_dict['class_path'], test_dict['methods']), ('fake A', ['test_a', 'test_b']))
+        assert_equal(self.upstream.lease_requests[0], 2)
+        assert_equal(self.relay.test_reporters[0].reporters, [])
+
+        # Failures go to the root too, which decides whether to rerun them.
+        self.relay.report_result('runner1', self.result('fake A', 'test_a'))
+        self.relay.report_result('runner1', self.result('fake A', 'test_b', success=False))
+        wait_for(lambda: len(self.upstream.results) == 2)
+        assert_equal([result['method']['name'] for result in self.upstream.results], ['test_a', 'test_b'])
+        assert_equal(self.upstream.results[0]['runner_id'], 'runner1')
+        assert_equal(self.relay.test_queue.test_count, 0)
+        assert not self.relay.checked_out
+
+    def test_releases_timed_out_tests_to_the_root(self):
+        self.upstream.leases.put(([('fake A', ['test_a', 'test_b'])], False))
+        get_test(self.relay, 'runner1')
+        self.relay.report_result('runner1', self.result('fake A', 'test_a'))
+
+        wait_for(lambda: self.upstream.releases, timeout=3)
+        ((class_path, methods, reason),) = self.upstream.releases
+        assert_equal((class_path, methods), ('fake A', ['test_b']))
+        assert 'relay1' in reason, reason
+        # The root decides what to rerun, so we don't requeue anything ourselves.
+        assert self.relay.test_queue.empty()
+        assert not self.relay.checked_out
+        # The release went after the result for test_a.
+        assert_equal(len(self.upstream.results), 1)
+
+    def test_shuts_down_when_the_root_is_done(self):
+        self.upstream.leases.put(([], True))
+        assert_equal(get_test(self.relay, 'runner1'), None)
+        self.thread.join(5)
+        assert not self.thread.is_alive()
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
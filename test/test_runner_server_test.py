@@ -1,8 +1,13 @@
+import os
+import Queue
+import shutil
+import tempfile
 import threading
+import time
 import tornado.ioloop
 
 from discovery_failure_test import BrokenImportTestCase
-from testify import assert_equal, class_setup, setup, teardown, test_case, test_runner_server
+from testify import assert_equal, assert_not_reached, binary_transport, class_setup, server_journal, setup, teardown, test_case, test_runner_server
 from testify.test_logger import _log
 from testify.utils import turtle
 
@@ -26,8 +31,28 @@ def get_test(server, runner_id):
     (test_received,) = tests_received
     return test_received
 
+def get_tests(server, runner_id, **kwargs):
+    """A blocking function to request a batch of tests from a TestRunnerServer."""
+    sem = threading.Semaphore(0)
+    batches_received = []
+
+    def inner(test_dicts):
+        batches_received.append(test_dicts)
+        sem.release()
+
+    def inner_empty():
+        batches_received.append(None)
+        sem.release()
+
+    server.get_next_tests(runner_id, inner, inner_empty, **kwargs)
+    sem.acquire()
+
+    (batch_received,) = batches_received
+    return batch_received
+
 class TestRunnerServerBaseTestCase(test_case.TestCase):
     __test__ = False
+    server_class = test_runner_server.TestRunnerServer
 
     def build_test_case(self):
         class DummyTestCase(test_case.TestCase):
@@ -39,11 +64,11 @@ class TestRunnerServerBaseTestCase(test_case.TestCase):
 
         self.dummy_test_case = DummyTestCase
 
-    def start_server(self, test_reporters=None):
+    def start_server(self, test_reporters=None, **server_kwargs):
         if test_reporters is None:
             test_reporters = []
 
-        self.server = test_runner_server.TestRunnerServer(
+        self.server = self.server_class(
             self.dummy_test_case,
             options=turtle.Turtle(
                 runner_timeout=1,
@@ -55,6 +80,7 @@ class TestRunnerServerBaseTestCase(test_case.TestCase):
             serve_port=0,
             test_reporters=test_reporters,
             plugin_modules=[],
+            **server_kwargs
         );
 
         def catch_exceptions_in_thread():
@@ -159,6 +185,18 @@ class TestRunnerServerTestCase(TestRunnerServerBaseTestCase):
 
         assert_equal(get_test(self.server, 'runner3'), None)
 
+    def test_lone_runner_reruns_its_own_failures(self):
+        """With nobody else to rerun it, a runner gets back the test it failed."""
+        first_test = get_test(self.server, 'runner1')
+        self.run_test('runner1', should_pass=False)
+
+        second_test = get_test(self.server, 'runner1')
+        assert_equal(second_test['class_path'], first_test['class_path'])
+        assert_equal(second_test['methods'], ['test'])
+
+        self.run_test('runner1', should_pass=False)
+        assert_equal(get_test(self.server, 'runner1'), None)
+
     def test_requeue_on_timeout(self):
         """Start a server with one test case to run. Make sure it hands out the same test twice, then nothing else."""
 
@@ -179,6 +217,22 @@ class TestRunnerServerTestCase(TestRunnerServerBaseTestCase):
         assert_equal(first_test['methods'], second_test['methods'])
         assert_equal(third_test, None)
 
+    def test_release_is_a_timeout(self):
+        """A relay releasing a test is treated as it timing out: the test is rerun once, then reported with the relay's reason."""
+        reported = Queue.Queue()
+        self.server.test_reporters = [turtle.Turtle(test_complete=reported.put)]
+
+        first_test = get_test(self.server, 'relay1')
+        tornado.ioloop.IOLoop.instance().add_callback(lambda: self.server.release('relay1', first_test['class_path'], first_test['methods'], 'Gone'))
+        second_test = get_test(self.server, 'relay2')
+        assert_equal(second_test['methods'], first_test['methods'])
+
+        # Releasing a test someone else has checked out does nothing.
+        tornado.ioloop.IOLoop.instance().add_callback(lambda: self.server.release('relay1', second_test['class_path'], second_test['methods'], 'Gone'))
+        tornado.ioloop.IOLoop.instance().add_callback(lambda: self.server.release('relay2', second_test['class_path'], second_test['methods'], 'Gone again'))
+        assert_equal(get_test(self.server, 'relay3'), None)
+        assert_equal(reported.get(timeout=1)['exception_info'], ['Gone again\n'])
+
     def test_fail_then_timeout_twice(self):
         """Fail, then time out, then time out again, then time out again.
         The first three fetches should give the same test; the last one should be None."""
@@ -228,6 +282,9 @@ class TestRunnerServerTestCase(TestRunnerServerBaseTestCase):
          - The server has more than one test in its queue
          - All the tests in the server's queue were last run by the runner asking for tests.
         """
+        # Let the server finish queueing the tests it discovered, so none of them land in our queue.
+        while self.server.test_queue.empty():
+            time.sleep(0.01)
         self.server.test_queue = test_runner_server.AsyncDelayedQueue()
 
         self.server.test_queue.put(0, {'last_runner': 'foo', 'class_path': '1', 'methods': ['blah'], 'fixture_methods': []})
@@ -255,4 +312,519 @@ class TestRunnerServerTestCase(TestRunnerServerBaseTestCase):
         if failures:
             raise Exception(' '.join(failures))
 
+
+class TestRunnerServerBatchTestCase(TestRunnerServerBaseTestCase):
+    def queue_more_tests(self, *class_paths):
+        # Let the server queue the test it discovered first, so it comes out ahead of ours.
+        while self.server.test_queue.empty():
+            time.sleep(0.01)
+        for class_path in class_paths:
+            self.server.test_queue.put(1, {'class_path': class_path, 'methods': ['test'], 'last_runner': None})
+
+    def report_pass(self, runner_id, test_dict):
+        module, _, class_name = test_dict['class_path'].partition(' ')
+        result = {'method': {'module': module, 'class': class_name, 'name': 'test'}, 'success': True}
+        tornado.ioloop.IOLoop.instance().add_callback(lambda: self.server.report_result(runner_id, result))
+
+    def test_batch_is_checked_out_per_class(self):
+        self.queue_more_tests('fake Two', 'fake Three', 'fake Four')
+        batch = get_tests(self.server, 'runner1', max_classes=3)
+        assert_equal([test_dict['class_path'] for test_dict in batch], ['test.test_runner_server_test DummyTestCase', 'fake Two', 'fake Three'])
+        assert_equal(set(self.server.checked_out), set(test_dict['class_path'] for test_dict in batch))
+        assert_equal(self.server.checked_out_by_runner['runner1'], set(self.server.checked_out))
+
+        (rest,) = get_tests(self.server, 'runner2', max_classes=3)
+        assert_equal(rest['class_path'], 'fake Four')
+
+    def test_results_extend_the_whole_batch(self):
+        self.queue_more_tests('fake Two')
+        first, second = get_tests(self.server, 'runner1', max_classes=2)
+        self.server.checked_out['fake Two']['timeout_time'] = 0
+
+        self.report_pass('runner1', first)
+        # report_result runs on the IOLoop; wait for it to check the first class in.
+        while first['class_path'] in self.server.checked_out:
+            time.sleep(0.01)
+        assert self.server.checked_out['fake Two']['timeout_time'] > time.time()
+        assert_equal(self.server.checked_out_by_runner['runner1'], set(['fake Two']))
+
+    def test_report_results_reports_errors_per_result(self):
+        (test_dict,) = get_tests(self.server, 'runner1')
+        module, _, class_name = test_dict['class_path'].partition(' ')
+        results = [
+            {'method': {'module': 'fake', 'class': 'NotCheckedOut', 'name': 'test', 'full_name': 'fake NotCheckedOut.test'}, 'success': True},
+            {'method': {'module': module, 'class': class_name, 'name': 'test', 'full_name': '%s.test' % test_dict['class_path']}, 'success': True},
+        ]
+        errors = []
+        tornado.ioloop.IOLoop.instance().add_callback(lambda: errors.extend(self.server.report_results('runner1', results)))
+        while not errors:
+            time.sleep(0.01)
+        assert_equal([error['full_name'] for error in errors], ['fake NotCheckedOut.test'])
+        assert test_dict['class_path'] not in self.server.checked_out
+
+    def test_batch_respects_estimated_seconds(self):
+        self.queue_more_tests('fake Two', 'fake Three')
+        self.server.durations = {
+            ('test.test_runner_server_test DummyTestCase', 'test'): 1.0,
+            ('fake Two', 'test'): 5.0,
+            ('fake Three', 'test'): 10.0,
+        }
+        batch = get_tests(self.server, 'runner1', max_classes=3, max_seconds=10)
+        assert_equal([test_dict['class_path'] for test_dict in batch], ['test.test_runner_server_test DummyTestCase', 'fake Two'])
+        assert not self.server.test_queue.empty()
+
+
+class TestRunnerServerBinaryTransportTestCase(TestRunnerServerBaseTestCase):
+    def start_server(self):
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'testify.sock')
+        super(TestRunnerServerBinaryTransportTestCase, self).start_server(transport='binary', serve_socket=self.socket_path)
+        while self.server.test_queue.empty() or not os.path.exists(self.socket_path):
+            time.sleep(0.01)
+
+    @teardown
+    def remove_socket(self):
+        shutil.rmtree(os.path.dirname(self.socket_path))
+
+    def test_hands_out_tests_and_takes_results(self):
+        connection = binary_transport.ClientConnection(self.socket_path, 'runner1')
+        module = self.dummy_test_case.__module__
+        tests, finished, _ = connection.get_tests()
+        assert_equal(tests, [('%s DummyTestCase' % module, ['test'])])
+        assert not finished
+
+        results = [
+            {'method': {'module': 'fake', 'class': 'NotCheckedOut', 'name': 'test'}, 'success': True},
+            {'method': {'module': module, 'class': 'DummyTestCase', 'name': 'test'}, 'success': True},
+        ]
+        errors = connection.report_results(results)
+        assert_equal([error['full_name'] for error in errors], ['fake NotCheckedOut.test'])
+
+        # That was the only test, so the next request tells us we're done.
+        assert_equal(connection.get_tests(), ([], True, []))
+        connection.close()
+
+    def test_heartbeat(self):
+        connection = binary_transport.ClientConnection(self.socket_path, 'runner1')
+        tests, _, _ = connection.get_tests(slots=2)
+        assert_equal(self.server.runner_slots, {'runner1': 2})
+        connection.heartbeat([(tests[0][0], 'test', 0.5)])
+        assert_equal([running[:2] for running in self.server.running_methods['runner1'].values()], [(tests[0][0], 'test')])
+        connection.heartbeat()
+        assert 'runner1' not in self.server.running_methods
+        assert 'runner1' in self.server.heartbeat_runners
+        connection.close()
+
+    def test_refuses_wrong_revision(self):
+        self.server.revision = 'abc123'
+        connection = binary_transport.ClientConnection(self.socket_path, 'runner1', revision='def456')
+        try:
+            connection.get_tests()
+        except binary_transport.Refused, e:
+            assert_equal(e.code, 409)
+        else:
+            assert_not_reached("Expected the server to refuse us")
+        # Leave the server with nothing checked out, so it shuts down promptly.
+        self.server.revision = None
+        tests, _, _ = binary_transport.ClientConnection(self.socket_path, 'runner1').get_tests()
+        assert_equal(len(tests), 1)
+
+
+class TestRunnerServerStreamingTestCase(TestRunnerServerBaseTestCase):
+    def build_test_case(self):
+        class TwoMethodTestCase(test_case.TestCase):
+            def test_a(self_):
+                pass
+            def test_b(self_):
+                pass
+
+        self.dummy_test_case = TwoMethodTestCase
+
+    def start_server(self):
+        self.reported = Queue.Queue()
+        reporter = turtle.Turtle(test_complete=self.reported.put, report=lambda: True)
+        super(TestRunnerServerStreamingTestCase, self).start_server(test_reporters=[reporter])
+
+    def result(self, test_dict, method, success, **kwargs):
+        module, _, class_name = test_dict['class_path'].partition(' ')
+        result = {
+            'method': {'module': module, 'class': class_name, 'name': method, 'full_name': '%s.%s' % (test_dict['class_path'], method), 'fixture_type': None},
+            'success': success,
+            'failure': not success,
+            'exception_info': None if success else ['Traceback...'],
+            'exception_info_pretty': None if success else ['Pretty traceback...'],
+        }
+        result.update(kwargs)
+        return result
+
+    def test_passed_results_are_reported_before_check_in(self):
+        test_dict = get_test(self.server, 'runner1')
+        self.server.report_result('runner1', self.result(test_dict, 'test_a', True))
+
+        reported = self.reported.get(timeout=1)
+        assert_equal(reported['method']['name'], 'test_a')
+        assert test_dict['class_path'] in self.server.checked_out
+
+        self.server.report_result('runner1', self.result(test_dict, 'test_b', True))
+        assert_equal(self.reported.get(timeout=1)['method']['name'], 'test_b')
+
+    def test_failures_wait_for_their_rerun(self):
+        test_dict = get_test(self.server, 'runner1')
+        self.server.report_result('runner1', self.result(test_dict, 'test_a', False))
+        self.server.report_result('runner1', self.result(test_dict, 'test_b', True))
+        assert_equal(self.reported.get(timeout=1)['method']['name'], 'test_b')
+
+        rerun = get_test(self.server, 'runner2')
+        assert_equal(rerun['methods'], ['test_a'])
+        self.server.report_result('runner2', self.result(rerun, 'test_a', True))
+
+        reported = self.reported.get(timeout=1)
+        assert_equal(reported['method']['name'], 'test_a')
+        # We only kept a summary of the failure.
+        assert_equal(reported['previous_run']['exception_info'], ['Traceback...'])
+        assert 'exception_info_pretty' not in reported['previous_run']
+        assert self.reported.empty()
+
+
+class TestRunnerServerStatusTestCase(TestRunnerServerStreamingTestCase):
+    def test_status(self):
+        test_dict = get_test(self.server, 'runner1')
+        self.server.report_result('runner1', self.result(test_dict, 'test_a', True, run_time=2.0))
+
+        status = self.server.status()
+        assert_equal(status['queue'], {'tests': 0, 'waiting_runners': 0})
+        assert_equal([(test['key'], test['runner'], test['methods']) for test in status['checked_out']], [(test_dict['class_path'], 'runner1', 1)])
+        assert_equal(status['results']['total'], 1)
+        assert_equal(status['runners']['runner1']['results'], 1)
+        assert_equal(status['runners']['runner1']['idle_seconds'], 0.0)
+        # test_b should take as long as test_a did, less the time runner1 has had it.
+        assert 1.0 < status['eta_seconds'] <= 2.0, status['eta_seconds']
+
+        self.server.report_result('runner1', self.result(test_dict, 'test_b', False, run_time=2.0))
+        status = self.server.status()
+        assert_equal(status['queue']['tests'], 1)
+        assert_equal(status['checked_out'], [])
+        assert_equal(status['reruns'], {'failed': 1, 'timeout': 0})
+        assert_equal(status['results']['failures'], 1)
+        assert_equal(status['runners']['runner1']['checked_out'], 0)
+        assert_equal(status['runners']['runner1']['warm_modules'], 1)
+        assert_equal(status['eta_seconds'], 2.0)
+
+
+class TestRunnerServerHeartbeatTestCase(TestRunnerServerBaseTestCase):
+    def start_server(self):
+        super(TestRunnerServerHeartbeatTestCase, self).start_server(heartbeat_timeout=0.3, hang_factor=10)
+
+    def test_silent_runner_is_requeued_after_heartbeat_timeout(self):
+        test_dict = get_test(self.server, 'runner1')
+        self.server.heartbeat('runner1')
+        start = time.time()
+
+        requeued = get_test(self.server, 'runner2')
+        assert_equal(requeued['class_path'], test_dict['class_path'])
+        # Well before runner_timeout (1s).
+        assert time.time() - start < 0.8, time.time() - start
+
+    def test_heartbeats_keep_a_slow_test_checked_out(self):
+        test_dict = get_test(self.server, 'runner1')
+        self.server.durations = {(test_dict['class_path'], 'test'): 1.0}
+        start = time.time()
+        while time.time() - start < 1.5:
+            self.server.heartbeat('runner1', [(test_dict['class_path'], 'test', time.time() - start)])
+            time.sleep(0.1)
+        assert test_dict['class_path'] in self.server.checked_out
+        assert_equal(self.server.status()['runners']['runner1']['running'], '%s.test' % test_dict['class_path'])
+
+    def test_hung_method_is_requeued(self):
+        test_dict = get_test(self.server, 'runner1')
+        self.server.durations = {(test_dict['class_path'], 'test'): 0.01}
+        # It usually takes 0.01s, so 0.3s (heartbeat_timeout) is as long as we'll allow it.
+        self.server.heartbeat('runner1', [(test_dict['class_path'], 'test', 0.5)])
+
+        requeued = get_test(self.server, 'runner2')
+        assert_equal(requeued['class_path'], test_dict['class_path'])
+        assert_equal(self.server.timeout_rerun_methods, set([(test_dict['class_path'], 'test')]))
+        assert 'runner1' not in self.server.running_methods
+
+
+class TestRunnerServerSlotsTestCase(TestRunnerServerBaseTestCase):
+    def start_server(self):
+        super(TestRunnerServerSlotsTestCase, self).start_server(heartbeat_timeout=0.3, hang_factor=10)
+
+    def check_out_two(self):
+        """Have runner1, with two slots, check out the test case the server discovered and 'fake Two'."""
+        while self.server.test_queue.empty():
+            time.sleep(0.01)
+        self.server.test_queue.put(1, {'class_path': 'fake Two', 'methods': ['test'], 'last_runner': None})
+        responses = Queue.Queue()
+        self.server.request_tests('runner1', lambda tests, finished, upcoming: responses.put(tests), max_classes=2, slots=2)
+        return [class_path for class_path, _ in responses.get(timeout=1)]
+
+    def test_hung_slot_only_times_out_its_own_test_case(self):
+        hung, other = self.check_out_two()
+        self.server.durations = {(hung, 'test'): 0.01}
+        self.server.heartbeat('runner1', [(hung, 'test', 0.5), (other, 'test', 0.0)])
+
+        requeued = get_test(self.server, 'runner2')
+        assert_equal(requeued['class_path'], hung)
+        # The other slot is still running its test, which may well finish.
+        assert_equal(self.server.checked_out[other]['runner'], 'runner1')
+        assert_equal(self.server.running_methods['runner1'].keys(), [other])
+
+    def test_slots_run_at_once(self):
+        first, second = self.check_out_two()
+        self.server.durations = {(first, 'test'): 2.0, (second, 'test'): 2.0}
+        status = self.server.status()
+        assert_equal(status['runners']['runner1']['slots'], 2)
+        assert_equal(status['runners']['runner1']['checked_out'], 2)
+        # Not 4s, since runner1 runs both at the same time.
+        assert 1.5 < status['eta_seconds'] <= 2.0, status['eta_seconds']
+
+
+class TestRunnerServerResumeTestCase(TestRunnerServerBaseTestCase):
+    discovered = True
+
+    def start_server(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.tempdir, 'journal')
+        journal = server_journal.ServerJournal(self.journal_path)
+        journal.queue(0, {'class_path': 'fake Half', 'methods': ['test_a', 'test_b']})
+        journal.checkout('runner1', 'fake Half')
+        journal.reported({'method': {'module': 'fake', 'class': 'Half', 'name': 'test_a'}, 'success': True})
+        if self.discovered:
+            journal.discovered()
+        journal.close()
+
+        self.reported = Queue.Queue()
+        reporter = turtle.Turtle(test_complete=self.reported.put, report=lambda: True)
+        super(TestRunnerServerResumeTestCase, self).start_server(test_reporters=[reporter], resume=self.journal_path)
+
+    @teardown
+    def remove_journal(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_resumes_unfinished_tests(self):
+        assert_equal(self.reported.get(timeout=1)['method']['name'], 'test_a')
+
+        test_dict = get_test(self.server, 'runner2')
+        assert_equal((test_dict['class_path'], test_dict['methods']), ('fake Half', ['test_b']))
+
+        self.server.report_result('runner2', {'method': {'module': 'fake', 'class': 'Half', 'name': 'test_b'}, 'success': True})
+        assert_equal(self.reported.get(timeout=1)['method']['name'], 'test_b')
+
+        # We kept journaling where we left off.
+        state = server_journal.load(self.journal_path)
+        assert_equal(len(state.reported_results), 2)
+        assert_equal(state.tests_to_queue(), [])
+
+
+class TestRunnerServerResumeUnfinishedDiscoveryTestCase(TestRunnerServerResumeTestCase):
+    discovered = False
+
+    def test_resumes_unfinished_tests(self):
+        # The run died before it had discovered DummyTestCase, so we discover it, after what was left of fake Half.
+        assert_equal(get_test(self.server, 'runner2')['class_path'], 'fake Half')
+        assert_equal(get_test(self.server, 'runner3')['class_path'], 'test.test_runner_server_test DummyTestCase')
+        start = time.time()
+        while not server_journal.load(self.journal_path).discovered:
+            assert time.time() - start < 1, "Timed out waiting for discovery to finish."
+            time.sleep(0.01)
+
+
+class StreamingDiscoveryServer(test_runner_server.TestRunnerServer):
+    """Discovers whatever test cases are put on self.discovered, until None is."""
+    def __init__(self, *args, **kwargs):
+        self.discovered = Queue.Queue()
+        super(StreamingDiscoveryServer, self).__init__(*args, **kwargs)
+
+    def discover_test_methods(self):
+        for test in iter(self.discovered.get, None):
+            yield test
+
+
+class TestRunnerServerStreamingDiscoveryTestCase(TestRunnerServerBaseTestCase):
+    server_class = StreamingDiscoveryServer
+
+    def result(self, class_path):
+        module, _, class_name = class_path.partition(' ')
+        return {'method': {'module': module, 'class': class_name, 'name': 'test', 'full_name': '%s.test' % class_path}, 'success': True}
+
+    def test_hands_out_tests_while_discovering(self):
+        self.server.discovered.put(('fake First', ['test']))
+        assert_equal(get_test(self.server, 'runner1')['class_path'], 'fake First')
+        assert self.server.status()['discovering']
+
+        # Running out of tests isn't the end of the run while there may be more to come.
+        self.server.report_result('runner1', self.result('fake First'))
+        assert not self.server.shutting_down
+
+        self.server.discovered.put(('fake Second', ['test']))
+        self.server.discovered.put(None)
+        assert_equal(get_test(self.server, 'runner1')['class_path'], 'fake Second')
+        self.server.report_result('runner1', self.result('fake Second'))
+        assert_equal(get_test(self.server, 'runner1'), None)
+
+
+class TestRunnerServerSplitClassTestCase(TestRunnerServerBaseTestCase):
+    def build_test_case(self):
+        class SplitTestCase(test_case.TestCase):
+            def test_a(self_):
+                pass
+            def test_b(self_):
+                pass
+
+        self.dummy_test_case = SplitTestCase
+
+    def start_server(self):
+        super(TestRunnerServerSplitClassTestCase, self).start_server(split_classes=['SplitTestCase'])
+
+    def test_chunks_run_concurrently(self):
+        first_chunk = get_test(self.server, 'runner1')
+        second_chunk = get_test(self.server, 'runner2')
+        assert_equal(first_chunk['class_path'], second_chunk['class_path'])
+        assert_equal(sorted(first_chunk['methods'] + second_chunk['methods']), ['test_a', 'test_b'])
+        assert_equal(sorted(self.server.checked_out), sorted([first_chunk['chunk'], second_chunk['chunk']]))
+
+        # A result only checks in the chunk its method belongs to.
+        module, _, class_name = second_chunk['class_path'].partition(' ')
+        result = {'method': {'module': module, 'class': class_name, 'name': second_chunk['methods'][0]}, 'success': True}
+        tornado.ioloop.IOLoop.instance().add_callback(lambda: self.server.report_result('runner2', result))
+        while second_chunk['chunk'] in self.server.checked_out:
+            time.sleep(0.01)
+        assert_equal(self.server.checked_out.keys(), [first_chunk['chunk']])
+
+        # A chunk that times out is requeued as the same chunk.
+        tornado.ioloop.IOLoop.instance().add_callback(lambda: self.server.check_in_class('runner1', first_chunk['chunk'], timed_out=True))
+        requeued_chunk = get_test(self.server, 'runner3')
+        assert_equal(requeued_chunk['chunk'], first_chunk['chunk'])
+        assert_equal(requeued_chunk['methods'], first_chunk['methods'])
+
+
+class ChunkMethodsTestCase(test_case.TestCase):
+    def test_one_method_per_chunk_without_a_target(self):
+        assert_equal(test_runner_server.chunk_methods(['a', 'b'], {}), [['a'], ['b']])
+
+    def test_chunks_by_run_time(self):
+        run_times = {'a': 6.0, 'b': 3.0, 'c': 3.0, 'd': 9.0}
+        # 'e' has no history, so it's assumed to take the average, 5.25s.
+        assert_equal(test_runner_server.chunk_methods(['a', 'b', 'c', 'd', 'e'], run_times, 10.0), [['a', 'b'], ['c'], ['d'], ['e']])
+
+
+class AsyncDelayedQueueTestCase(test_case.TestCase):
+    """Drive the scheduler's match passes by hand, without an IOLoop running."""
+
+    @setup
+    def build_queue(self):
+        self.queue = test_runner_server.AsyncDelayedQueue()
+        self.received = []
+
+    def callback(self, name):
+        return lambda priority, data: self.received.append((name, data and data['class_path']))
+
+    def test_best_test_goes_to_best_callback(self):
+        self.queue.put(2, {'last_runner': None, 'class_path': 'late'})
+        self.queue.put(1, {'last_runner': None, 'class_path': 'early'})
+        self.queue.get(5, self.callback('second'))
+        self.queue.get(0, self.callback('first'))
+        self.queue.match()
+        assert_equal(self.received, [('first', 'early'), ('second', 'late')])
+        assert self.queue.empty()
+        assert self.queue.waiting()
+
+    def test_runners_skip_their_own_tests(self):
+        self.queue.put(0, {'last_runner': 'foo', 'class_path': 'foo_failed'})
+        self.queue.put(1, {'last_runner': 'bar', 'class_path': 'bar_failed'})
+        self.queue.get(0, self.callback('foo'), runner='foo')
+        self.queue.match()
+        assert_equal(self.received, [('foo', 'bar_failed')])
+
+        # Nothing left that foo may run; it waits for someone else's test.
+        self.queue.get(0, self.callback('foo'), runner='foo')
+        self.queue.match()
+        assert not self.queue.waiting()
+        self.queue.get(1, self.callback('bar'), runner='bar')
+        self.queue.match()
+        assert_equal(self.received[1:], [('bar', 'foo_failed')])
+        assert self.queue.empty()
+
+    def test_many_tests_one_excluded_runner(self):
+        """A runner shouldn't have to wade through everything it last ran to get at what it may run."""
+        for i in xrange(10000):
+            self.queue.put(0, {'last_runner': 'foo', 'class_path': str(i)})
+        self.queue.put(1, {'last_runner': 'bar', 'class_path': 'other'})
+        for _ in xrange(100):
+            self.queue.get(0, self.callback('foo'), runner='foo')
+        self.queue.match()
+        assert_equal(self.received, [('foo', 'other')])
+
+    def test_prefers_warm_modules(self):
+        self.queue.put(0, {'last_runner': None, 'class_path': 'cold First'})
+        self.queue.put(1, {'last_runner': None, 'class_path': 'warm Second'})
+        self.queue.put(2, {'last_runner': None, 'class_path': 'warm Third'})
+        self.queue.mark_warm('runner1', 'warm')
+        self.queue.get(0, self.callback('runner1'), prefer_runner='runner1')
+        self.queue.get(1, self.callback('runner2'), prefer_runner='runner2')
+        self.queue.match()
+        assert_equal(self.received, [('runner1', 'warm Second'), ('runner2', 'cold First')])
+        assert_equal(self.queue.test_count, 1)
+        assert_equal([data['class_path'] for data in self.queue.items()], ['warm Third'])
+        assert_equal(self.queue.take(prefer_runner='runner1')[1]['class_path'], 'warm Third')
+        assert self.queue.empty()
+
+    def test_prefers_warm_modules_queued_after_warming(self):
+        self.queue.mark_warm('runner1', 'warm')
+        for i in xrange(1000):
+            self.queue.put(0, {'last_runner': None, 'class_path': 'cold%d Test' % i})
+            self.queue.mark_warm('runner2', 'cold%d' % i)
+        self.queue.put(1, {'last_runner': None, 'class_path': 'warm Test'})
+        self.queue.put(2, {'last_runner': None, 'class_path': 'unclaimed Test'})
+        assert_equal(self.queue.take(prefer_runner='runner1')[1]['class_path'], 'warm Test')
+        assert_equal(self.queue.take(prefer_runner='runner3')[1]['class_path'], 'unclaimed Test')
+
+    def test_new_runners_spread_across_modules(self):
+        for module in ('first', 'second'):
+            for i in xrange(2):
+                self.queue.put(0, {'last_runner': None, 'class_path': '%s Test%d' % (module, i)})
+        for runner in ('runner1', 'runner2', 'runner1', 'runner2'):
+            self.queue.get(0, self.callback(runner), prefer_runner=runner)
+        self.queue.match()
+        assert_equal(sorted(self.received), [
+            ('runner1', 'first Test0'),
+            ('runner1', 'first Test1'),
+            ('runner2', 'second Test0'),
+            ('runner2', 'second Test1'),
+        ])
+
+    def test_upcoming_tests_are_from_new_modules(self):
+        for class_path in ('first Test0', 'first Test1', 'second Test0', 'third Test0'):
+            self.queue.put(0, {'last_runner': None, 'class_path': class_path})
+        self.queue.take(prefer_runner='runner1')
+        assert_equal(self.queue.upcoming('runner1', 2), ['second Test0', 'third Test0'])
+        assert_equal(self.queue.upcoming('runner1', 1), ['second Test0'])
+        self.queue.take(prefer_runner='runner2')
+        self.queue.take(prefer_runner='runner3')
+        # Once every module has been claimed, the best test there is is still a good bet, unless we have its module.
+        assert_equal(self.queue.upcoming('runner2', 2), ['first Test1'])
+        assert_equal(self.queue.upcoming('runner1', 2), [])
+
+    def test_cold_tests_arent_passed_over_forever(self):
+        self.queue = test_runner_server.AsyncDelayedQueue(max_affinity_skips=2)
+        self.queue.put(0, {'last_runner': None, 'class_path': 'cold First'})
+        for i in xrange(3):
+            self.queue.put(i + 1, {'last_runner': None, 'class_path': 'warm Test%d' % i})
+        self.queue.mark_warm('runner1', 'warm')
+        taken = [self.queue.take(prefer_runner='runner1')[1]['class_path'] for _ in xrange(4)]
+        assert_equal(taken, ['warm Test0', 'warm Test1', 'cold First', 'warm Test2'])
+
+    def test_reruns_go_first_regardless(self):
+        self.queue.put(0, {'last_runner': None, 'class_path': 'warm First'})
+        self.queue.put(-1, {'last_runner': 'runner2', 'class_path': 'cold Failed'})
+        self.queue.mark_warm('runner1', 'warm')
+        assert_equal(self.queue.take('runner1', prefer_runner='runner1')[1]['class_path'], 'cold Failed')
+
+    def test_finalize(self):
+        self.queue.get(0, self.callback('waiting'))
+        self.queue.finalize()
+        self.queue.get(0, self.callback('late'))
+        assert_equal(self.received, [('waiting', None), ('late', None)])
+
 # vim: set ts=4 sts=4 sw=4 et:
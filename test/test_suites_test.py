@@ -45,4 +45,22 @@ class TestSuitesTest(TestCase):
         sub_instance = SubTestCase()
 
         assert_equal(super_instance.test_thing._suites, set(['super']))
-        assert_equal(sub_instance.test_thing._suites, set(['sub']))
\ No newline at end of file
+        assert_equal(sub_instance.test_thing._suites, set(['sub']))
+
+    def test_method_names_without_an_instance(self):
+        """Check that the class picks out the same methods as its instances would, without constructing one."""
+        class SuitedTestCase(TestCase):
+            _suites = ['class']
+            @suite('odd')
+            def test_one(self):
+                pass
+            def test_two(self):
+                pass
+            @suite('odd')
+            def test_three(self):
+                pass
+
+        assert_equal(SuitedTestCase.runnable_test_method_names(), ['test_one', 'test_three', 'test_two'])
+        assert_equal(SuitedTestCase.runnable_test_method_names(suites_exclude=['odd']), ['test_two'])
+        assert_equal(SuitedTestCase.runnable_test_method_names(suites_require=['odd', 'class'], name_overrides=set(['test_one'])), ['test_one'])
+        assert not SuitedTestCase.overrides_init()
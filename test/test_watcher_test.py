@@ -0,0 +1,72 @@
+from __future__ import with_statement
+
+import os
+import sys
+import tempfile
+import time
+
+from testify import assert_equal, run, setup_teardown, test_case
+from testify.test_watcher import TestWatcher
+from testify.utils import turtle
+
+
+class TestWatcherTestCase(test_case.TestCase):
+    @setup_teardown
+    def make_modules(self):
+        self.here = os.path.dirname(os.path.abspath(__file__))
+        self.paths = []
+        self.source_module = self.make_module('watched_source', 'def value():\n    return 1\n')
+        self.test_module = self.make_module('watched_test', 'from test.%s import value\n' % self.source_module.split('.')[-1])
+        self.other_test_module = self.make_module('watched_other_test', 'other = 1\n')
+        for module_name in (self.source_module, self.test_module, self.other_test_module):
+            __import__(module_name)
+
+        self.runs = []
+        self.watcher = TestWatcher('test', self.make_runner)
+        self.watcher.module_tracker.snapshot()
+
+        yield
+
+        for module_name in (self.source_module, self.test_module, self.other_test_module):
+            sys.modules.pop(module_name, None)
+        for path in self.paths:
+            for leftover in (path, path + 'c'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def make_runner(self, test_path):
+        self.runs.append(test_path)
+        return turtle.Turtle()
+
+    def make_module(self, prefix, contents):
+        fd, path = tempfile.mkstemp(prefix=prefix, suffix='.py', dir=self.here)
+        os.close(fd)
+        self.write(path, contents)
+        self.paths.append(path)
+        return 'test.%s' % os.path.splitext(os.path.basename(path))[0]
+
+    def write(self, path, contents):
+        with open(path, 'w') as module_file:
+            module_file.write(contents)
+        os.utime(path, (time.time() + 2, time.time() + 2))
+
+    def test_change_reruns_dependent_test_modules(self):
+        source_path = self.paths[0]
+        self.write(source_path, 'def value():\n    return 2\n')
+
+        assert_equal(self.watcher.affected_test_modules([source_path]), sorted([self.source_module, self.test_module]))
+        assert_equal(sys.modules[self.test_module].value(), 2)
+
+    def test_new_test_module_is_run(self):
+        new_path = os.path.join(self.here, 'not_yet_imported_test.py')
+        assert_equal(self.watcher.affected_test_modules([new_path]), ['test.not_yet_imported_test'])
+
+    def test_run_once(self):
+        self.watcher.run_once(['test.foo'])
+        assert_equal(self.runs, [['test.foo']])
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+from testify import assert_equal, run, test_case
+
+import testify
+
+
+class ImportTestifyTestCase(test_case.TestCase):
+    def test_import_is_lazy(self):
+        """A plain `import testify` shouldn't drag in the test runner, IPython or subprocess."""
+        root = os.path.dirname(os.path.dirname(os.path.abspath(testify.__file__)))
+        output = subprocess.Popen(
+            [sys.executable, '-c', 'import sys, testify; print " ".join(sorted(sys.modules))'],
+            stdout=subprocess.PIPE,
+            cwd=root,
+        ).communicate()[0]
+        imported = set(output.split())
+        assert 'testify' in imported
+        assert_equal(imported & set(['testify.test_program', 'optparse', 'IPython', 'subprocess', 'socket']), set())
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,86 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import urllib2
+
+from testify import assert_equal, assert_not_reached, assert_raises, run, setup_teardown, test_case
+from testify.utils.connection_pool import ConnectionPool
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ConnectionPoolTestCase(test_case.TestCase):
+    @setup_teardown
+    def make_server(self):
+        self.connections = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(handler):
+                self.connections.append(handler)
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(handler)
+
+            def do_GET(handler):
+                if handler.path == '/missing':
+                    body = 'no such thing'
+                    handler.send_response(404)
+                else:
+                    body = 'ok %s' % handler.path
+                    handler.send_response(200)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+                if handler.path == '/hang-up':
+                    # Drop the connection without telling the client, as a server restarting would.
+                    handler.close_connection = True
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('localhost', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        self.pool = ConnectionPool('localhost:%d' % self.server.server_address[1])
+
+        yield
+
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuses_connection(self):
+        for i in xrange(5):
+            assert_equal(self.pool.request('GET', '/%d' % i), 'ok /%d' % i)
+        assert_equal(len(self.connections), 1)
+
+    def test_error_status_raises_http_error(self):
+        try:
+            self.pool.request('GET', '/missing')
+        except urllib2.HTTPError, e:
+            assert_equal(e.code, 404)
+            assert_equal(e.read(), 'no such thing')
+        else:
+            assert_not_reached("Expected an HTTPError")
+        # The connection is still good for the next request.
+        assert_equal(self.pool.request('GET', '/after'), 'ok /after')
+        assert_equal(len(self.connections), 1)
+
+    def test_reconnects_when_server_hangs_up(self):
+        assert_equal(self.pool.request('GET', '/hang-up'), 'ok /hang-up')
+        assert_equal(self.pool.request('GET', '/again'), 'ok /again')
+        assert_equal(len(self.connections), 2)
+
+    def test_unreachable_server_raises_url_error(self):
+        self.server.server_close()
+        pool = ConnectionPool('localhost:%d' % self.server.server_address[1])
+        assert_raises(urllib2.URLError, pool.request, 'GET', '/')
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
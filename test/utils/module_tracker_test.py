@@ -0,0 +1,54 @@
+from __future__ import with_statement
+
+import os
+import sys
+import tempfile
+import time
+
+from testify import assert_equal, run, setup_teardown, TestCase
+from testify.utils.module_tracker import ModuleTracker
+
+
+class ModuleTrackerTestCase(TestCase):
+    @setup_teardown
+    def make_module(self):
+        here = os.path.dirname(os.path.abspath(__file__))
+        fd, self.module_path = tempfile.mkstemp(prefix='tracked_module', suffix='.py', dir=here)
+        os.close(fd)
+        self.write_module('value = 1\n')
+        self.module_name = 'test.utils.%s' % os.path.splitext(os.path.basename(self.module_path))[0]
+        __import__(self.module_name)
+        self.module = sys.modules[self.module_name]
+
+        yield
+
+        del sys.modules[self.module_name]
+        for path in (self.module_path, self.module_path + 'c'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def write_module(self, contents):
+        with open(self.module_path, 'w') as module_file:
+            module_file.write(contents)
+
+    def test_reload_changed(self):
+        tracker = ModuleTracker()
+        tracker.snapshot()
+        assert_equal(tracker.changed_modules(), [])
+
+        self.write_module('value = 2\n')
+        # Make sure the mtime moves even on filesystems with coarse timestamps.
+        os.utime(self.module_path, (time.time() + 2, time.time() + 2))
+        assert_equal(tracker.changed_modules(), [self.module_name])
+
+        reloaded, failed = tracker.reload_changed()
+        assert_equal(reloaded, [self.module_name])
+        assert_equal(failed, [])
+        assert_equal(self.module.value, 2)
+        assert_equal(tracker.changed_modules(), [])
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,46 @@
+from testify import assert_equal, run, test_case
+from testify.utils.timer_wheel import TimerWheel
+
+
+class TimerWheelTestCase(test_case.TestCase):
+    def test_fires_in_order_once_due(self):
+        wheel = TimerWheel(1.0)
+        wheel.advance(100.0)
+        wheel.schedule(103.5, 'c')
+        wheel.schedule(101.2, 'a')
+        wheel.schedule(101.7, 'b')
+
+        assert_equal(wheel.advance(101.9), [])
+        assert_equal(wheel.advance(102.0), ['a', 'b'])
+        assert_equal(wheel.advance(102.5), [])
+        assert_equal(wheel.advance(110.0), ['c'])
+        assert_equal(len(wheel), 0)
+
+    def test_later_trips_around_the_wheel_wait(self):
+        wheel = TimerWheel(1.0, slot_count=4)
+        wheel.advance(0.0)
+        wheel.schedule(1.5, 'soon')
+        wheel.schedule(5.5, 'next time around')
+
+        assert_equal(wheel.advance(2.0), ['soon'])
+        assert_equal(wheel.advance(5.0), [])
+        assert_equal(wheel.advance(6.0), ['next time around'])
+
+    def test_overdue_timers_fire_on_the_next_advance(self):
+        wheel = TimerWheel(1.0)
+        wheel.advance(50.0)
+        wheel.schedule(10.0, 'late')
+        assert_equal(wheel.advance(50.5), [])
+        assert_equal(wheel.advance(51.0), ['late'])
+
+    def test_long_gaps_look_at_every_slot(self):
+        wheel = TimerWheel(1.0, slot_count=4)
+        wheel.schedule(2.5, 'a')
+        wheel.schedule(7.5, 'b')
+        assert_equal(wheel.advance(100.0), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    run()
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -47,5 +47,7 @@ from test_case import (
 
 from utils import turtle
 
-import test_program
-run = lambda: test_program.TestProgram(["__main__"] + sys.argv[1:])
+def run():
+    # test_program pulls in optparse and the rest of the runner, which a plain `import testify` doesn't need.
+    from testify import test_program
+    test_program.TestProgram(["__main__"] + sys.argv[1:])
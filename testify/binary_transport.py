@@ -0,0 +1,430 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A compact binary alternative to JSON over HTTP between --serve and --connect (--transport binary).
+
+Each connection is a session that starts with a HELLO giving the runner id and
+revision; after that, every message is a request frame answered by one reply
+frame. A frame is a 4-byte big-endian length, then a one-byte message type,
+then the message body in a small tagged encoding (see Encoder).
+
+Module, class and method names are interned per session: the first time a
+name is sent it goes over the wire in full, and after that as the id both ends
+assigned it. Each direction of a session has its own table, and reconnecting
+starts a new session with empty tables.
+
+    HELLO    [runner_id, revision]              -> OK [] or ERROR [status, reason]
+    TESTS    [max_classes, max_seconds, lookahead, slots] -> TESTS_REPLY [finished, [[class_path, [method, ...]], ...], [class_path, ...]]
+    RESULTS  [result, ...]                      -> RESULTS_REPLY [[full_name, error], ...]
+    HEARTBEAT [[class_path, method, elapsed], ...] -> OK []
+    RELEASE  [class_path, [method, ...], reason] -> OK []
+
+Statuses in ERROR replies are the HTTP status the HTTP transport would have
+used, so clients treat refusals the same way whichever transport they use.
+"""
+from __future__ import with_statement
+
+import socket
+import struct
+import threading
+
+import tornado.netutil
+
+HELLO = 'H'
+OK = 'O'
+ERROR = 'E'
+TESTS = 'G'
+TESTS_REPLY = 'T'
+RESULTS = 'R'
+RESULTS_REPLY = 'A'
+HEARTBEAT = 'B'
+RELEASE = 'L'
+
+HEADER = struct.Struct('>I')
+# Anything bigger than this is a corrupt frame (or something that isn't testify talking), not a batch of results.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# The fields of a result dict we send positionally; anything else goes along in a dict at the end.
+RESULT_FIELDS = (
+    'start_time', 'end_time', 'run_time', 'normalized_run_time', 'complete', 'success', 'failure', 'error',
+    'interrupted', 'exception_info', 'exception_info_pretty', 'runner_id',
+)
+
+
+class TransportError(Exception):
+    """We lost (or never had) a connection to the server, or it sent us something we can't read."""
+
+
+class Refused(Exception):
+    """The server refused a request; status is the HTTP status the HTTP transport would have used."""
+
+    def __init__(self, status, reason):
+        super(Refused, self).__init__(status, reason)
+        self.code = status
+        self.reason = reason
+
+    def __str__(self):
+        return '%d: %s' % (self.code, self.reason)
+
+
+class Name(str):
+    """A string the Encoder should intern, like a module, class or method name."""
+
+
+class Encoder(object):
+    """Encodes None, bools, ints, floats, strs, unicode, lists, tuples, dicts and Names, one end of a session."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def dumps(self, value):
+        chunks = []
+        self._encode(value, chunks)
+        return ''.join(chunks)
+
+    def _encode(self, value, chunks):
+        # Name before str, bool before int: they're subclasses.
+        if value is None:
+            chunks.append('N')
+        elif isinstance(value, Name):
+            if value in self.ids:
+                chunks.append('#' + HEADER.pack(self.ids[value]))
+            else:
+                self.ids[value] = len(self.ids)
+                chunks.append('+' + HEADER.pack(len(value)) + value)
+        elif isinstance(value, bool):
+            chunks.append('T' if value else 'F')
+        elif isinstance(value, (int, long)):
+            chunks.append('i' + struct.pack('>q', value))
+        elif isinstance(value, float):
+            chunks.append('d' + struct.pack('>d', value))
+        elif isinstance(value, str):
+            chunks.append('s' + HEADER.pack(len(value)) + value)
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+            chunks.append('u' + HEADER.pack(len(value)) + value)
+        elif isinstance(value, (list, tuple)):
+            chunks.append('l' + HEADER.pack(len(value)))
+            for item in value:
+                self._encode(item, chunks)
+        elif isinstance(value, dict):
+            chunks.append('m' + HEADER.pack(len(value)))
+            for key, item in value.iteritems():
+                self._encode(key, chunks)
+                self._encode(item, chunks)
+        else:
+            raise TypeError("Can't encode %r" % (value,))
+
+
+class Decoder(object):
+    """Decodes what the Encoder at the other end of the session sent; Names come back as plain strs."""
+
+    def __init__(self):
+        self.names = []
+
+    def loads(self, data):
+        try:
+            value, offset = self._decode(data, 0)
+        except (struct.error, IndexError, KeyError, ValueError, TypeError), e:
+            raise TransportError("Couldn't decode message: %r" % e)
+        if offset != len(data):
+            raise TransportError("%d bytes left over after decoding message" % (len(data) - offset))
+        return value
+
+    def _read_string(self, data, offset):
+        (length,) = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        if offset + length > len(data):
+            raise IndexError("string runs past the end of the message")
+        return data[offset:offset + length], offset + length
+
+    def _decode(self, data, offset):
+        tag = data[offset]
+        offset += 1
+        if tag == 'N':
+            return None, offset
+        elif tag == 'T':
+            return True, offset
+        elif tag == 'F':
+            return False, offset
+        elif tag == 'i':
+            return struct.unpack_from('>q', data, offset)[0], offset + 8
+        elif tag == 'd':
+            return struct.unpack_from('>d', data, offset)[0], offset + 8
+        elif tag == 's':
+            return self._read_string(data, offset)
+        elif tag == 'u':
+            value, offset = self._read_string(data, offset)
+            return value.decode('utf-8'), offset
+        elif tag == '#':
+            (name_id,) = HEADER.unpack_from(data, offset)
+            return self.names[name_id], offset + HEADER.size
+        elif tag == '+':
+            value, offset = self._read_string(data, offset)
+            self.names.append(value)
+            return value, offset
+        elif tag == 'l':
+            (count,) = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            items = []
+            for _ in xrange(count):
+                item, offset = self._decode(data, offset)
+                items.append(item)
+            return items, offset
+        elif tag == 'm':
+            (count,) = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            items = {}
+            for _ in xrange(count):
+                key, offset = self._decode(data, offset)
+                items[key], offset = self._decode(data, offset)
+            return items, offset
+        raise KeyError("unknown tag %r" % tag)
+
+
+def pack_frame(message_type, body):
+    return HEADER.pack(len(body) + 1) + message_type + body
+
+
+def encode_result(result):
+    """Turn a result dict (see TestResult.to_dict) into a list, interning its method's names."""
+    method = result['method']
+    encoded = [
+        [Name(method['module']), Name(method['class']), Name(method['name']), method.get('fixture_type')],
+        encode_result(result['previous_run']) if result.get('previous_run') else None,
+    ]
+    encoded.extend(result.get(field) for field in RESULT_FIELDS)
+    extra = dict((key, value) for key, value in result.iteritems() if key not in RESULT_FIELDS and key not in ('method', 'previous_run'))
+    encoded.append(extra)
+    return encoded
+
+
+def decode_result(encoded):
+    (module, class_name, name, fixture_type), previous_run = encoded[:2]
+    result = dict(zip(RESULT_FIELDS, encoded[2:2 + len(RESULT_FIELDS)]))
+    result.update(encoded[2 + len(RESULT_FIELDS)])
+    result['previous_run'] = decode_result(previous_run) if previous_run else None
+    result['method'] = {
+        'module': module,
+        'class': class_name,
+        'name': name,
+        'full_name': '%s %s.%s' % (module, class_name, name),
+        'fixture_type': fixture_type,
+    }
+    return result
+
+
+def parse_addr(addr):
+    """Return the socket family and address to connect to for HOST:PORT, or a unix socket path (anything with a /)."""
+    if '/' in addr:
+        return socket.AF_UNIX, addr
+    host, _, port = addr.rpartition(':')
+    return socket.AF_INET, (host or 'localhost', int(port))
+
+
+class ClientConnection(object):
+    """A session with the server, as runner_id, over a blocking socket. Safe to share between threads.
+
+    Like ConnectionPool, if a request fails on a session we've used before (the server may have dropped it), we
+    retry it once on a new session before raising TransportError.
+    """
+
+    def __init__(self, addr, runner_id, revision=None, timeout=None):
+        self.addr = addr
+        self.runner_id = runner_id
+        self.revision = revision
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        family, address = parse_addr(self.addr)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect(address)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        try:
+            self._exchange(HELLO, [self.runner_id, self.revision], OK)
+        except Exception:
+            self.close()
+            raise
+
+    def _read_exactly(self, length):
+        chunks = []
+        while length:
+            chunk = self.sock.recv(min(length, 65536))
+            if not chunk:
+                raise TransportError("Server closed the connection")
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+    def _exchange(self, message_type, body, reply_type):
+        self.sock.sendall(pack_frame(message_type, self.encoder.dumps(body)))
+        (length,) = HEADER.unpack(self._read_exactly(HEADER.size))
+        if not 1 <= length <= MAX_FRAME_SIZE:
+            raise TransportError("Bad frame length %d" % length)
+        frame = self._read_exactly(length)
+        reply = self.decoder.loads(frame[1:])
+        if frame[0] == ERROR:
+            raise Refused(*reply)
+        if frame[0] != reply_type:
+            raise TransportError("Expected a %r reply, got %r" % (reply_type, frame[0]))
+        return reply
+
+    def request(self, message_type, body, reply_type):
+        with self.lock:
+            reused = self.sock is not None
+            try:
+                try:
+                    if not reused:
+                        self._connect()
+                    return self._exchange(message_type, body, reply_type)
+                except (socket.error, TransportError):
+                    self.close()
+                    if not reused:
+                        raise
+                    self._connect()
+                    return self._exchange(message_type, body, reply_type)
+            except socket.error, e:
+                self.close()
+                raise TransportError(e)
+            except TransportError:
+                self.close()
+                raise
+
+    def get_tests(self, max_classes=1, max_seconds=None, lookahead=0, slots=1):
+        """Return (tests, finished, upcoming), where tests is a list of (class_path, methods), and upcoming up to
+        lookahead class paths we're likely to get later on. slots is how many test cases we run at a time."""
+        finished, tests, upcoming = self.request(TESTS, [max_classes, max_seconds, lookahead, slots], TESTS_REPLY)
+        return [(class_path, methods) for class_path, methods in tests], finished, upcoming
+
+    def report_results(self, results):
+        """Send a batch of result dicts, returning a list of {'full_name', 'error'} for the ones the server refused."""
+        errors = self.request(RESULTS, [encode_result(result) for result in results], RESULTS_REPLY)
+        return [{'full_name': full_name, 'error': error} for full_name, error in errors]
+
+    def heartbeat(self, running=()):
+        """Tell the server we're alive, and which methods we've been running for how many seconds, as a list of
+        (class_path, method, elapsed)."""
+        self.request(HEARTBEAT, [[Name(class_path), Name(method), elapsed] for class_path, method, elapsed in running], OK)
+
+    def release(self, class_path, methods, reason=None):
+        """Give up on running methods of class_path (see TestRunnerServer.release)."""
+        self.request(RELEASE, [Name(class_path), [Name(method) for method in methods], reason], OK)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class ServerSession(object):
+    """One client's session with a TestRunnerServer, on the server's IOLoop."""
+
+    def __init__(self, test_runner_server, stream):
+        self.server = test_runner_server
+        self.stream = stream
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.runner_id = None
+
+    def start(self):
+        self.read_frame()
+
+    def read_frame(self):
+        if not self.stream.closed():
+            self.stream.read_bytes(HEADER.size, self.on_header)
+
+    def on_header(self, data):
+        (length,) = HEADER.unpack(data)
+        if not 1 <= length <= MAX_FRAME_SIZE:
+            return self.stream.close()
+        self.stream.read_bytes(length, self.on_frame)
+
+    def reply(self, message_type, body, callback=None):
+        if self.stream.closed():
+            return
+        self.stream.write(pack_frame(message_type, self.encoder.dumps(body)), callback)
+        self.read_frame()
+
+    def refuse(self, status, reason):
+        self.reply(ERROR, [status, reason])
+
+    def hang_up(self, status, reason):
+        """Refuse a request and end the session, since we can no longer trust its name tables to match the client's."""
+        if not self.stream.closed():
+            self.stream.write(pack_frame(ERROR, self.encoder.dumps([status, reason])), self.stream.close)
+
+    def on_frame(self, frame):
+        try:
+            self.handle(frame[0], self.decoder.loads(frame[1:]))
+        except (TransportError, ValueError, TypeError, KeyError), e:
+            self.hang_up(400, "Couldn't read %r message: %s" % (frame[0], e))
+
+    def handle(self, message_type, body):
+        if message_type == HELLO:
+            runner_id, revision = body
+            if self.server.revision and self.server.revision != revision:
+                return self.refuse(409, "Incorrect revision %s -- server is running revision %s" % (revision, self.server.revision))
+            self.runner_id = runner_id
+            return self.reply(OK, [])
+
+        if self.runner_id is None:
+            return self.refuse(400, "Expected HELLO first")
+
+        if message_type == TESTS:
+            max_classes, max_seconds, lookahead, slots = body
+            def on_response(tests, finished, upcoming):
+                encoded = [[Name(class_path), [Name(method) for method in methods]] for class_path, methods in tests]
+                self.reply(TESTS_REPLY, [finished, encoded, [Name(class_path) for class_path in upcoming]], callback=self.server.stop_if_idle)
+            self.server.request_tests(self.runner_id, on_response, max_classes=max(max_classes, 1), max_seconds=max_seconds, lookahead=lookahead, slots=slots)
+        elif message_type == RESULTS:
+            results = [decode_result(result) for result in body]
+            self.server.runners_outstanding.add(self.runner_id)
+            errors = self.server.report_results(self.runner_id, results)
+            self.reply(RESULTS_REPLY, [[error['full_name'], error['error']] for error in errors])
+        elif message_type == HEARTBEAT:
+            self.server.heartbeat(self.runner_id, [(class_path, method, elapsed) for class_path, method, elapsed in body])
+            self.reply(OK, [])
+        elif message_type == RELEASE:
+            class_path, methods, reason = body
+            self.server.release(self.runner_id, class_path, methods, reason)
+            self.reply(OK, [])
+        else:
+            self.refuse(400, "Unknown message type %r" % message_type)
+
+
+class BinaryServer(tornado.netutil.TCPServer):
+    """Serves a TestRunnerServer's tests and takes its results over the binary transport."""
+
+    def __init__(self, test_runner_server, **kwargs):
+        self.test_runner_server = test_runner_server
+        super(BinaryServer, self).__init__(**kwargs)
+
+    def handle_stream(self, stream, address):
+        ServerSession(self.test_runner_server, stream).start()
+
+    def listen_unix(self, path):
+        self.add_socket(tornado.netutil.bind_unix_socket(path))
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,247 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Run TestCases in forked children, so a crash or a leak only takes out one TestCase.
+
+The child runs the TestCase as usual and writes one JSON line per test method
+event (start and complete) to a pipe, then a final 'done' line. The parent reads
+those events and passes them on to its reporters. If the pipe closes without the
+'done' line, the child died (or called os._exit) and every method it didn't
+complete is reported as an error.
+"""
+import imp
+import logging
+import os
+import signal
+import sys
+import threading
+import weakref
+
+try:
+    import simplejson as json
+    _hush_pyflakes = [json]
+    del _hush_pyflakes
+except ImportError:
+    import json
+
+from testify.test_case import TestCase
+from testify.test_logger import _log
+from testify.test_result import TestResult
+
+ISOLATE_CLASS = 'class'
+
+EVENT_START = 'start'
+EVENT_COMPLETE = 'complete'
+EVENT_DONE = 'done'
+
+READ_SIZE = 65536
+
+
+def fork():
+    """os.fork(), safe to call while other threads (e.g. reporters') are running.
+
+    We hold the import lock and logging's locks while forking, so that no other thread holds them mid-update in
+    the child, where it doesn't exist to release them. The child then gets fresh logging locks.
+    """
+    # Before Python 2.7 these were the handlers themselves, rather than weakrefs to them.
+    handlers = [ref() if isinstance(ref, weakref.ref) else ref for ref in logging._handlerList]
+    handlers = [handler for handler in handlers if handler is not None and handler.lock is not None]
+
+    imp.acquire_lock()
+    logging._acquireLock()
+    for handler in handlers:
+        handler.acquire()
+    pid = None
+    try:
+        pid = os.fork()
+    finally:
+        if pid == 0:
+            logging._lock = threading.RLock()
+            for handler in handlers:
+                handler.createLock()
+            # Python 2.7 gives the child a fresh import lock of its own.
+            if imp.lock_held():
+                imp.release_lock()
+        else:
+            for handler in reversed(handlers):
+                handler.release()
+            logging._releaseLock()
+            imp.release_lock()
+    return pid
+
+
+class ForkedTestCase(object):
+    """A TestCase running in a forked child process.
+
+    Call start() to fork and run it, then call read_events() until eof is set (read_events() blocks, so use
+    select() on fileno() first if you're juggling more than one), and then finish() to reap the child and get
+    error results for any methods it never completed.
+    """
+
+    def __init__(self, test_case, runnable, memory_limit=None, cpu_limit=None):
+        """memory_limit is in bytes (RLIMIT_AS), cpu_limit in seconds (RLIMIT_CPU)."""
+        self.test_case = test_case
+        self.runnable = runnable
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+
+        self.pid = None
+        self.read_fd = None
+        self.eof = False
+        self.done = False
+        self._buffer = ''
+        self.started_methods = []
+        self.completed_methods = set()
+
+    def start(self):
+        # Anything still buffered would otherwise get written twice.
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        read_fd, write_fd = os.pipe()
+        self.pid = fork()
+        if self.pid == 0:
+            os.close(read_fd)
+            self._run_child(write_fd)
+        else:
+            os.close(write_fd)
+            self.read_fd = read_fd
+
+    def _run_child(self, write_fd):
+        """Run the TestCase, streaming events to write_fd. Never returns."""
+        exit_code = 0
+        try:
+            pipe = os.fdopen(write_fd, 'w')
+
+            def send(event):
+                def callback(result_dict):
+                    pipe.write(json.dumps([event, result_dict]) + '\n')
+                    pipe.flush()
+                return callback
+
+            self.test_case.register_callback(TestCase.EVENT_ON_RUN_TEST_METHOD, send(EVENT_START))
+            self.test_case.register_callback(TestCase.EVENT_ON_COMPLETE_TEST_METHOD, send(EVENT_COMPLETE))
+
+            self._apply_limits()
+            self.runnable()
+            send(EVENT_DONE)(None)
+            pipe.close()
+        except BaseException, e:
+            exit_code = 1
+            try:
+                _log.error("Isolated test case %s died: %r", self.test_case.__class__.__name__, e)
+            except Exception:
+                pass
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(exit_code)
+
+    def _apply_limits(self):
+        if not (self.memory_limit or self.cpu_limit):
+            return
+        import resource
+        if self.memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
+        if self.cpu_limit:
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu_limit, self.cpu_limit))
+
+    def fileno(self):
+        return self.read_fd
+
+    def read_events(self):
+        """Read whatever the child has sent, and return a list of (event, result_dict) pairs."""
+        data = os.read(self.read_fd, READ_SIZE)
+        if not data:
+            self.eof = True
+            os.close(self.read_fd)
+            data = '\n'
+
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+
+        events = []
+        for line in lines:
+            if not line:
+                continue
+            try:
+                event, result_dict = json.loads(line)
+            except ValueError:
+                _log.error("Garbled event from isolated test case %s: %r", self.test_case.__class__.__name__, line)
+                continue
+            if event == EVENT_DONE:
+                self.done = True
+                continue
+            name = result_dict['method']['name']
+            if event == EVENT_START:
+                self.started_methods.append(name)
+            else:
+                self.completed_methods.add(name)
+            events.append((event, result_dict))
+        return events
+
+    def finish(self):
+        """Reap the child. Returns (event, result_dict) pairs reporting an error for each method it didn't complete."""
+        _, status = os.waitpid(self.pid, 0)
+
+        if self.done:
+            # The TestCase ran to the end; anything not run was skipped on purpose (e.g. because of the failure limit).
+            return []
+
+        if os.WIFSIGNALED(status):
+            signum = os.WTERMSIG(status)
+            names = [name for name in dir(signal) if name.startswith('SIG') and not name.startswith('SIG_') and getattr(signal, name) == signum]
+            how = "was killed by signal %d%s" % (signum, ' (%s)' % names[0] if names else '')
+        else:
+            how = "exited with status %d" % os.WEXITSTATUS(status)
+
+        events = []
+        for test_method in self.test_case.runnable_test_methods():
+            if test_method.__name__ in self.completed_methods:
+                continue
+            result = TestResult(test_method)
+            result.start()
+            result.end_in_error(None)
+            result_dict = result.to_dict()
+            message = "The isolated process running this test case %s before this method completed.\n" % how
+            result_dict['exception_info'] = [message]
+            result_dict['exception_info_pretty'] = [message]
+            if test_method.__name__ not in self.started_methods:
+                events.append((EVENT_START, result_dict))
+            events.append((EVENT_COMPLETE, result_dict))
+        return events
+
+    def kill(self):
+        """Kill the child and reap it, without reporting anything for it."""
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        os.waitpid(self.pid, 0)
+        if not self.eof:
+            os.close(self.read_fd)
+
+    def run(self):
+        """Start the child and yield (event, result_dict) pairs until it's done."""
+        self.start()
+        while not self.eof:
+            for event in self.read_events():
+                yield event
+        for event in self.finish():
+            yield event
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,124 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Plugin manifests, so we only import the plugins a run actually uses.
+
+A plugin module can declare a manifest as a module-level dict literal:
+
+    TESTIFY_PLUGIN = {
+        # (args, kwargs) for each parser.add_option() call the plugin needs.
+        'options': [
+            (('--json-results',), {'action': 'store', 'dest': 'json_results', 'type': 'string', 'default': None}),
+        ],
+        # The plugin is imported if any of these option dests is set; with no
+        # 'activate_on', it's always imported once options are parsed.
+        'activate_on': ['json_results'],
+    }
+
+We read the manifest from the plugin's source without importing it, register
+its options, and only import the module (along with whatever heavy
+dependencies it has) once the parsed options show it's needed. Plugins without
+a manifest are imported up front, as they always have been.
+"""
+from __future__ import with_statement
+
+import ast
+import imp
+import sys
+
+MANIFEST_NAME = 'TESTIFY_PLUGIN'
+
+
+def read_manifest(path):
+    """Return the TESTIFY_PLUGIN dict declared in the plugin source at path, or None if it doesn't declare one.
+
+    We only parse the assignment itself, not the whole module, since this runs for every plugin on every startup.
+    """
+    with open(path) as source_file:
+        lines = source_file.readlines()
+    for start, line in enumerate(lines):
+        if line.startswith(MANIFEST_NAME) and line[len(MANIFEST_NAME):].lstrip().startswith('='):
+            break
+    else:
+        return None
+
+    # Take lines until they make a complete statement.
+    for end in xrange(start + 1, len(lines) + 1):
+        try:
+            tree = ast.parse(''.join(lines[start:end]), path)
+        except SyntaxError:
+            continue
+        try:
+            return ast.literal_eval(tree.body[0].value)
+        except ValueError:
+            break
+    print >>sys.stderr, "Ignoring the manifest of plugin %s: it must be a dict literal." % path
+    return None
+
+
+def add_options(parser, manifest):
+    for args, kwargs in manifest.get('options', ()):
+        parser.add_option(*args, **kwargs)
+
+
+class LazyPlugin(object):
+    """Stands in for a plugin module until we know whether this run needs it.
+
+    Only add_command_line_options is available before it's loaded; see activate_plugins().
+    """
+
+    def __init__(self, name, path, manifest):
+        self.name = name
+        self.path = path
+        self.manifest = manifest
+        self.module = None
+
+    def __repr__(self):
+        return '<LazyPlugin %s from %s>' % (self.name, self.path)
+
+    def add_command_line_options(self, parser):
+        add_options(parser, self.manifest)
+
+    def is_active(self, options):
+        activate_on = self.manifest.get('activate_on')
+        if activate_on is None:
+            return True
+        return any(getattr(options, dest, None) for dest in activate_on)
+
+    def load(self):
+        """Import the plugin module (once), returning it, or None if it failed to import."""
+        if self.module is None:
+            try:
+                with open(self.path) as plugin_file:
+                    self.module = imp.load_module(self.name, plugin_file, self.path, ('.py', 'U', imp.PY_SOURCE))
+            except ImportError, e:
+                print >>sys.stderr, "Failed to import plugin %s: %r" % (self.path, e)
+        return self.module
+
+
+def activate_plugins(plugin_modules, options):
+    """Given parsed options, import the lazy plugins they need, and return the list of plugin modules to use."""
+    active_modules = []
+    for plugin in plugin_modules:
+        if isinstance(plugin, LazyPlugin):
+            if not plugin.is_active(options):
+                continue
+            plugin = plugin.load()
+            if plugin is None:
+                continue
+        active_modules.append(plugin)
+    return active_modules
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -11,10 +11,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from testify import plugin_manifest
 from testify.utils import code_coverage
 
+TESTIFY_PLUGIN = {
+    'options': [
+        (("-c", "--coverage"), {'action': "store_true", 'dest': "coverage"}),
+    ],
+    'activate_on': ['coverage'],
+}
+
 def add_command_line_options(parser):
-    parser.add_option("-c", "--coverage", action="store_true", dest="coverage")
+    plugin_manifest.add_options(parser, TESTIFY_PLUGIN)
 
 def run_test_case(options, test_case, runnable):
     if options.coverage:
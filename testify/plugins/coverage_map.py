@@ -0,0 +1,86 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Record which lines each test method runs, for use by --affected-by.
+
+Lines run by class-level fixtures are recorded against the test case as a
+whole. The map is written to --coverage-map when the run finishes, replacing
+the entries of the test cases that ran and keeping everything else.
+"""
+import os
+
+from testify import plugin_manifest
+from testify import test_reporter
+from testify.test_impact import CLASS_LEVEL, CoverageMap
+from testify.test_logger import _log
+from testify.utils.code_coverage import LineCollector
+
+TESTIFY_PLUGIN = {
+    'options': [
+        (("--record-coverage-map",), {'action': "store_true", 'dest': "record_coverage_map", 'default': False, 'help': "Record which lines of code under the current directory each test method runs, into the --coverage-map file."}),
+    ],
+    'activate_on': ['record_coverage_map'],
+}
+
+# The recorder for the current run, set up by build_test_reporters.
+recorder = None
+
+
+class CoverageMapRecorder(test_reporter.TestReporter):
+    def __init__(self, options, coverage_map, roots):
+        super(CoverageMapRecorder, self).__init__(options)
+        self.coverage_map = coverage_map
+        self.collector = LineCollector(roots)
+
+    def test_start(self, result):
+        self.collector.switch(result['method']['name'])
+
+    def test_complete(self, result):
+        self.collector.switch(CLASS_LEVEL)
+
+    def run_test_case(self, test_case, runnable):
+        class_path = '%s %s' % (test_case.__module__, test_case.__class__.__name__)
+        self.collector.start(CLASS_LEVEL)
+        try:
+            return runnable()
+        finally:
+            self.collector.stop()
+            for bucket, lines_by_file in self.collector.pop_lines().iteritems():
+                self.coverage_map.record(class_path, bucket, lines_by_file)
+
+    def report(self):
+        self.coverage_map.save()
+        return True
+
+
+# Hooks for plugin system
+
+def add_command_line_options(parser):
+    plugin_manifest.add_options(parser, TESTIFY_PLUGIN)
+
+def build_test_reporters(options):
+    global recorder
+    recorder = None
+    if not options.record_coverage_map:
+        return []
+    if options.isolate:
+        # The lines would be collected in the forked children, and lost.
+        _log.warning("--record-coverage-map doesn't work with --isolate; not recording a coverage map.")
+        return []
+    recorder = CoverageMapRecorder(options, CoverageMap(options.coverage_map).load(), [os.getcwd()])
+    return [recorder]
+
+def run_test_case(options, test_case, runnable):
+    if recorder is not None:
+        return recorder.run_test_case(test_case, runnable)
+    return runnable()
@@ -1,10 +1,17 @@
+from __future__ import with_statement
+
 import httplib
 import logging
 import Queue
 import threading
+import time
 import urllib2
+import zlib
 
+from testify import binary_transport
+from testify import plugin_manifest
 from testify import test_reporter
+from testify.utils.connection_pool import ConnectionPool
 
 try:
     import simplejson as json
@@ -13,18 +20,43 @@ try:
 except ImportError:
     import json
 
+# Reports back to the server given by --connect.
+TESTIFY_PLUGIN = {
+    'options': [
+        (('--result-batch-size',), {'action': "store", 'dest': "result_batch_size", 'type': "int", 'default': 1, 'help': "With --connect, send results back to the server in gzipped batches of up to this many."}),
+        (('--result-batch-seconds',), {'action': "store", 'dest': "result_batch_seconds", 'type': "float", 'default': 1.0, 'help': "With --result-batch-size, send a batch once its first result has waited this long, even if it isn't full. Defaults to %default."}),
+        (('--heartbeat-interval',), {'action': "store", 'dest': "heartbeat_interval", 'type': "float", 'default': 5.0, 'metavar': "SECONDS", 'help': "With --connect, tell the server this often that we're alive and which test method we're running, so it can tell a dead runner or a hung test from a slow one (see --heartbeat-timeout). 0 turns heartbeats off. Defaults to %default."}),
+    ],
+    'activate_on': ['connect_addr'],
+}
+
+# Put on the result queue by report(), to send whatever's waiting without waiting out result_batch_seconds.
+FLUSH = object()
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
 class HTTPReporter(test_reporter.TestReporter):
     def report_results(self):
         while True:
+            if self.batch_size > 1 or self.connection:
+                self.report_batch()
+                continue
+
             result = self.result_queue.get()
+            if result is FLUSH:
+                self.result_queue.task_done()
+                continue
             result['runner_id'] = self.runner_id
 
             try:
+                path = '/results?runner=%s' % self.runner_id
                 try:
-                    urllib2.urlopen('http://%s/results?runner=%s' % (self.connect_addr, self.runner_id), json.dumps(result))
+                    self.pool.request('POST', path, json.dumps(result))
                 except (urllib2.URLError, httplib.BadStatusLine), e:
                     # Retry once.
-                    urllib2.urlopen('http://%s/results?runner=%s' % (self.connect_addr, self.runner_id), json.dumps(result))
+                    self.pool.request('POST', path, json.dumps(result))
             except urllib2.HTTPError, e:
                 logging.error('Skipping returning results for test %s because of error: %s' % (result['method']['full_name'], e.read()))
             except Exception, e:
@@ -32,10 +64,88 @@ class HTTPReporter(test_reporter.TestReporter):
 
             self.result_queue.task_done()
 
+    def report_batch(self):
+        """Wait for a result, then gather more until we have batch_size of them, batch_seconds pass or report() asks
+        us to flush, and send them all to /results/batch in one gzipped request."""
+        batch = []
+        dequeued = 0
+        deadline = None
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    result = self.result_queue.get()
+                    deadline = time.time() + self.batch_seconds
+                else:
+                    result = self.result_queue.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            dequeued += 1
+            if result is FLUSH:
+                break
+            result['runner_id'] = self.runner_id
+            batch.append(result)
+
+        try:
+            if batch:
+                self.send_batch(batch)
+        finally:
+            for _ in xrange(dequeued):
+                self.result_queue.task_done()
+
+    def send_batch(self, batch):
+        if self.connection:
+            return self.send_binary_batch(batch)
+
+        path = '/results/batch?runner=%s' % self.runner_id
+        body = gzip_compress(json.dumps(batch))
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        try:
+            try:
+                response = self.pool.request('POST', path, body, headers)
+            except (urllib2.URLError, httplib.BadStatusLine), e:
+                # Retry once.
+                response = self.pool.request('POST', path, body, headers)
+            errors = json.loads(response)['errors']
+        except urllib2.HTTPError, e:
+            logging.error('Skipping returning results for %d tests because of error: %s' % (len(batch), e.read()))
+            return
+        except Exception, e:
+            logging.error('Skipping returning results for %d tests because of unknown error: %s' % (len(batch), e))
+            return
+
+        for error in errors:
+            logging.error('Skipping returning results for test %s because of error: %s' % (error['full_name'], error['error']))
+
+    def send_binary_batch(self, batch):
+        try:
+            try:
+                errors = self.connection.report_results(batch)
+            except binary_transport.TransportError, e:
+                # Retry once.
+                errors = self.connection.report_results(batch)
+        except binary_transport.Refused, e:
+            logging.error('Skipping returning results for %d tests because of error: %s' % (len(batch), e.reason))
+            return
+        except Exception, e:
+            logging.error('Skipping returning results for %d tests because of unknown error: %s' % (len(batch), e))
+            return
+
+        for error in errors:
+            logging.error('Skipping returning results for test %s because of error: %s' % (error['full_name'], error['error']))
 
     def __init__(self, options, connect_addr, runner_id, *args, **kwargs):
         self.connect_addr = connect_addr
         self.runner_id = runner_id
+        # Only the reporting thread sends results, so one idle keep-alive connection is all it needs.
+        self.pool = ConnectionPool(connect_addr, max_idle=1)
+        self.batch_size = kwargs.pop('batch_size', 1)
+        self.batch_seconds = kwargs.pop('batch_seconds', 1.0)
+        transport = kwargs.pop('transport', 'http')
+        revision = kwargs.pop('revision', None)
+        self.connection = None
+        if transport == 'binary':
+            # Results always go over the binary transport in batches, if only of one.
+            self.connection = binary_transport.ClientConnection(connect_addr, runner_id, revision)
 
         self.result_queue = Queue.Queue()
         self.reporting_thread = threading.Thread(target=self.report_results)
@@ -52,11 +162,90 @@ class HTTPReporter(test_reporter.TestReporter):
 
     def report(self):
         """Wait until all results have been sent back."""
+        self.result_queue.put(FLUSH)
         self.result_queue.join()
 
+class HeartbeatReporter(test_reporter.TestReporter):
+    """Sends the server a heartbeat every interval seconds, saying which test methods we're running (if any; more
+    than one with --slots) and for how long, from a thread of its own so that a long-running test doesn't hold it up."""
+
+    def __init__(self, options, connect_addr, runner_id, interval, transport='http', revision=None):
+        super(HeartbeatReporter, self).__init__(options)
+        self.runner_id = runner_id
+        self.interval = interval
+        self.pool = ConnectionPool(connect_addr, max_idle=1)
+        self.connection = None
+        if transport == 'binary':
+            self.connection = binary_transport.ClientConnection(connect_addr, runner_id, revision)
+        self.lock = threading.Lock()
+        self.running = {} # (class_path, method) -> start time, for each method we're running.
+        self.stopped = threading.Event()
+
+        self.heartbeat_thread = threading.Thread(target=self.send_heartbeats)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def running_key(self, result):
+        return '%s %s' % (result['method']['module'], result['method']['class']), result['method']['name']
+
+    def test_start(self, result):
+        with self.lock:
+            self.running[self.running_key(result)] = time.time()
+
+    def test_complete(self, result):
+        with self.lock:
+            self.running.pop(self.running_key(result), None)
+
+    def send_heartbeats(self):
+        while True:
+            # Event.wait() only returns whether the event is set from Python 2.7 on.
+            self.stopped.wait(self.interval)
+            if self.stopped.is_set():
+                break
+            self.send_heartbeat()
+
+    def send_heartbeat(self):
+        now = time.time()
+        with self.lock:
+            running = [(class_path, method, now - start_time) for (class_path, method), start_time in self.running.iteritems()]
+
+        try:
+            if self.connection:
+                self.connection.heartbeat(running)
+            else:
+                body = json.dumps({'running': running})
+                self.pool.request('POST', '/heartbeat?runner=%s' % self.runner_id, body)
+        except Exception, e:
+            logging.warning('Failed to send a heartbeat to the server: %s' % e)
+
+    def report(self):
+        self.stopped.set()
+        return True
+
+def add_command_line_options(parser):
+    plugin_manifest.add_options(parser, TESTIFY_PLUGIN)
+
 def build_test_reporters(options):
     if options.connect_addr:
-        return [HTTPReporter(options, options.connect_addr, options.runner_id)]
+        reporters = [HTTPReporter(
+            options,
+            options.connect_addr,
+            options.runner_id,
+            batch_size=options.result_batch_size,
+            batch_seconds=options.result_batch_seconds,
+            transport=options.transport,
+            revision=options.revision,
+        )]
+        if options.heartbeat_interval > 0:
+            reporters.append(HeartbeatReporter(
+                options,
+                options.connect_addr,
+                options.runner_id,
+                options.heartbeat_interval,
+                transport=options.transport,
+                revision=options.revision,
+            ))
+        return reporters
     return []
 
 # vim: set ts=4 sts=4 sw=4 et:
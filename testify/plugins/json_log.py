@@ -20,8 +20,18 @@ try:
 except ImportError:
     import json
 
+from testify import plugin_manifest
 from testify import test_reporter
 
+TESTIFY_PLUGIN = {
+    'options': [
+        (("--json-results",), {'action': "store", 'dest': "json_results", 'type': "string", 'default': None, 'help': "Store test results in json format"}),
+        (("--json-results-logging",), {'action': "store_true", 'dest': "json_results_logging", 'default': False, 'help': "Store log output for failed test results in json"}),
+        (("--extra-json-info",), {'action': "store", 'dest': "extra_json_info", 'type': "string", 'help': "json containing some extra info to be stored"}),
+    ],
+    'activate_on': ['json_results'],
+}
+
 class ResultLogHandler(logging.Handler):
     """Log Handler to collect log output during a test run"""
     def __init__(self, *args, **kwargs):
@@ -92,9 +102,7 @@ class JSONReporter(test_reporter.TestReporter):
 # Hooks for plugin system
 
 def add_command_line_options(parser):
-    parser.add_option("--json-results", action="store", dest="json_results", type="string", default=None, help="Store test results in json format")
-    parser.add_option("--json-results-logging", action="store_true", dest="json_results_logging", default=False, help="Store log output for failed test results in json")
-    parser.add_option("--extra-json-info", action="store", dest="extra_json_info", type="string", help="json containing some extra info to be stored")
+    plugin_manifest.add_options(parser, TESTIFY_PLUGIN)
 
 def build_test_reporters(options):
     if options.json_results:
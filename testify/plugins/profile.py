@@ -13,8 +13,17 @@
 # limitations under the License.
 import cProfile
 
+from testify import plugin_manifest
+
+TESTIFY_PLUGIN = {
+    'options': [
+        (("-p", "--profile"), {'action': "store_true", 'dest': "profile"}),
+    ],
+    'activate_on': ['profile'],
+}
+
 def add_command_line_options(parser):
-    parser.add_option("-p", "--profile", action="store_true", dest="profile")
+    plugin_manifest.add_options(parser, TESTIFY_PLUGIN)
 
 def run_test_case(options, test_case, runnable):
     if options.profile:
@@ -13,8 +13,17 @@
 # limitations under the License.
 import random
 
+from testify import plugin_manifest
+
+TESTIFY_PLUGIN = {
+    'options': [
+        (("--seed",), {'action': "store", 'dest': "seed", 'type': 'int', 'default': None, 'help': "Seed random for each test using this value + hash of the testclass' name. This allows tests to have random yet reproducible numbers."}),
+    ],
+    'activate_on': ['seed'],
+}
+
 def add_command_line_options(parser):
-    parser.add_option("--seed", action="store", dest="seed", type='int', default=None, help="Seed random for each test using this value + hash of the testclass' name. This allows tests to have random yet reproducible numbers.")
+    plugin_manifest.add_options(parser, TESTIFY_PLUGIN)
 
 def run_test_case(options, test_case, runnable):
     # If random seed is set, seed with seed value plus hash(testclass name). This makes random tests at least be reproducible,
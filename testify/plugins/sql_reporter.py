@@ -15,6 +15,7 @@
 import hashlib
 import logging
 import sqlalchemy as SA
+from testify import plugin_manifest
 from testify import test_reporter
 
 try:
@@ -29,6 +30,17 @@ import time
 import threading
 import Queue
 
+TESTIFY_PLUGIN = {
+    'options': [
+        (("--reporting-db-config",), {'action': "store", 'dest': "reporting_db_config", 'type': "string", 'default': None, 'help': "Path to a yaml file describing the SQL database to report into."}),
+        (('--reporting-db-url',), {'action': "store", 'dest': "reporting_db_url", 'type': "string", 'default': None, 'help': "The URL of a SQL database to report into."}),
+        (("--build-info",), {'action': "store", 'dest': "build_info", 'type': "string", 'default': None, 'help': "A JSON dictionary of information about this build, to store in the reporting database."}),
+        (("--sql-reporting-frequency",), {'action': "store", 'dest': "sql_reporting_frequency", 'type': "float", 'default': 1.0, 'help': "How long to wait between SQL inserts, at a minimum"}),
+        (("--sql-batch-size",), {'action': "store", 'dest': "sql_batch_size", 'type': "int", 'default': "500", 'help': "Maximum number of rows to insert at any one time"}),
+    ],
+    'activate_on': ['reporting_db_config', 'reporting_db_url'],
+}
+
 metadata = SA.MetaData()
 
 Tests = SA.Table('tests', metadata,
@@ -70,12 +82,20 @@ TestResults = SA.Table('test_results', metadata,
     SA.Column('run_time', SA.Float, index=True, nullable=False),
     SA.Column('runner_id', SA.String(255), index=True, nullable=True),
     SA.Column('previous_run', SA.Integer, index=False, nullable=True),
+    # Added after the table was, so older databases won't have it (create_all() doesn't add columns); see
+    # has_cached_column(). NULL means the result wasn't served from the cache.
+    SA.Column('cached', SA.Boolean, nullable=True),
 )
 SA.Index('ix_build_test_failure', TestResults.c.build, TestResults.c.test, TestResults.c.failure)
 
 def md5(s):
     return hashlib.md5(s.encode('utf8') if isinstance(s, unicode) else s).hexdigest()
 
+def has_cached_column(conn):
+    """Return whether the database's test_results table has the cached column."""
+    reflected = SA.Table(TestResults.name, SA.MetaData(), autoload=True, autoload_with=conn)
+    return 'cached' in reflected.c
+
 class SQLReporter(test_reporter.TestReporter):
     def __init__(self, options, *args, **kwargs):
         dburl = options.reporting_db_url or SA.engine.url.URL(**yaml.safe_load(open(options.reporting_db_config)))
@@ -88,6 +108,7 @@ class SQLReporter(test_reporter.TestReporter):
         self.engine = SA.create_engine(dburl, **create_engine_opts)
         self.conn = self.engine.connect()
         metadata.create_all(self.engine)
+        self.has_cached_column = has_cached_column(self.conn)
 
         self.build_id = self.create_build_row(options.build_info)
         self.start_time = time.time()
@@ -151,7 +172,7 @@ class SQLReporter(test_reporter.TestReporter):
         """A worker func that runs in another thread and reports results to the database.
         Create a TestResults row from a test result dict. Also inserts the previous_run row."""
         def create_row_to_insert(result, previous_run_id=None):
-            return {
+            row = {
                 'test' : get_test_id(result['method']['module'], result['method']['class'], result['method']['name']),
                 'failure' : get_failure_id(result['exception_info']),
                 'build' : self.build_id,
@@ -160,6 +181,9 @@ class SQLReporter(test_reporter.TestReporter):
                 'runner_id' : result['runner_id'],
                 'previous_run' : previous_run_id,
             }
+            if result.get('cached') and self.has_cached_column:
+                row['cached'] = True
+            return row
 
         def get_test_id(module, class_name, method_name):
             """Get the ID of the Tests row that corresponds to this test. If the row doesn't exist, insert one"""
@@ -245,9 +269,12 @@ class SQLReporter(test_reporter.TestReporter):
 
             for chunk in chunks:
                 try:
-                    conn.execute(TestResults.insert(),
-                        [create_row_to_insert(result, result.get('previous_run_id', None)) for result in chunk]
-                    )
+                    rows = [create_row_to_insert(result, result.get('previous_run_id', None)) for result in chunk]
+                    # An executemany needs every row to have the same keys, and only cached results have 'cached'.
+                    for with_cached in (False, True):
+                        batch = [row for row in rows if ('cached' in row) == with_cached]
+                        if batch:
+                            conn.execute(TestResults.insert(), batch)
                 except Exception, e:
                     logging.error("Exception while reporting results: " + repr(e))
                     self.ok = False
@@ -271,13 +298,28 @@ class SQLReporter(test_reporter.TestReporter):
         return self.ok
 
 
+def load_durations(conn):
+    """Return {(class_path, method): average run time} over the results in the database, for scheduling.
+
+    Cached results are left out, since they didn't actually run.
+    """
+    whereclause = TestResults.c.test == Tests.c.id
+    # Databases from before the cached column have no cached results to leave out.
+    if has_cached_column(conn):
+        whereclause = SA.and_(whereclause, SA.or_(TestResults.c.cached == None, TestResults.c.cached == False))
+    query = SA.select(
+        [Tests.c.module, Tests.c.class_name, Tests.c.method_name, SA.func.avg(TestResults.c.run_time)],
+        whereclause,
+    ).group_by(Tests.c.module, Tests.c.class_name, Tests.c.method_name)
+    return dict(
+        (('%s %s' % (module, class_name), method_name), float(run_time))
+        for module, class_name, method_name, run_time in conn.execute(query)
+    )
+
+
 # Hooks for plugin system
 def add_command_line_options(parser):
-    parser.add_option("--reporting-db-config", action="store", dest="reporting_db_config", type="string", default=None, help="Path to a yaml file describing the SQL database to report into.")
-    parser.add_option('--reporting-db-url', action="store", dest="reporting_db_url", type="string", default=None, help="The URL of a SQL database to report into.")
-    parser.add_option("--build-info", action="store", dest="build_info", type="string", default=None, help="A JSON dictionary of information about this build, to store in the reporting database.")
-    parser.add_option("--sql-reporting-frequency", action="store", dest="sql_reporting_frequency", type="float", default=1.0, help="How long to wait between SQL inserts, at a minimum")
-    parser.add_option("--sql-batch-size", action="store", dest="sql_batch_size", type="int", default="500", help="Maximum number of rows to insert at any one time")
+    plugin_manifest.add_options(parser, TESTIFY_PLUGIN)
 
 def build_test_reporters(options):
     if options.reporting_db_config or options.reporting_db_url:
@@ -0,0 +1,115 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Run test reporters on their own thread, so slow ones don't hold up the caller.
+
+The server calls its reporters from the IOLoop, where a reporter writing to
+disk or flushing a terminal would otherwise stall every runner.
+"""
+from __future__ import with_statement
+
+import Queue
+import threading
+import time
+
+from testify import test_reporter
+from testify.test_logger import _log
+
+DEFAULT_MAX_SIZE = 1000
+
+# Put on the queue by report(), to tell the reporting thread there's nothing more to come.
+_STOP = object()
+
+
+class QueuedReporter(test_reporter.TestReporter):
+    """Passes everything on to reporters, in order, from a thread of its own.
+
+    Calls queue up to max_size deep; past that, the caller blocks until the reporters catch up, rather than us
+    holding an unbounded backlog of results. report() waits for the queue to drain, then collects the reporters'
+    own report()s.
+    """
+
+    def __init__(self, options, reporters, max_size=DEFAULT_MAX_SIZE):
+        super(QueuedReporter, self).__init__(options)
+        self.reporters = reporters
+        self.queue = Queue.Queue(max_size)
+        self.lock = threading.Lock()
+        self.queued_count = 0 # Calls ever queued.
+        self.max_depth = 0 # The deepest the queue has been.
+        self.blocked_count = 0 # Calls that found the queue full and had to wait.
+        self.blocked_seconds = 0.0 # Total time callers spent waiting on a full queue.
+
+        self.thread = threading.Thread(target=self.dispatch)
+        # A wedged reporter shouldn't stop us exiting; report() is what waits for it.
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enqueue(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            start = time.time()
+            self.queue.put(item)
+            with self.lock:
+                self.blocked_count += 1
+                self.blocked_seconds += time.time() - start
+        with self.lock:
+            self.queued_count += 1
+            self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def dispatch(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            method_name, args = item
+            for reporter in self.reporters:
+                try:
+                    getattr(reporter, method_name)(*args)
+                except Exception:
+                    # Keep going: if this thread died, the queue would fill up and wedge whoever's calling us.
+                    _log.exception("Reporter %r failed in %s", reporter, method_name)
+
+    def stats(self):
+        """Return how the queue has been doing, for watching whether reporters keep up."""
+        with self.lock:
+            return {
+                'depth': self.queue.qsize(),
+                'max_size': self.queue.maxsize,
+                'max_depth': self.max_depth,
+                'queued': self.queued_count,
+                'blocked': self.blocked_count,
+                'blocked_seconds': self.blocked_seconds,
+            }
+
+    def test_counts(self, test_case_count, test_method_count):
+        self.enqueue(('test_counts', (test_case_count, test_method_count)))
+
+    def test_start(self, result):
+        self.enqueue(('test_start', (result,)))
+
+    def test_complete(self, result):
+        self.enqueue(('test_complete', (result,)))
+
+    def test_discovery_failure(self, exc):
+        self.enqueue(('test_discovery_failure', (exc,)))
+
+    def report(self):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+        return all([reporter.report() for reporter in self.reporters])
+
+# vim: set ts=4 sts=4 sw=4 et:
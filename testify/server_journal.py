@@ -0,0 +1,155 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""A journal of a TestRunnerServer's state, so a run can pick up where it left off if the server dies (--resume).
+
+The journal is a file of JSON objects, one per line, each recording one
+transition:
+
+    {"event": "queue", "key": ..., "priority": ..., "test": test_dict}
+    {"event": "checkout", "key": ..., "runner": ...}
+    {"event": "checkin", "key": ...}
+    {"event": "rerun", "kind": "failed" or "timeout", "class_path": ..., "method": ..., "previous_run": summary}
+    {"event": "reported", "result": result_dict}
+    {"event": "discovered"}
+
+where key is the checkout key of a test_dict (its chunk key if it has one,
+otherwise its class path). The server queues tests as it discovers them, and
+writes "discovered" once it has queued them all. Each line is flushed as it's written, so the journal
+survives the server process dying, though not necessarily the machine.
+"""
+from __future__ import with_statement
+
+import threading
+
+try:
+    import simplejson as json
+    _hush_pyflakes = [json]
+    del _hush_pyflakes
+except ImportError:
+    import json
+
+
+def checkout_key(test_dict):
+    return test_dict.get('chunk', test_dict['class_path'])
+
+
+class ServerJournal(object):
+    """Appends events to the journal at path."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.journal_file = open(path, 'a')
+
+    def write(self, event, **fields):
+        fields['event'] = event
+        line = json.dumps(fields) + '\n'
+        with self.lock:
+            self.journal_file.write(line)
+            self.journal_file.flush()
+
+    def queue(self, priority, test_dict):
+        self.write('queue', key=checkout_key(test_dict), priority=priority, test=test_dict)
+
+    def checkout(self, runner, key):
+        self.write('checkout', key=key, runner=runner)
+
+    def checkin(self, key):
+        self.write('checkin', key=key)
+
+    def rerun(self, kind, class_path, method, previous_run):
+        self.write('rerun', kind=kind, class_path=class_path, method=method, previous_run=previous_run)
+
+    def reported(self, result):
+        self.write('reported', result=result)
+
+    def discovered(self):
+        self.write('discovered')
+
+    def close(self):
+        with self.lock:
+            self.journal_file.close()
+
+
+class JournalState(object):
+    """What a server had done, according to its journal."""
+
+    def __init__(self):
+        self.queued = {} # checkout key -> (priority, test_dict), for tests that were waiting in the queue.
+        self.checked_out = {} # checkout key -> test_dict, for tests a runner had but hadn't finished.
+        self.reported_results = [] # Results the server had passed on to its reporters, in order.
+        self.reported_methods = set() # (class_path, method) of each of reported_results.
+        self.failed_rerun_methods = set()
+        self.timeout_rerun_methods = set()
+        self.previous_run_results = {}
+        self.test_dicts = [] # Every test_dict ever queued, for rebuilding method chunks.
+        self.discovered = False # Whether the server had queued everything it discovered.
+
+    def apply(self, entry):
+        event = entry['event']
+        if event == 'queue':
+            test_dict = entry['test']
+            self.queued[entry['key']] = (entry['priority'], test_dict)
+            self.checked_out.pop(entry['key'], None)
+            self.test_dicts.append(test_dict)
+        elif event == 'checkout':
+            _, test_dict = self.queued.pop(entry['key'], (None, None))
+            if test_dict is not None:
+                self.checked_out[entry['key']] = test_dict
+        elif event == 'checkin':
+            self.checked_out.pop(entry['key'], None)
+        elif event == 'rerun':
+            method = (entry['class_path'], entry['method'])
+            if entry['kind'] == 'failed':
+                self.failed_rerun_methods.add(method)
+            else:
+                self.timeout_rerun_methods.add(method)
+            self.previous_run_results[method] = entry['previous_run']
+        elif event == 'reported':
+            result = entry['result']
+            self.reported_results.append(result)
+            self.reported_methods.add(('%s %s' % (result['method']['module'], result['method']['class']), result['method']['name']))
+        elif event == 'discovered':
+            self.discovered = True
+
+    def tests_to_queue(self):
+        """Return (priority, test_dict) for everything left to run: what was queued, then (ahead of it) whatever
+        runners had checked out, less the methods they'd already reported."""
+        tests = sorted(self.queued.itervalues(), key=lambda queued: queued[0])
+        for test_dict in self.checked_out.itervalues():
+            unfinished = dict(test_dict)
+            # Whichever runner had it may well be gone, so don't hold it back from anyone.
+            unfinished.pop('last_runner', None)
+            unfinished['methods'] = [method for method in test_dict['methods'] if (test_dict['class_path'], method) not in self.reported_methods]
+            if unfinished['methods']:
+                tests.insert(0, (-1, unfinished))
+        return tests
+
+
+def load(path):
+    """Read the journal at path, returning a JournalState."""
+    state = JournalState()
+    with open(path) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Most likely the last line, torn when the server died mid-write.
+                continue
+            state.apply(entry)
+    return state
+
+# vim: set ts=4 sts=4 sw=4 et:
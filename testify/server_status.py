@@ -0,0 +1,118 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""What a TestRunnerServer is up to, for /status and /metrics.
+
+TestRunnerServer.status() gathers a dict of it (served as JSON at /status);
+format_openmetrics() renders that dict in the OpenMetrics text format (served
+at /metrics), for Prometheus and the like to scrape.
+"""
+import collections
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# How far back results_per_second looks.
+RATE_WINDOW_SECONDS = 60.0
+
+
+class ResultRate(object):
+    """Counts results, and how many came in over the last RATE_WINDOW_SECONDS."""
+
+    def __init__(self, window=RATE_WINDOW_SECONDS):
+        self.window = window
+        self.times = collections.deque()
+        self.total = 0
+
+    def add(self, now):
+        self.total += 1
+        self.times.append(now)
+        self.expire(now)
+
+    def expire(self, now):
+        while self.times and self.times[0] <= now - self.window:
+            self.times.popleft()
+
+    def per_second(self, now, since):
+        """Results per second over the window, or since since if that was more recent."""
+        self.expire(now)
+        elapsed = min(self.window, now - since) if since is not None else self.window
+        if elapsed <= 0:
+            return 0.0
+        return len(self.times) / elapsed
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_openmetrics(status):
+    """Render a TestRunnerServer.status() dict as OpenMetrics text."""
+    lines = []
+
+    def family(name, metric_type, help_text, samples):
+        """samples is a list of (labels dict, value); samples with a value of None are left out."""
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.append('# HELP %s %s' % (name, help_text))
+        sample_name = name + '_total' if metric_type == 'counter' else name
+        for labels, value in samples:
+            if value is None:
+                continue
+            if labels:
+                label_text = ','.join('%s="%s"' % (key, escape_label(labels[key])) for key in sorted(labels))
+                lines.append('%s{%s} %s' % (sample_name, label_text, format_value(value)))
+            else:
+                lines.append('%s %s' % (sample_name, format_value(value)))
+
+    checked_out = status['checked_out']
+    runners = status['runners']
+    reporter_queue = status['reporter_queue']
+
+    family('testify_shutting_down', 'gauge', 'Whether the server is shutting down.', [({}, status['shutting_down'])])
+    family('testify_discovering', 'gauge', 'Whether the server is still discovering tests to queue.', [({}, status['discovering'])])
+    family('testify_queued_tests', 'gauge', 'Test cases waiting to be handed out.', [({}, status['queue']['tests'])])
+    family('testify_waiting_runners', 'gauge', 'Runners waiting for a test.', [({}, status['queue']['waiting_runners'])])
+    family('testify_checked_out_tests', 'gauge', 'Test cases runners have checked out.', [({}, len(checked_out))])
+    family('testify_checked_out_age_seconds', 'gauge', 'How long ago each checked out test case was checked out.',
+        [({'key': test['key'], 'runner': test['runner']}, test['age_seconds']) for test in checked_out])
+    family('testify_results', 'counter', 'Results reported by runners.', [({}, status['results']['total'])])
+    family('testify_failures', 'counter', 'Failed results.', [({}, status['results']['failures'])])
+    family('testify_results_per_second', 'gauge', 'Results reported per second over the last minute.', [({}, status['results']['per_second'])])
+    family('testify_reruns', 'counter', 'Test methods requeued to run again.',
+        [({'reason': reason}, count) for reason, count in sorted(status['reruns'].iteritems())])
+    family('testify_eta_seconds', 'gauge', 'Estimated seconds until every test has run.', [({}, status['eta_seconds'])])
+    family('testify_runner_results', 'counter', 'Results reported by each runner.',
+        [({'runner': runner_id}, runner['results']) for runner_id, runner in sorted(runners.iteritems())])
+    family('testify_runner_results_per_second', 'gauge', 'Results per second from each runner since it first asked for tests.',
+        [({'runner': runner_id}, runner['results_per_second']) for runner_id, runner in sorted(runners.iteritems())])
+    family('testify_runner_idle_seconds', 'gauge', 'How long each runner has had nothing checked out.',
+        [({'runner': runner_id}, runner['idle_seconds']) for runner_id, runner in sorted(runners.iteritems())])
+    family('testify_runner_last_seen_seconds', 'gauge', 'How long since each runner last asked for tests or reported a result.',
+        [({'runner': runner_id}, runner['last_seen_seconds']) for runner_id, runner in sorted(runners.iteritems())])
+    family('testify_reporter_queue_depth', 'gauge', 'Reports waiting for the reporters.', [({}, reporter_queue['depth'])])
+    family('testify_reporter_queue_blocked_seconds', 'counter', 'Time the server spent waiting for reporters to catch up.',
+        [({}, reporter_queue['blocked_seconds'])])
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,221 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""A content-addressed cache of passing test results.
+
+Each TestCase gets a key hashing the source of its module and of every
+first-party module (one whose source is under the current directory) that it
+transitively refers to, along with the Python and testify versions, the suite
+options and any environment variables named with --result-cache-env. Test
+methods that passed under the same key before are reported as cached successes
+instead of being run.
+
+Dependencies are found the same way the daemon and watch mode find them (see
+utils.module_tracker): from the modules and objects each module holds at the
+top level. Imports done inside functions aren't seen, so the cache is opt-in.
+
+The cache is a directory with one JSON file of passing results per key. Hits
+bump a file's mtime, and when the directory grows past its size limit the
+least recently used files are removed.
+"""
+from __future__ import with_statement
+
+import errno
+import hashlib
+import os
+import sys
+import time
+
+try:
+    import simplejson as json
+    _hush_pyflakes = [json]
+    del _hush_pyflakes
+except ImportError:
+    import json
+
+import testify
+from testify import test_reporter
+from testify.test_logger import _log
+from testify.utils.module_tracker import ModuleTracker, source_path
+
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+
+
+def class_path_for(test_case):
+    return '%s %s' % (test_case.__module__, test_case.__class__.__name__)
+
+
+class ResultCache(object):
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, key_data=None, roots=None):
+        """key_data is anything repr()-able that should invalidate every entry when it changes (options, environment)."""
+        self.path = path
+        self.max_size = max_size
+        self.key_data = repr((sys.version, testify.__version__, key_data))
+        self.roots = tuple(os.path.join(os.path.abspath(root), '') for root in (roots or [os.getcwd()]))
+
+        self.module_tracker = None
+        self.closures = {} # module name -> set of first-party source paths
+        self.digests = {} # source path -> sha1 of its contents
+        self.keys = {} # class path -> key, for the TestCases we've looked up
+
+    def is_first_party(self, module_name):
+        path = self.module_tracker.mtimes.get(module_name, (None, None))[0]
+        return path is not None and path.startswith(self.roots)
+
+    def source_closure(self, module_name):
+        """Return the source paths of a module and the first-party modules it transitively depends on."""
+        if self.module_tracker is None:
+            # By the time we're asked for keys, discovery has imported everything we'll run.
+            self.module_tracker = ModuleTracker()
+            self.module_tracker.snapshot()
+
+        if module_name not in self.closures:
+            paths = set()
+            seen = set()
+            pending = [module_name]
+            while pending:
+                name = pending.pop()
+                if name in seen:
+                    continue
+                seen.add(name)
+                path = source_path(sys.modules.get(name))
+                if path:
+                    paths.add(path)
+                pending.extend(dep for dep in self.module_tracker.dependencies(name) if self.is_first_party(dep))
+            self.closures[module_name] = paths
+        return self.closures[module_name]
+
+    def digest(self, path):
+        if path not in self.digests:
+            try:
+                with open(path, 'rb') as source_file:
+                    self.digests[path] = hashlib.sha1(source_file.read()).hexdigest()
+            except IOError:
+                self.digests[path] = None
+        return self.digests[path]
+
+    def key_for(self, test_case):
+        class_path = class_path_for(test_case)
+        key = hashlib.sha1()
+        key.update(self.key_data)
+        key.update(class_path)
+        for path in sorted(self.source_closure(test_case.__module__)):
+            key.update('\0%s\0%s' % (path, self.digest(path)))
+        self.keys[class_path] = key.hexdigest()
+        return self.keys[class_path]
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        """Return {method name: result dict} of the methods that passed under this key."""
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path) as entry_file:
+                entry = json.load(entry_file)
+        except (IOError, ValueError), e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                _log.warning("Ignoring unreadable result cache entry %s: %r", entry_path, e)
+            return {}
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, results):
+        """Add {method name: result dict} to what we know passed under this key."""
+        entry = self.get(key)
+        entry.update(results)
+        entry_path = self.entry_path(key)
+        try:
+            os.makedirs(os.path.dirname(entry_path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_path = '%s.%d.tmp' % (entry_path, os.getpid())
+        with open(tmp_path, 'w') as entry_file:
+            json.dump(entry, entry_file)
+        os.rename(tmp_path, entry_path)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size."""
+        entries = []
+        total_size = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                entry_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+                total_size += stat.st_size
+
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total_size -= size
+
+    def cached_result(self, result):
+        """Turn a stored result into one to report for this run."""
+        result = dict(result)
+        now = time.time()
+        result.update({
+            'cached': True,
+            'previous_run': None,
+            'start_time': now,
+            'end_time': now,
+            'run_time': 0.0,
+            'normalized_run_time': '0.00s',
+        })
+        return result
+
+
+class ResultCacheReporter(test_reporter.TestReporter):
+    """Stores the passing results of each TestCase we have a key for, unless one of its methods failed."""
+
+    def __init__(self, options, cache):
+        super(ResultCacheReporter, self).__init__(options)
+        self.cache = cache
+        self.passed = {} # class path -> {method name: result dict}
+        self.failed = set() # class paths
+
+    def test_complete(self, result):
+        if result.get('cached'):
+            return
+        class_path = '%s %s' % (result['method']['module'], result['method']['class'])
+        if class_path not in self.cache.keys:
+            return
+        if result['success'] and result['method']['fixture_type'] is None:
+            self.passed.setdefault(class_path, {})[result['method']['name']] = result
+        else:
+            self.failed.add(class_path)
+
+    def report(self):
+        try:
+            for class_path, results in self.passed.iteritems():
+                if class_path not in self.failed:
+                    self.cache.put(self.cache.keys[class_path], results)
+            self.cache.evict()
+        except (IOError, OSError), e:
+            _log.warning("Failed to update the result cache in %s: %r", self.cache.path, e)
+        return True
+
+# vim: set ts=4 sts=4 sw=4 et:
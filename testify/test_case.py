@@ -70,6 +70,30 @@ class TwistedFailureError(Exception):
     pass
 
 
+def _select_test_methods(owner, suites_include, suites_exclude, suites_require, name_overrides):
+    """Yield the test methods of owner (a TestCase, or a TestCase class) that the given suites and name overrides select."""
+    for member_name in dir(owner):
+        if not member_name.startswith("test"):
+            continue
+        member = getattr(owner, member_name)
+        if not inspect.ismethod(member):
+            continue
+        member_suites = getattr(member, '_suites', set()) | set(getattr(owner, '_suites', []))
+        # if there are any exclude suites, exclude methods under them
+        if suites_exclude and suites_exclude & member_suites:
+            continue
+        # if there are any include suites, only run methods in them
+        if suites_include and not (suites_include & member_suites):
+            continue
+        # if there are any require suites, only run methods in *all* of those suites
+        if suites_require and not ((suites_require & member_suites) == suites_require):
+            continue
+
+        # if there are any name overrides, only run the named methods
+        if name_overrides is None or member.__name__ in name_overrides:
+            yield member
+
+
 class MetaTestCase(type):
     """This base metaclass is used to collect each TestCase's decorated fixture methods at
     runtime.  It is implemented as a metaclass so we can determine the order in which
@@ -267,26 +291,22 @@ class TestCase(object):
         any of our exclude_suites.  If there are any include_suites, it will then further
         limit itself to test methods in those suites.
         """
-        for member_name in dir(self):
-            if not member_name.startswith("test"):
-                continue
-            member = getattr(self, member_name)
-            if not inspect.ismethod(member):
-                continue
-            member_suites = getattr(member, '_suites', set()) | set(getattr(self, '_suites', []))
-            # if there are any exclude suites, exclude methods under them
-            if self.__suites_exclude and self.__suites_exclude & member_suites:
-                continue
-            # if there are any include suites, only run methods in them
-            if self.__suites_include and not (self.__suites_include & member_suites):
-                continue
-            # if there are any require suites, only run methods in *all* of those suites
-            if self.__suites_require and not ((self.__suites_require & member_suites) == self.__suites_require):
-                continue
+        return _select_test_methods(self, self.__suites_include, self.__suites_exclude, self.__suites_require, self.__name_overrides)
+
+    @classmethod
+    def runnable_test_method_names(cls, suites_include=(), suites_exclude=(), suites_require=(), name_overrides=None):
+        """Return the names of the methods runnable_test_methods() would yield for an instance constructed with these
+        arguments, without constructing one.
 
-            # if there are any name overrides, only run the named methods
-            if self.__name_overrides is None or member.__name__ in self.__name_overrides:
-                yield member
+        Only methods on the class count, so this misses any that __init__ adds with _generate_test_method();
+        overrides_init() says whether that might be the case.
+        """
+        return [member.__name__ for member in _select_test_methods(cls, set(suites_include), set(suites_exclude), set(suites_require), name_overrides)]
+
+    @classmethod
+    def overrides_init(cls):
+        """Return whether a subclass of TestCase between here and cls defines __init__."""
+        return any('__init__' in vars(klass) for klass in cls.__mro__ if klass is not TestCase and issubclass(klass, TestCase))
 
     def run(self):
         """Delegator method encapsulating the flow for executing a TestCase instance"""
@@ -0,0 +1,282 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""A warm testify process that runs tests on request, skipping startup costs.
+
+`testify --daemon [test path]` loads the plugins, imports the given test path
+and listens on a unix socket. `testify` invocations with TESTIFY_DAEMON_SOCKET
+set send their command line to it instead of starting from scratch. For every
+request the daemon forks a child, which reloads any module whose source has
+changed since the daemon imported it, runs the command line with its output
+going straight back over the socket, and finishes with a fixed-size trailer
+giving its exit status. The trailer only counts as the last thing before the
+connection closes, so a run may print anything, trailer included.
+"""
+from __future__ import with_statement
+
+import errno
+import os
+import stat
+import struct
+import sys
+
+try:
+    import simplejson as json
+    _hush_pyflakes = [json]
+    del _hush_pyflakes
+except ImportError:
+    import json
+
+from testify import plugin_manifest
+from testify import test_discovery
+from testify.errors import TestifyError
+from testify.test_logger import _log
+from testify.utils.module_tracker import ModuleTracker
+
+DAEMON_SOCKET_ENV = 'TESTIFY_DAEMON_SOCKET'
+SOCKET_NAME = 'testify-daemon.sock'
+# Sent after the run's output: this magic, then the exit status.
+EXIT_MAGIC = '\0testify-exit:'
+EXIT_TRAILER = struct.Struct('>%dsi' % len(EXIT_MAGIC))
+READ_SIZE = 4096
+
+
+class DaemonError(TestifyError): pass
+
+
+def private_socket_dir():
+    """The per-user directory in /tmp we put the socket in when there's no $XDG_RUNTIME_DIR."""
+    return '/tmp/testify-%d' % os.getuid()
+
+
+def default_socket_path():
+    if os.environ.get(DAEMON_SOCKET_ENV):
+        return os.environ[DAEMON_SOCKET_ENV]
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or private_socket_dir(), SOCKET_NAME)
+
+
+def owned_by_us(path, file_type):
+    """Return whether path (not following symlinks) is of file_type (e.g. stat.S_IFSOCK) and belongs to us."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_IFMT(st.st_mode) == file_type and st.st_uid == os.getuid()
+
+
+def make_private_dir(path):
+    """Create path readable only by us, or check that it already is; raise DaemonError if it isn't."""
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise DaemonError("Couldn't create %s for the daemon's socket: %s" % (path, e))
+    if not owned_by_us(path, stat.S_IFDIR) or os.lstat(path).st_mode & 0077:
+        raise DaemonError("Refusing to put the daemon's socket in %s, since other users can get at it." % path)
+
+
+class TestDaemon(object):
+    def __init__(self, socket_path, plugin_modules, preload_test_path=None, poll_interval=0.5):
+        self.socket_path = socket_path
+        self.plugin_modules = plugin_modules
+        self.preload_test_path = preload_test_path
+        self.poll_interval = poll_interval
+
+        self.module_tracker = ModuleTracker()
+        self.children = set()
+        self.listener = None
+        self.shutting_down = False
+
+    def preload(self):
+        """Import our plugins and everything under our test path, so children start with them in memory."""
+        for plugin in self.plugin_modules:
+            if isinstance(plugin, plugin_manifest.LazyPlugin):
+                plugin.load()
+        if self.preload_test_path:
+            try:
+                for _ in test_discovery.discover(self.preload_test_path):
+                    pass
+            except test_discovery.DiscoveryError, e:
+                # Children will hit (and report) the same error; we just won't have it warm.
+                _log.error("Failed to preload %s: %s", self.preload_test_path, e)
+        self.module_tracker.snapshot()
+
+    def listen(self):
+        import socket
+        if os.path.dirname(self.socket_path) == private_socket_dir():
+            make_private_dir(private_socket_dir())
+        if os.path.lexists(self.socket_path):
+            # Only replace a socket left behind by an earlier daemon of ours, not whatever someone else put there.
+            if not owned_by_us(self.socket_path, stat.S_IFSOCK):
+                raise DaemonError("Refusing to replace %s, which isn't a socket of ours." % self.socket_path)
+            os.remove(self.socket_path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(16)
+
+    def serve_forever(self):
+        import select
+        self.preload()
+        self.listen()
+        _log.info("testify daemon listening on %s", self.socket_path)
+        try:
+            while not self.shutting_down:
+                self.reap_children()
+                try:
+                    readable, _, _ = select.select([self.listener], [], [], self.poll_interval)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if readable:
+                    conn, _ = self.listener.accept()
+                    self.handle(conn)
+        finally:
+            self.listener.close()
+            if owned_by_us(self.socket_path, stat.S_IFSOCK):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        self.shutting_down = True
+
+    def reap_children(self):
+        for pid in list(self.children):
+            try:
+                reaped_pid, _ = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                reaped_pid = pid
+            if reaped_pid:
+                self.children.discard(pid)
+
+    def handle(self, conn):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            conn.close()
+            self.children.add(pid)
+            return
+
+        exit_code = 1
+        try:
+            self.listener.close()
+            exit_code = self.run_request(conn)
+        except BaseException, e:
+            try:
+                _log.error("testify daemon child failed: %r", e)
+            except Exception:
+                pass
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                conn.sendall(EXIT_TRAILER.pack(EXIT_MAGIC, exit_code))
+                conn.close()
+            finally:
+                os._exit(0)
+
+    def run_request(self, conn):
+        """In the forked child: read the request off conn, run it with our output going to conn, and return its exit code."""
+        request = ''
+        while not request.endswith('\n'):
+            data = conn.recv(READ_SIZE)
+            if not data:
+                return 1
+            request += data
+        request = json.loads(request)
+
+        os.chdir(request['cwd'])
+        if request['cwd'] not in sys.path:
+            sys.path.insert(0, request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+
+        reloaded, failed = self.module_tracker.reload_changed()
+        for name, e in failed:
+            _log.error("Failed to reload %s: %r", name, e)
+        if reloaded:
+            _log.info("Reloaded changed modules: %s", ', '.join(reloaded))
+
+        from testify.test_program import TestProgram
+        try:
+            TestProgram(request['args'], plugin_modules=self.plugin_modules)
+        except SystemExit, e:
+            if e.code is None:
+                return 0
+            if isinstance(e.code, (int, bool)):
+                return int(e.code)
+            print >>sys.stderr, e.code
+            return 1
+        return 0
+
+
+def run_via_daemon(socket_path, args, stream=None):
+    """Run the given command line on the daemon at socket_path, copying its output to stream.
+
+    Returns the run's exit code, or None if we couldn't reach a daemon.
+    """
+    # Imported here rather than at the top, since every testify run imports this module to check for a daemon.
+    import socket
+
+    stream = stream or sys.stdout
+    if not owned_by_us(socket_path, stat.S_IFSOCK):
+        # Whoever is listening there would get our environment.
+        _log.debug("Not using %s as a testify daemon, since it isn't a socket of ours.", socket_path)
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except socket.error, e:
+        _log.debug("Couldn't connect to testify daemon at %s: %r", socket_path, e)
+        conn.close()
+        return None
+
+    # The last EXIT_TRAILER.size bytes we've read, which we hold back in case they turn out to be the trailer.
+    held_back = ''
+    try:
+        conn.sendall(json.dumps({
+            'args': args,
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }) + '\n')
+
+        while True:
+            data = conn.recv(READ_SIZE)
+            if not data:
+                break
+            held_back += data
+            if len(held_back) > EXIT_TRAILER.size:
+                stream.write(held_back[:-EXIT_TRAILER.size])
+                stream.flush()
+                held_back = held_back[-EXIT_TRAILER.size:]
+    finally:
+        conn.close()
+
+    if len(held_back) == EXIT_TRAILER.size:
+        magic, exit_status = EXIT_TRAILER.unpack(held_back)
+        if magic == EXIT_MAGIC:
+            return exit_status
+    stream.write(held_back)
+    stream.flush()
+    print >>sys.stderr, "The testify daemon's worker died before finishing the run."
+    return 1
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,91 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Historical test durations, for scheduling the longest tests first.
+
+Durations are kept as a dict of (class_path, method) -> run time in seconds,
+and can come from a JSON result log (as written by --json-results) or from the
+database the sql_reporter plugin reports into.
+"""
+from __future__ import with_statement
+
+import heapq
+
+try:
+    import simplejson as json
+    _hush_pyflakes = [json]
+    del _hush_pyflakes
+except ImportError:
+    import json
+
+
+def load_json_durations(path):
+    """Return the average run time of each test method in a JSON result log, one result dict per line.
+
+    Fixture results, cached results and lines we can't parse are skipped.
+    """
+    totals = {}
+    with open(path) as log_file:
+        for line in log_file:
+            try:
+                result = json.loads(line)
+                method = result['method']
+                run_time = result['run_time']
+            except (ValueError, KeyError, TypeError):
+                # "RUN COMPLETE", or a line torn by a runner that died mid-write.
+                continue
+            if method.get('fixture_type') or result.get('cached') or run_time is None:
+                continue
+            key = ('%s %s' % (method['module'], method['class']), method['name'])
+            total, count = totals.get(key, (0.0, 0))
+            totals[key] = (total + run_time, count + 1)
+    return dict((key, total / count) for key, (total, count) in totals.iteritems())
+
+
+def load_db_durations(db_url):
+    """Return the average run time of each test method reported into the sql_reporter database at db_url."""
+    # sqlalchemy is only needed (and imported) if we're asked to read a database.
+    import sqlalchemy as SA
+    from testify.plugins import sql_reporter
+
+    engine = SA.create_engine(db_url, poolclass=SA.pool.NullPool)
+    conn = engine.connect()
+    try:
+        return sql_reporter.load_durations(conn)
+    finally:
+        conn.close()
+
+
+def estimate(durations, class_path, methods):
+    """Return the total duration of the given methods of a class, or None if we don't know any of them."""
+    known = [durations[(class_path, method)] for method in methods if (class_path, method) in durations]
+    if not known:
+        return None
+    return sum(known)
+
+
+def predict_wall_time(estimates, runner_count, busy=()):
+    """Return how long it should take runner_count runners to work through estimates, handed out in order.
+
+    Each estimate goes to whichever runner frees up first, as it does on the server. busy is how long each of the
+    runners that are already running something has left to go.
+    """
+    idle_count = max(runner_count, len(busy), 1) - len(busy)
+    finish_times = [0.0] * idle_count + sorted(busy) # A sorted list is already a heap.
+    for seconds in estimates:
+        heapq.heapreplace(finish_times, finish_times[0] + seconds)
+    return max(finish_times)
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,221 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Local run history, and test case ordering based on it.
+
+The history file is append-only: every completed test method adds one line of
+the form
+
+    <module> <class>\t<method>\t<1 if passed else 0>\t<run time in seconds>
+
+Later lines win, so the file holds the last outcome and duration of each test
+method. Writers take an exclusive flock for each append so several runners can
+share one file, and the file is compacted in place (under the same lock) once
+it grows well past the number of distinct methods it describes.
+"""
+from __future__ import with_statement
+
+import errno
+import fcntl
+import os
+
+from testify import test_reporter
+from testify.test_logger import _log
+
+DEFAULT_HISTORY_FILE = '.testify_history'
+
+ORDER_FAILED_FIRST = 'failed-first'
+ORDER_SLOWEST_FIRST = 'slowest-first'
+ORDER_FASTEST_FIRST = 'fastest-first'
+ORDER_RANDOM = 'random'
+
+HISTORY_ORDERS = (ORDER_FAILED_FIRST, ORDER_SLOWEST_FIRST, ORDER_FASTEST_FIRST)
+
+# Compact once the file holds this many times more lines than distinct methods.
+COMPACTION_RATIO = 4
+
+
+def parse_order(order):
+    """Split an --order value into (order_name, seed).
+
+    seed is only set for random:<seed>. Raises ValueError for anything else we don't understand.
+    """
+    name, _, seed = order.partition(':')
+    if name == ORDER_RANDOM:
+        if not seed:
+            raise ValueError("random order requires a seed, e.g. random:1234")
+        try:
+            return name, int(seed)
+        except ValueError:
+            raise ValueError("Invalid random seed %r" % seed)
+    if name in HISTORY_ORDERS and not seed:
+        return name, None
+    raise ValueError("Unknown test order %r; expected one of %s or random:<seed>" % (order, ', '.join(HISTORY_ORDERS)))
+
+
+def order_needs_history(order):
+    return parse_order(order)[0] in HISTORY_ORDERS
+
+
+class TestHistory(object):
+    """The last outcome and run time of every test method we've seen, backed by an append-only file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+
+    def _parse_line(self, line):
+        try:
+            class_path, method, success, run_time = line.rstrip('\n').split('\t')
+            return (class_path, method), (success == '1', float(run_time))
+        except ValueError:
+            # A torn or otherwise garbled line; skip it rather than lose the whole history.
+            return None
+
+    def _read(self, history_file):
+        entries = {}
+        line_count = 0
+        for line in history_file:
+            line_count += 1
+            parsed = self._parse_line(line)
+            if parsed:
+                entries[parsed[0]] = parsed[1]
+        return entries, line_count
+
+    def load(self):
+        """Return a dict of (class_path, method) -> (success, run_time), reading the file only once."""
+        if self._entries is None:
+            try:
+                with open(self.path) as history_file:
+                    fcntl.flock(history_file, fcntl.LOCK_SH)
+                    self._entries, _ = self._read(history_file)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._entries = {}
+        return self._entries
+
+    def record(self, results):
+        """Append the outcome of each of the given (complete) test result dicts."""
+        lines = []
+        for result in results:
+            if result['method']['fixture_type'] or result['run_time'] is None:
+                continue
+            class_path = '%s %s' % (result['method']['module'], result['method']['class'])
+            lines.append('%s\t%s\t%d\t%.3f\n' % (class_path, result['method']['name'], bool(result['success']), result['run_time']))
+        if not lines:
+            return
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, ''.join(lines))
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        """Rewrite the file to hold one line per method, if it has grown enough to be worth it."""
+        try:
+            history_file = open(self.path, 'r+')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        with history_file:
+            fcntl.flock(history_file, fcntl.LOCK_EX)
+            entries, line_count = self._read(history_file)
+            if line_count <= COMPACTION_RATIO * max(len(entries), 1):
+                return
+            history_file.seek(0)
+            history_file.truncate()
+            for (class_path, method), (success, run_time) in sorted(entries.iteritems()):
+                history_file.write('%s\t%s\t%d\t%.3f\n' % (class_path, method, success, run_time))
+        self._entries = entries
+
+    def class_stats(self, class_path, methods):
+        """Return (any_failed, total_run_time, known) for the given methods of a class."""
+        entries = self.load()
+        any_failed = False
+        total_run_time = 0.0
+        known = False
+        for method in methods:
+            entry = entries.get((class_path, method))
+            if entry:
+                known = True
+                any_failed = any_failed or not entry[0]
+                total_run_time += entry[1]
+        return any_failed, total_run_time, known
+
+
+def describe_test_case(test_case):
+    """Return (class_path, method names) for a TestCase instance."""
+    return '%s %s' % (test_case.__module__, test_case.__class__.__name__), [method.__name__ for method in test_case.runnable_test_methods()]
+
+
+def order_test_cases(test_cases, order, history=None, describe=describe_test_case):
+    """Return the given test cases in the requested order: TestCase instances, or anything describe() turns into
+    (class_path, method names).
+
+    Orders based on history are stable: test cases with the same key (and those we know nothing about) keep
+    their discovery order, and unknown test cases go after known ones.
+    """
+    name, seed = parse_order(order)
+    test_cases = list(test_cases)
+
+    if name == ORDER_RANDOM:
+        import random
+        random.Random(seed).shuffle(test_cases)
+        return test_cases
+
+    def stats(test_case):
+        class_path, methods = describe(test_case)
+        return history.class_stats(class_path, methods)
+
+    def key(test_case):
+        any_failed, total_run_time, known = stats(test_case)
+        if name == ORDER_FAILED_FIRST:
+            return (not known, not any_failed)
+        elif name == ORDER_SLOWEST_FIRST:
+            return (not known, -total_run_time)
+        else:
+            return (not known, total_run_time)
+
+    return sorted(test_cases, key=key)
+
+
+class TestHistoryReporter(test_reporter.TestReporter):
+    """Appends each completed test method to a TestHistory as it finishes."""
+
+    def __init__(self, options, history):
+        super(TestHistoryReporter, self).__init__(options)
+        self.history = history
+
+    def test_complete(self, result):
+        if result.get('cached'):
+            # It didn't run, so it tells us nothing new (and its run time is meaningless).
+            return
+        try:
+            self.history.record([result])
+        except (IOError, OSError), e:
+            _log.warning("Failed to record test history in %s: %r", self.history.path, e)
+
+    def report(self):
+        try:
+            self.history.compact()
+        except (IOError, OSError), e:
+            _log.warning("Failed to compact test history in %s: %r", self.history.path, e)
+        return True
+
+# vim: set ts=4 sts=4 sw=4 et:
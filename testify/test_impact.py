@@ -0,0 +1,233 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Select the tests affected by a change, using a map of which lines each test ran.
+
+The coverage map is recorded by the coverage_map plugin (--record-coverage-map)
+and stored as JSON:
+
+    {
+        "files": ["path/to/module.py", ...],
+        "tests": {
+            "<module> <class>": {
+                "<method>": {"<file index>": "1-4,9,12-13", ...},
+                "": {...}
+            }
+        }
+    }
+
+Paths are relative to the directory the map was recorded from. The "" entry
+holds lines run by class-level fixtures, which affect every method of the
+class.
+
+Given a unified diff (or a list of changed files), --affected-by runs only the
+test methods whose recorded lines were changed, plus any test cases and methods
+the map doesn't know about yet.
+"""
+from __future__ import with_statement
+
+import errno
+import os
+import re
+
+try:
+    import simplejson as json
+    _hush_pyflakes = [json]
+    del _hush_pyflakes
+except ImportError:
+    import json
+
+DEFAULT_COVERAGE_MAP_FILE = '.testify_coverage_map'
+
+# Key for lines run outside of any test method (class_setup and friends).
+CLASS_LEVEL = ''
+
+# Lines of a file we have no line information for, i.e. the whole file changed.
+WHOLE_FILE = None
+
+_hunk_header_re = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@')
+
+
+def encode_lines(lines):
+    """Turn a set of line numbers into a compact string like '1-4,9,12-13'."""
+    ranges = []
+    for line in sorted(lines):
+        if ranges and ranges[-1][1] == line - 1:
+            ranges[-1][1] = line
+        else:
+            ranges.append([line, line])
+    return ','.join(('%d' % start) if start == end else ('%d-%d' % (start, end)) for start, end in ranges)
+
+
+def decode_lines(encoded):
+    lines = set()
+    for part in encoded.split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        lines.update(xrange(int(start), int(end or start) + 1))
+    return lines
+
+
+def normalize_path(path):
+    """Paths under the current directory are stored relative to it; anything else is absolute."""
+    path = os.path.abspath(path)
+    relative_path = os.path.relpath(path)
+    return path if relative_path.startswith(os.pardir) else relative_path
+
+
+def _strip_diff_prefix(path):
+    path = path.split('\t')[0].strip()
+    if path.startswith(('a/', 'b/')):
+        path = path[2:]
+    return path
+
+
+def parse_changes(text):
+    """Parse a unified diff, or a list of file names, into {path: set of changed (old) line numbers or WHOLE_FILE}.
+
+    We care about line numbers in the old version of each file, since that's what the coverage map was recorded
+    against. Removed lines count as changed; lines added in between unchanged ones mark the old lines on either
+    side of them.
+    """
+    lines = text.splitlines()
+    if not any(line.startswith('--- ') for line in lines):
+        return dict((normalize_path(line.strip()), WHOLE_FILE) for line in lines if line.strip())
+
+    changes = {}
+    path = None
+    old_line = None
+    after_removal = False
+    for line in lines:
+        if line.startswith('--- '):
+            old_path = _strip_diff_prefix(line[4:])
+            path = None if old_path == '/dev/null' else normalize_path(old_path)
+            if path is not None:
+                changes.setdefault(path, set())
+            old_line = None
+            continue
+        if line.startswith('+++ '):
+            continue
+        match = _hunk_header_re.match(line)
+        if match:
+            old_line = int(match.group(1))
+            # A hunk that only adds lines at the top of the file has an old start of 0.
+            old_line = max(old_line, 1) if match.group(2) != '0' else old_line + 1
+            continue
+        if path is None or old_line is None:
+            continue
+        if line.startswith('-'):
+            changes[path].add(old_line)
+            old_line += 1
+            after_removal = True
+        elif line.startswith('+'):
+            # Lines replacing removed ones are covered by the removal; pure insertions touch their neighbours.
+            if not after_removal:
+                changes[path].update((old_line - 1, old_line))
+        elif line.startswith(' ') or not line:
+            old_line += 1
+            after_removal = False
+        else:
+            # '\ No newline at end of file', or the next file's header.
+            after_removal = False
+    return changes
+
+
+class ImpactSelection(object):
+    """The result of looking up a set of changes in a CoverageMap."""
+
+    def __init__(self, known_methods, affected_methods):
+        self.known_methods = known_methods # class_path -> set of method names recorded in the map
+        self.affected_methods = affected_methods # class_path -> set of method names, or None for all of them
+
+    def filter_methods(self, class_path, method_names):
+        """Return the methods of a test case to run: the affected ones, and ones the map doesn't know about."""
+        if class_path not in self.known_methods:
+            return list(method_names)
+        affected = self.affected_methods.get(class_path, set())
+        known = self.known_methods[class_path]
+        return [name for name in method_names if affected is None or name in affected or name not in known]
+
+
+class CoverageMap(object):
+    def __init__(self, path):
+        self.path = path
+        self.files = []
+        self.file_indexes = {}
+        self.tests = {}
+
+    def load(self):
+        try:
+            with open(self.path) as map_file:
+                data = json.load(map_file)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self
+        self.files = data['files']
+        self.file_indexes = dict((path, index) for index, path in enumerate(self.files))
+        self.tests = data['tests']
+        return self
+
+    def save(self):
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as map_file:
+            json.dump({'files': self.files, 'tests': self.tests}, map_file, separators=(',', ':'))
+        os.rename(tmp_path, self.path)
+
+    def _file_index(self, path):
+        path = normalize_path(path)
+        index = self.file_indexes.get(path)
+        if index is None:
+            index = self.file_indexes[path] = len(self.files)
+            self.files.append(path)
+        return index
+
+    def record(self, class_path, method, lines_by_file):
+        """Replace what we know about one method (or CLASS_LEVEL) with {filename: set of line numbers}."""
+        self.tests.setdefault(class_path, {})[method] = dict(
+            (str(self._file_index(filename)), encode_lines(lines))
+            for filename, lines in lines_by_file.iteritems()
+        )
+
+    def affected(self, changes):
+        """Look up the output of parse_changes() and return an ImpactSelection."""
+        changed_indexes = {}
+        for path, lines in changes.iteritems():
+            index = self.file_indexes.get(path)
+            if index is not None:
+                changed_indexes[str(index)] = lines
+
+        def touches(encoded_files):
+            for index, encoded_lines in encoded_files.iteritems():
+                if index in changed_indexes:
+                    changed_lines = changed_indexes[index]
+                    if changed_lines is WHOLE_FILE or changed_lines & decode_lines(encoded_lines):
+                        return True
+            return False
+
+        known_methods = {}
+        affected_methods = {}
+        for class_path, methods in self.tests.iteritems():
+            known_methods[class_path] = set(method for method in methods if method != CLASS_LEVEL)
+            if touches(methods.get(CLASS_LEVEL, {})):
+                affected_methods[class_path] = None
+                continue
+            affected = set(method for method, encoded_files in methods.iteritems() if method != CLASS_LEVEL and touches(encoded_files))
+            if affected:
+                affected_methods[class_path] = affected
+        return ImpactSelection(known_methods, affected_methods)
+
+# vim: set ts=4 sts=4 sw=4 et:
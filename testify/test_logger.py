@@ -19,7 +19,6 @@ __testify = 1
 import collections
 import logging
 import operator
-import subprocess
 import sys
 
 from testify import test_reporter
@@ -118,18 +117,29 @@ class TextTestLogger(TestLoggerBase):
     def __init__(self, options, stream=sys.stdout):
         super(TextTestLogger, self).__init__(options, stream)
 
+        self._use_color = None
+
+    @property
+    def use_color(self):
+        """Whether our terminal supports color. Worked out the first time we need to know, since it runs a command."""
+        if self._use_color is None:
+            self._use_color = self._detect_color_support()
+        return self._use_color
+
+    def _detect_color_support(self):
         # Checking for color support isn't as fun as we might hope.  We're
         # going to use the command 'tput colors' to get a list of colors
         # supported by the shell. But of course we if this fails terribly,
         # we'll want to just fall back to no colors
-        self.use_color = False
         if sys.stdin.isatty():
             try:
+                import subprocess
                 output = subprocess.Popen(["tput", "colors"], stdout=subprocess.PIPE).communicate()[0]
                 if int(output.strip()) >= 8:
-                    self.use_color = True
+                    return True
             except Exception, e:
                 _log.debug("Failed to find color support: %r", e)
+        return False
 
     def write(self, message):
         """Write a message to the output stream, no trailing newline"""
@@ -164,7 +174,9 @@ class TextTestLogger(TestLoggerBase):
     def report_test_result(self, result):
         if self.options.verbosity > VERBOSITY_SILENT:
             if result['success']:
-                if result['previous_run']:
+                if result.get('cached'):
+                    status = "cached"
+                elif result['previous_run']:
                     status = "flaky"
                 else:
                     status = "success"
@@ -179,6 +191,7 @@ class TextTestLogger(TestLoggerBase):
 
             status_description, status_letter, color = {
                 "success" : ('ok', '.', self.GREEN),
+                "cached" : ('cached', 'c', self.CYAN),
                 "flaky" : ('flaky', '!', self.YELLOW),
                 "fail" : ('FAIL', 'F', self.RED),
                 "error" : ('ERROR', 'E', self.RED),
@@ -248,6 +261,10 @@ class TextTestLogger(TestLoggerBase):
 
         failed_string = self._colorize("%d failed" % len(failed), (self.RED if len(failed) else None))
 
+        cached_count = len([result for result in successful if result.get('cached')])
+        if cached_count:
+            passed_string += " (%d cached)" % cached_count
+
         self.write("%s, %s.  " % (passed_string, failed_string))
 
         total_test_time = reduce(
@@ -259,6 +276,8 @@ class TextTestLogger(TestLoggerBase):
 
 
 class ColorlessTextTestLogger(TextTestLogger):
+    use_color = False
+
     def _colorize(self, message, color=None):
         return message
 
@@ -16,13 +16,17 @@ from __future__ import with_statement
 from collections import defaultdict
 from optparse import OptionParser
 import os
-import pwd
-import socket
 import sys
 import logging
 import imp
 
 import testify
+from testify import isolation
+from testify import plugin_manifest
+from testify import test_cache
+from testify import test_daemon
+from testify import test_history
+from testify import test_impact
 from testify import test_logger
 from testify.test_runner import TestRunner
 
@@ -57,7 +61,8 @@ def load_plugins():
 
     We load plugin modules based on directories provided to us by the environment, as well as a default in our own folder.
 
-    Returns a list of module objects
+    Returns a list of module objects, and plugin_manifest.LazyPlugins standing in for plugins that declare a manifest;
+    parse_test_runner_command_line_args() replaces those with the modules a run actually needs.
     """
     # This function is a little wacky, doesn't seem like we SHOULD have to do all this just to get the behavior we want.
     # The idea will be to check out the directory contents and pick up any files that seem to match what python knows how to
@@ -81,6 +86,11 @@ def load_plugins():
                 full_file_path = os.path.join(plugin_path, file_name)
                 mod_name, suffix = os.path.splitext(file_name)
 
+                manifest = plugin_manifest.read_manifest(full_file_path)
+                if manifest is not None:
+                    plugin_modules.append(plugin_manifest.LazyPlugin(mod_name, full_file_path, manifest))
+                    continue
+
                 with open(full_file_path, "r") as file:
                     try:
                         plugin_modules.append(imp.load_module(mod_name, file, full_file_path, suffix_map.get(suffix)))
@@ -124,20 +134,58 @@ def parse_test_runner_command_line_args(plugin_modules, args):
     parser.add_option('--print-log', action="append", dest="print_loggers", type="string", default=[], help="Direct logging output for these loggers to the console")
 
     parser.add_option('--serve', action="store", dest="serve_port", type="int", default=None, help="Run in server mode, listening on this port for testify clients.")
-    parser.add_option('--connect', action="store", dest="connect_addr", type="string", default=None, metavar="HOST:PORT", help="Connect to a testify server (testify --serve) at this HOST:PORT")
+    parser.add_option('--connect', action="store", dest="connect_addr", type="string", default=None, metavar="HOST:PORT", help="Connect to a testify server (testify --serve) at this HOST:PORT, or with --transport binary, at this unix socket path (testify --serve-socket).")
+    parser.add_option('--serve-socket', action="store", dest="serve_socket", type="string", default=None, metavar="PATH", help="Run in server mode, listening on a unix socket at this path for testify clients (which --connect to the same path). Implies --transport binary.")
+    parser.add_option('--relay', action="store", dest="relay_addr", type="string", default=None, metavar="HOST:PORT", help="With --serve or --serve-socket, relay for the root server at HOST:PORT (or with --transport binary, this unix socket path) rather than discovering tests: lease batches of tests from it, hand them out to runners that --connect to us, and forward their results to it, over the same --transport we serve. Spreads a run with many runners across several servers.")
+    parser.add_option('--relay-lease-size', action="store", dest="relay_lease_size", type="int", default=20, metavar="N", help="With --relay, lease up to this many test cases from the root server at a time. Defaults to %default.")
+    parser.add_option('--transport', action="store", dest="transport", type="choice", choices=['http', 'binary'], default='http', help="How --serve and --connect talk to each other: JSON over HTTP, or a compact binary protocol over TCP or a unix socket. Both ends must use the same transport. Defaults to %default.")
     parser.add_option('--revision', action="store", dest="revision", type="string", default=None, help="With --serve, refuses clients that identify with a different or no revision. In client mode, sends the revision number to the server for verification.")
     parser.add_option('--retry-limit', action="store", dest="retry_limit", type="int", default=60, help="Number of times to try connecting to the server before exiting.")
     parser.add_option('--retry-interval', action="store", dest="retry_interval", type="int", default=2, help="Interval, in seconds, between trying to connect to the server.")
     parser.add_option('--reconnect-retry-limit', action="store", dest="reconnect_retry_limit", type="int", default=5, help="Number of times to try reconnecting to the server before exiting if we have previously connected.")
+    parser.add_option('--batch-size', action="store", dest="batch_size", type="int", default=1, help="With --connect, ask the server for up to this many test cases at a time.")
+    parser.add_option('--batch-seconds', action="store", dest="batch_seconds", type="float", default=None, help="With --connect and --batch-size, stop adding test cases to a batch once they add up to this many seconds of run time, as estimated by the server's --history-file.")
+    parser.add_option('--prefetch', action="store_true", dest="prefetch", default=False, help="With --connect, ask for the next batch of test cases while running the current one.")
+    parser.add_option('--import-ahead', action="store", dest="import_ahead", type="int", default=0, metavar="N", help="With --connect, import the modules of test cases later in the batch, and of up to N test cases the server expects to hand out later, in the background while running the current one.")
+    parser.add_option('--slots', action="store", dest="slots", type="int", default=1, metavar="N", help="With --connect, run up to N test cases at a time, each in a process forked from this one (so they share what it has imported), asking the server for another whenever one finishes. Results and heartbeats for all of them go back over this runner's connections. Defaults to %default.")
+
+    parser.add_option('--order', action="store", dest="test_order", type="string", default=None, metavar="ORDER", help="Run test cases in this order instead of discovery order: failed-first, slowest-first or fastest-first (based on the history file), or random:<seed>.")
+    parser.add_option('--history-file', action="store", dest="history_file", type="string", default=None, help="Record the outcome and run time of each test method in this file, for use by --order. Defaults to %s when --order needs history." % test_history.DEFAULT_HISTORY_FILE)
+
+    parser.add_option('--isolate', action="store", dest="isolate", type="choice", choices=[isolation.ISOLATE_CLASS], default=None, help="Run each test case in its own forked process, so a crash or leak only affects that test case. Only 'class' is supported.")
+    parser.add_option('--isolate-memory-limit', action="store", dest="isolate_memory_limit", type="int", default=None, metavar="MB", help="With --isolate or --slots, limit the address space of each test case's process to this many megabytes.")
+    parser.add_option('--isolate-cpu-limit', action="store", dest="isolate_cpu_limit", type="int", default=None, metavar="SECONDS", help="With --isolate or --slots, limit the CPU time of each test case's process to this many seconds.")
+
+    parser.add_option('--daemon', action="store_true", dest="daemon", default=False, help="Load plugins and import the test path (if given), then wait for testify runs on --daemon-socket and fork a warm process for each. Run testify with %s set to the socket path to use it." % test_daemon.DAEMON_SOCKET_ENV)
+    parser.add_option('--daemon-socket', action="store", dest="daemon_socket", type="string", default=None, metavar="PATH", help="With --daemon, the unix socket to listen on. Defaults to $%s, or %s in $XDG_RUNTIME_DIR, or in a directory in /tmp that only you can get at." % (test_daemon.DAEMON_SOCKET_ENV, test_daemon.SOCKET_NAME))
+
+    parser.add_option('--watch', action="store_true", dest="watch", default=False, help="After running the tests, watch for changes to source files and rerun the test modules affected by each change.")
+    parser.add_option('--watch-path', action="append", dest="watch_paths", type="string", default=[], metavar="PATH", help="With --watch, a source root to watch for changes. May be passed multiple times. Defaults to the current directory.")
+
+    parser.add_option('--affected-by', action="store", dest="affected_by", type="string", default=None, metavar="DIFF_OR_FILE_LIST", help="Only run the test methods that ran lines changed by this unified diff (or, for a plain list of files, any line of them), according to the --coverage-map file. '-' reads from stdin. Tests the map doesn't know about always run.")
+    parser.add_option('--coverage-map', action="store", dest="coverage_map", type="string", default=test_impact.DEFAULT_COVERAGE_MAP_FILE, metavar="FILE", help="The map of lines run by each test method, used by --affected-by and written by --record-coverage-map. Defaults to %default.")
+
+    parser.add_option('--result-cache', action="store", dest="result_cache_dir", type="string", default=None, metavar="DIR", help="Keep passing results in this directory, keyed on the source of each test case's module and the first-party modules it depends on, and report test methods that passed with the same key as cached instead of running them.")
+    parser.add_option('--result-cache-size', action="store", dest="result_cache_size", type="int", default=test_cache.DEFAULT_MAX_SIZE / (1024 * 1024), metavar="MB", help="With --result-cache, remove the least recently used results once the cache grows past this many megabytes. Defaults to %default.")
+    parser.add_option('--result-cache-env', action="append", dest="result_cache_env", type="string", default=[], metavar="VAR", help="With --result-cache, include this environment variable in the cache key. May be passed multiple times.")
 
     parser.add_option('--failure-limit', action="store", dest="failure_limit", type="int", default=None, help="Quit after this many test failures.")
     parser.add_option('--runner-timeout', action="store", dest="runner_timeout", type="int", default=300, help="How long to wait to wait for activity from a test runner before requeuing the tests it has checked out.")
+    parser.add_option('--heartbeat-timeout', action="store", dest="heartbeat_timeout", type="float", default=30.0, metavar="SECONDS", help="With --serve, requeue the tests of a runner that sends heartbeats (see --heartbeat-interval) once we've gone this long without one. Runners that don't send them get --runner-timeout. Defaults to %default.")
+    parser.add_option('--hang-factor', action="store", dest="hang_factor", type="float", default=10.0, metavar="N", help="With --serve, requeue the tests of a runner whose heartbeats say it has been running one test method for N times as long as the method usually takes (according to the history file or --durations-json), or at least --heartbeat-timeout. Methods with no history get --runner-timeout. Defaults to %default.")
     parser.add_option('--server-timeout', action="store", dest="server_timeout", type="int", default=300, help="How long to wait after the last activity from any test runner before shutting down.")
+    parser.add_option('--split-class', action="append", dest="split_classes", type="string", default=[], metavar="CLASS", help="With --serve, hand out the methods of this test case (given as 'module Class' or just Class) in chunks that different runners can run at the same time. May be passed multiple times.")
+    parser.add_option('--split-classes-over', action="store", dest="split_seconds", type="float", default=None, metavar="SECONDS", help="With --serve, split test cases whose methods took more than this many seconds in total (according to the history file) into chunks of about this many seconds each.")
+    parser.add_option('--durations-json', action="store", dest="durations_json", type="string", default=None, metavar="FILE", help="With --serve, hand out the longest test cases first, going by the run times in this JSON result log (as written by --json-results).")
+    parser.add_option('--journal', action="store", dest="journal", type="string", default=None, metavar="FILE", help="With --serve, record what the server hands out and gets back in FILE, so that --resume can pick the run up if the server dies.")
+    parser.add_option('--resume', action="store", dest="resume", type="string", default=None, metavar="FILE", help="With --serve, pick up the run journaled in FILE (see --journal) instead of discovering tests: rerun only what it hadn't finished, and keep journaling to FILE.")
+    parser.add_option('--reporter-queue-size', action="store", dest="reporter_queue_size", type="int", default=1000, metavar="N", help="With --serve, let up to this many results queue up for the reporters (which run on a thread of their own) before handling runners waits for them. Defaults to %default.")
+    parser.add_option('--durations-db-url', action="store", dest="durations_db_url", type="string", default=None, metavar="URL", help="With --serve, hand out the longest test cases first, going by the run times in the database at this URL (as written by --reporting-db-url).")
 
     parser.add_option('--server-shutdown-delay', action='store', dest='shutdown_delay_for_connection_close', type="float", default=0.01, help="How long to wait (in seconds) for data to finish writing to sockets before shutting down the server.")
     parser.add_option('--server-shutdown-delay-outstanding-runners', action='store', dest='shutdown_delay_for_outstanding_runners', type='int', default=5, help="How long to wait (in seconds) for all clients to check for new tests before shutting down the server.")
 
-    parser.add_option('--runner-id', action="store", dest="runner_id", type="string", default="%s-%d" % (socket.gethostname(), os.getpid()), help="With --connect, an identity passed to the server on each request. Passed to the server's test reporters. Defaults to <HOST>-<PID>.")
+    parser.add_option('--runner-id', action="store", dest="runner_id", type="string", default=None, help="With --connect or --relay, an identity passed to the server on each request. Passed to the server's test reporters. Defaults to <HOST>-<PID>.")
 
     parser.add_option('--replay-json', action="store", dest="replay_json", type="string", default=None, help="Instead of discovering and running tests, read a file with one JSON-encoded test result dictionary per line, and report each line to test reporters as if we had just run that test.")
     parser.add_option('--replay-json-inline', action="append", dest="replay_json_inline", type="string", metavar="JSON_OBJECT", help="Similar to --replay-json, but allows result objects to be passed on the command line. May be passed multiple times. If combined with --replay-json, inline results get reported first.")
@@ -150,14 +198,81 @@ def parse_test_runner_command_line_args(plugin_modules, args):
             plugin.add_command_line_options(parser)
 
     (options, args) = parser.parse_args(args)
-    if len(args) < 1 and not options.connect_addr:
-        parser.error("Test path required unless --connect specified.")
+    if len(args) < 1 and not (options.connect_addr or options.daemon or options.resume or options.relay_addr):
+        parser.error("Test path required unless --connect, --daemon, --relay or --resume specified.")
+
+    if (options.journal or options.resume) and not (options.serve_port or options.serve_socket):
+        parser.error("--journal and --resume require --serve or --serve-socket.")
+
+    if options.relay_addr and not (options.serve_port or options.serve_socket):
+        parser.error("--relay requires --serve or --serve-socket.")
+
+    if options.relay_addr and (options.journal or options.resume):
+        parser.error("--relay can't be used with --journal or --resume; the root server keeps the journal.")
 
-    if options.connect_addr and options.serve_port:
+    if options.relay_lease_size < 1:
+        parser.error("--relay-lease-size must be at least 1.")
+
+    if options.serve_socket:
+        options.transport = 'binary'
+
+    if options.connect_addr and (options.serve_port or options.serve_socket):
         parser.error("--serve and --connect are mutually exclusive.")
 
+    if options.batch_size < 1:
+        parser.error("--batch-size must be at least 1.")
+    if options.import_ahead < 0:
+        parser.error("--import-ahead must not be negative.")
+    if options.slots < 1:
+        parser.error("--slots must be at least 1.")
+    if options.slots > 1 and not options.connect_addr:
+        parser.error("--slots requires --connect.")
+    if options.slots > 1 and (options.batch_size > 1 or options.prefetch):
+        parser.error("--slots can't be combined with --batch-size or --prefetch; it asks for a test case whenever a slot frees up.")
+
+    if options.heartbeat_timeout <= 0 or options.hang_factor <= 0:
+        parser.error("--heartbeat-timeout and --hang-factor must be positive.")
+
+    if options.reporter_queue_size < 1:
+        parser.error("--reporter-queue-size must be at least 1.")
+
+    if (options.isolate_memory_limit or options.isolate_cpu_limit) and not (options.isolate or options.slots > 1):
+        parser.error("--isolate-memory-limit and --isolate-cpu-limit require --isolate or --slots.")
+
+    if options.watch and (options.serve_port or options.serve_socket or options.connect_addr or options.daemon):
+        parser.error("--watch can't be combined with --serve, --connect or --daemon.")
+
+    if options.split_seconds is not None and not options.history_file:
+        options.history_file = test_history.DEFAULT_HISTORY_FILE
+
+    if options.test_order:
+        try:
+            if test_history.order_needs_history(options.test_order) and not options.history_file:
+                options.history_file = test_history.DEFAULT_HISTORY_FILE
+        except ValueError, e:
+            parser.error(str(e))
+
+    affected_tests = None
+    if options.affected_by:
+        if options.affected_by == '-':
+            changes = sys.stdin.read()
+        else:
+            try:
+                with open(options.affected_by) as changes_file:
+                    changes = changes_file.read()
+            except IOError, e:
+                parser.error("Can't read --affected-by file: %s" % e)
+        affected_tests = test_impact.CoverageMap(options.coverage_map).load().affected(test_impact.parse_changes(changes))
+
+    plugin_modules = plugin_manifest.activate_plugins(plugin_modules, options)
+
     test_path, module_method_overrides = _parse_test_runner_command_line_module_method_overrides(args)
 
+    if options.runner_id is None:
+        import socket
+        options.runner_id = "%s-%d" % (socket.gethostname(), os.getpid())
+
+    import pwd
     if pwd.getpwuid(os.getuid()).pw_name == 'buildbot':
         options.disable_color = True
 
@@ -168,15 +283,7 @@ def parse_test_runner_command_line_args(plugin_modules, args):
     else:
         runner_action = ACTION_RUN_TESTS
 
-    reporters = []
-    if options.disable_color:
-        reporters.append(test_logger.ColorlessTextTestLogger(options))
-    else:
-        reporters.append(test_logger.TextTestLogger(options))
-
-    for plugin in plugin_modules:
-        if hasattr(plugin, "build_test_reporters"):
-            reporters += plugin.build_test_reporters(options)
+    reporters = build_test_reporters(options, plugin_modules)
 
     test_runner_args = {
         'debugger': options.debugger,
@@ -184,6 +291,15 @@ def parse_test_runner_command_line_args(plugin_modules, args):
         'suites_exclude': options.suites_exclude,
         'suites_require': options.suites_require,
         'failure_limit' : options.failure_limit,
+        'test_order': options.test_order,
+        'history_file': options.history_file,
+        'affected_tests': affected_tests,
+        'result_cache_dir': options.result_cache_dir,
+        'result_cache_size': options.result_cache_size * 1024 * 1024,
+        'result_cache_env': options.result_cache_env,
+        'isolate': options.isolate,
+        'isolate_memory_limit': options.isolate_memory_limit * 1024 * 1024 if options.isolate_memory_limit else None,
+        'isolate_cpu_limit': options.isolate_cpu_limit,
         'module_method_overrides': module_method_overrides,
         'test_reporters': reporters,            # Should be pushed into plugin
         'options': options,
@@ -192,6 +308,18 @@ def parse_test_runner_command_line_args(plugin_modules, args):
 
     return runner_action, test_path, test_runner_args, options
 
+def build_test_reporters(options, plugin_modules):
+    reporters = []
+    if options.disable_color:
+        reporters.append(test_logger.ColorlessTextTestLogger(options))
+    else:
+        reporters.append(test_logger.TextTestLogger(options))
+
+    for plugin in plugin_modules:
+        if hasattr(plugin, "build_test_reporters"):
+            reporters += plugin.build_test_reporters(options)
+    return reporters
+
 def _parse_test_runner_command_line_module_method_overrides(args):
     """Parse a set of positional args (returned from an OptionParser probably) for specific modules or test methods.
     eg/ > python some_module_test.py SomeTestClass.some_test_method
@@ -212,13 +340,21 @@ def _parse_test_runner_command_line_module_method_overrides(args):
     return test_path, module_method_overrides
 
 class TestProgram(object):
-    def __init__(self, command_line_args=None):
+    def __init__(self, command_line_args=None, plugin_modules=None):
         """Initialize and run the test with the given command_line_args
             command_line_args will be passed to parser.parse_args
+            plugin_modules, if given, are used instead of loading plugins (e.g. by the daemon, which has them loaded already)
         """
         command_line_args = command_line_args or sys.argv[1:]
 
-        plugin_modules = load_plugins()
+        daemon_socket = os.environ.get(test_daemon.DAEMON_SOCKET_ENV)
+        if daemon_socket and plugin_modules is None and '--daemon' not in command_line_args and command_line_args and command_line_args[0] != '__main__':
+            exit_code = test_daemon.run_via_daemon(daemon_socket, command_line_args)
+            if exit_code is not None:
+                sys.exit(exit_code)
+
+        if plugin_modules is None:
+            plugin_modules = load_plugins()
 
         runner_action, test_path, test_runner_args, other_opts = parse_test_runner_command_line_args(plugin_modules, command_line_args)
 
@@ -228,10 +364,41 @@ class TestProgram(object):
         if other_opts.bucket_overrides_file:
             bucket_overrides = get_bucket_overrides(other_opts.bucket_overrides_file)
 
-        if other_opts.serve_port:
-            from test_runner_server import TestRunnerServer
-            test_runner_class = TestRunnerServer
+        if other_opts.daemon:
+            daemon = test_daemon.TestDaemon(
+                other_opts.daemon_socket or test_daemon.default_socket_path(),
+                plugin_modules,
+                preload_test_path=test_path,
+            )
+            try:
+                daemon.serve_forever()
+            except test_daemon.DaemonError, e:
+                print >>sys.stderr, e
+                sys.exit(1)
+            sys.exit(0)
+
+        if other_opts.serve_port or other_opts.serve_socket:
+            if other_opts.relay_addr:
+                from test_runner_relay import TestRunnerRelay
+                test_runner_class = TestRunnerRelay
+                test_runner_args['relay_addr'] = other_opts.relay_addr
+                test_runner_args['relay_id'] = other_opts.runner_id
+                test_runner_args['lease_size'] = other_opts.relay_lease_size
+            else:
+                from test_runner_server import TestRunnerServer
+                test_runner_class = TestRunnerServer
             test_runner_args['serve_port'] = other_opts.serve_port
+            test_runner_args['serve_socket'] = other_opts.serve_socket
+            test_runner_args['transport'] = other_opts.transport
+            test_runner_args['reporter_queue_size'] = other_opts.reporter_queue_size
+            test_runner_args['heartbeat_timeout'] = other_opts.heartbeat_timeout
+            test_runner_args['hang_factor'] = other_opts.hang_factor
+            test_runner_args['journal'] = other_opts.journal
+            test_runner_args['resume'] = other_opts.resume
+            test_runner_args['split_classes'] = other_opts.split_classes
+            test_runner_args['split_seconds'] = other_opts.split_seconds
+            test_runner_args['durations_json'] = other_opts.durations_json
+            test_runner_args['durations_db_url'] = other_opts.durations_db_url
         elif other_opts.connect_addr:
             from test_runner_client import TestRunnerClient
             test_runner_class = TestRunnerClient
@@ -249,14 +416,25 @@ class TestProgram(object):
         else:
             test_runner_class = TestRunner
 
-        runner = test_runner_class(
-            test_path,
-            bucket_overrides=bucket_overrides,
-            bucket_count=other_opts.bucket_count,
-            bucket_salt=other_opts.bucket_salt,
-            bucket=other_opts.bucket,
-            **test_runner_args
-        )
+        def make_runner(test_path):
+            return test_runner_class(
+                test_path,
+                bucket_overrides=bucket_overrides,
+                bucket_count=other_opts.bucket_count,
+                bucket_salt=other_opts.bucket_salt,
+                bucket=other_opts.bucket,
+                **test_runner_args
+            )
+
+        if other_opts.watch and runner_action == ACTION_RUN_TESTS:
+            from test_watcher import TestWatcher
+            def make_watched_runner(test_path):
+                test_runner_args['test_reporters'] = build_test_reporters(other_opts, test_runner_args['plugin_modules'])
+                return make_runner(test_path)
+            TestWatcher(test_path, make_watched_runner, roots=other_opts.watch_paths).run()
+            sys.exit(0)
+
+        runner = make_runner(test_path)
 
         if runner_action == ACTION_LIST_SUITES:
             runner.list_suites()
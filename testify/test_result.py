@@ -21,20 +21,29 @@ import traceback
 
 from testify.utils import inspection
 
-#If IPython is available, use it for fancy color traceback formatting
-try:
-    try:
-        # IPython >= 0.11
-        from IPython.core.ultratb import ColorTB
-        _hush_pyflakes = [ColorTB]
-        del _hush_pyflakes
-    except ImportError:
-        # IPython < 0.11
-        from IPython.ultraTB import ColorTB
-
-    fancy_tb_formatter = ColorTB().text
-except ImportError:
-    fancy_tb_formatter = None
+# Set up the first time we format a traceback, since importing IPython is slow.
+_fancy_tb_formatter = None
+_fancy_tb_formatter_loaded = False
+
+def get_fancy_tb_formatter():
+    """If IPython is available, return its formatter for fancy color tracebacks; otherwise None."""
+    global _fancy_tb_formatter, _fancy_tb_formatter_loaded
+    if not _fancy_tb_formatter_loaded:
+        _fancy_tb_formatter_loaded = True
+        try:
+            try:
+                # IPython >= 0.11
+                from IPython.core.ultratb import ColorTB
+                _hush_pyflakes = [ColorTB]
+                del _hush_pyflakes
+            except ImportError:
+                # IPython < 0.11
+                from IPython.ultraTB import ColorTB
+
+            _fancy_tb_formatter = ColorTB().text
+        except ImportError:
+            _fancy_tb_formatter = None
+    return _fancy_tb_formatter
 
 class TestResult(object):
     def __init__(self, test_method, runner_id=None):
@@ -85,7 +94,8 @@ class TestResult(object):
         if self.exception_info is None:
             return None
 
-        tb_formatter = fancy_tb_formatter if (pretty and fancy_tb_formatter) else traceback.format_exception
+        fancy_tb_formatter = get_fancy_tb_formatter() if pretty else None
+        tb_formatter = fancy_tb_formatter or traceback.format_exception
 
         def is_relevant_tb_level(tb):
             return tb.tb_frame.f_globals.has_key('__testify')
@@ -19,11 +19,16 @@ __testify = 1
 
 from collections import defaultdict
 import functools
+import os
 import pprint
 import sys
 
 from test_case import MetaTestCase, TestCase
+import isolation
+import test_cache
 import test_discovery
+import test_history
+from test_logger import _log
 
 
 class TestRunner(object):
@@ -47,7 +52,16 @@ class TestRunner(object):
                  test_reporters=None,
                  plugin_modules=None,
                  module_method_overrides=None,
-                 failure_limit=None
+                 failure_limit=None,
+                 test_order=None,
+                 history_file=None,
+                 isolate=None,
+                 isolate_memory_limit=None,
+                 isolate_cpu_limit=None,
+                 affected_tests=None,
+                 result_cache_dir=None,
+                 result_cache_size=test_cache.DEFAULT_MAX_SIZE,
+                 result_cache_env=(),
                  ):
         """After instantiating a TestRunner, call run() to run them."""
 
@@ -72,31 +86,85 @@ class TestRunner(object):
         self.failure_limit = failure_limit
         self.failure_count = 0
 
+        self.isolate = isolate
+        self.isolate_memory_limit = isolate_memory_limit
+        self.isolate_cpu_limit = isolate_cpu_limit
+
+        # A test_impact.ImpactSelection; if set, only the methods it selects are run.
+        self.affected_tests = affected_tests
+
+        self.result_cache = None
+        if result_cache_dir:
+            key_data = (
+                sorted(self.suites_include),
+                sorted(self.suites_exclude),
+                sorted(self.suites_require),
+                sorted((name, os.environ.get(name)) for name in result_cache_env),
+            )
+            self.result_cache = test_cache.ResultCache(result_cache_dir, max_size=result_cache_size, key_data=key_data)
+            self.test_reporters.append(test_cache.ResultCacheReporter(options, self.result_cache))
+
+        self.test_order = test_order
+        self.history = None
+        if history_file:
+            self.history = test_history.TestHistory(history_file)
+            self.test_reporters.append(test_history.TestHistoryReporter(options, self.history))
+
     @classmethod
     def get_test_method_name(cls, test_method):
         return '%s %s.%s' % (test_method.__module__, test_method.im_class.__name__, test_method.__name__)
 
+    def discover_test_case_classes(self):
+        """Yield (test case class, name overrides) for each test case class discovery finds in our bucket, as it finds
+        them. Raises test_discovery.DiscoveryError if discovery fails."""
+        for test_case_class in test_discovery.discover(self.test_path_or_test_case):
+            override_bucket = self.bucket_overrides.get(MetaTestCase._cmp_str(test_case_class))
+            if (self.bucket is None
+                or (override_bucket is None and test_case_class.bucket(self.bucket_count, self.bucket_salt) == self.bucket)
+                or (override_bucket is not None and override_bucket == self.bucket)):
+                if not self.module_method_overrides or test_case_class.__name__ in self.module_method_overrides:
+                    yield test_case_class, self.module_method_overrides.get(test_case_class.__name__, None)
+
+    def discover_test_methods(self):
+        """Like discover(), but yield (class_path, method names) for each test case as discovery finds it, without
+        constructing the test case unless its __init__ might add test methods of its own. Doesn't report discovery
+        failures or sort by test_order; raises test_discovery.DiscoveryError if discovery fails."""
+        if isinstance(self.test_path_or_test_case, (TestCase, MetaTestCase)):
+            # For testing purposes only.
+            test_case = self.test_path_or_test_case()
+            yield '%s %s' % (test_case.__module__, test_case.__class__.__name__), [method.__name__ for method in test_case.runnable_test_methods()]
+            return
+        for test_case_class, name_overrides in self.discover_test_case_classes():
+            class_path = '%s %s' % (test_case_class.__module__, test_case_class.__name__)
+            if test_case_class.overrides_init():
+                test_case = self.instantiate_test_case(test_case_class, name_overrides)
+                method_names = [method.__name__ for method in test_case.runnable_test_methods()]
+            else:
+                method_names = test_case_class.runnable_test_method_names(
+                    suites_include=self.suites_include,
+                    suites_exclude=self.suites_exclude,
+                    suites_require=self.suites_require,
+                    name_overrides=name_overrides,
+                )
+            if self.affected_tests is not None:
+                method_names = self.affected_tests.filter_methods(class_path, method_names)
+                if not method_names:
+                    continue
+            yield class_path, method_names
+
     def discover(self):
         def discover_inner():
             if isinstance(self.test_path_or_test_case, (TestCase, MetaTestCase)):
                 # For testing purposes only.
                 yield self.test_path_or_test_case()
                 return
-            for test_case_class in test_discovery.discover(self.test_path_or_test_case):
-                override_bucket = self.bucket_overrides.get(MetaTestCase._cmp_str(test_case_class))
-                if (self.bucket is None
-                    or (override_bucket is None and test_case_class.bucket(self.bucket_count, self.bucket_salt) == self.bucket)
-                    or (override_bucket is not None and override_bucket == self.bucket)):
-                    if not self.module_method_overrides or test_case_class.__name__ in self.module_method_overrides:
-                        test_case = test_case_class(
-                            suites_include=self.suites_include,
-                            suites_exclude=self.suites_exclude,
-                            suites_require=self.suites_require,
-                            name_overrides=self.module_method_overrides.get(test_case_class.__name__, None),
-                            failure_limit=(self.failure_limit - self.failure_count) if self.failure_limit else None,
-                            debugger=self.debugger,
-                        )
-                        yield test_case
+            for test_case_class, name_overrides in self.discover_test_case_classes():
+                test_case = self.instantiate_test_case(test_case_class, name_overrides)
+                if self.affected_tests is not None:
+                    test_case = self.select_affected_methods(test_case)
+                    if test_case is None:
+                        continue
+                yield test_case
 
         discovered_tests = []
         try:
@@ -105,12 +173,35 @@ class TestRunner(object):
             for reporter in self.test_reporters:
                 reporter.test_discovery_failure(exc)
             sys.exit(1)
+        if self.test_order:
+            discovered_tests = test_history.order_test_cases(discovered_tests, self.test_order, self.history)
         test_case_count = len(discovered_tests)
         test_method_count = sum(len(list(test_case.runnable_test_methods())) for test_case in discovered_tests)
         for reporter in self.test_reporters:
             reporter.test_counts(test_case_count, test_method_count)
         return discovered_tests
 
+    def instantiate_test_case(self, test_case_class, name_overrides):
+        return test_case_class(
+            suites_include=self.suites_include,
+            suites_exclude=self.suites_exclude,
+            suites_require=self.suites_require,
+            name_overrides=name_overrides,
+            failure_limit=(self.failure_limit - self.failure_count) if self.failure_limit else None,
+            debugger=self.debugger,
+        )
+
+    def select_affected_methods(self, test_case):
+        """Narrow a test case down to the methods self.affected_tests selects; None if there are none left."""
+        class_path = '%s %s' % (test_case.__module__, test_case.__class__.__name__)
+        method_names = [method.__name__ for method in test_case.runnable_test_methods()]
+        selected_names = self.affected_tests.filter_methods(class_path, method_names)
+        if not selected_names:
+            return None
+        if len(selected_names) == len(method_names):
+            return test_case
+        return self.instantiate_test_case(type(test_case), set(selected_names))
+
     def run(self):
         """Instantiate our found test case classes and run their test methods.
 
@@ -124,37 +215,32 @@ class TestRunner(object):
         testing exceptions and summaries printed out.
         """
 
+        # discover() may be a generator (see TestRunnerClient), so count what it gives us rather than len() it.
+        discovered_count = 0
         try:
             for test_case in self.discover():
+                discovered_count += 1
                 if self.failure_limit and self.failure_count >= self.failure_limit:
                     break
 
-                # We allow our plugins to mutate the test case prior to execution
-                for plugin_mod in self.plugin_modules:
-                    if hasattr(plugin_mod, "prepare_test_case"):
-                        plugin_mod.prepare_test_case(self.options, test_case)
-
-                if not any(test_case.runnable_test_methods()):
+                prepared = self.prepare_test_case(test_case)
+                if prepared is None:
                     continue
+                test_case, runnable = prepared
 
-                def failure_counter(result_dict):
-                    if not result_dict['success']:
-                        self.failure_count += 1
+                # In isolated mode the callbacks fire in the child; we report what it sends back instead.
+                if not self.isolate:
+                    for reporter in self.test_reporters:
+                        test_case.register_callback(test_case.EVENT_ON_RUN_TEST_METHOD, reporter.test_start)
+                        test_case.register_callback(test_case.EVENT_ON_COMPLETE_TEST_METHOD, reporter.test_complete)
 
-                for reporter in self.test_reporters:
-                    test_case.register_callback(test_case.EVENT_ON_RUN_TEST_METHOD, reporter.test_start)
-                    test_case.register_callback(test_case.EVENT_ON_COMPLETE_TEST_METHOD, reporter.test_complete)
-
-                test_case.register_callback(test_case.EVENT_ON_COMPLETE_TEST_METHOD, failure_counter)
-
-                # Now we wrap our test case like an onion. Each plugin given the opportunity to wrap it.
-                runnable = test_case.run
-                for plugin_mod in self.plugin_modules:
-                    if hasattr(plugin_mod, "run_test_case"):
-                        runnable = functools.partial(plugin_mod.run_test_case, self.options, test_case, runnable)
+                    test_case.register_callback(test_case.EVENT_ON_COMPLETE_TEST_METHOD, self.failure_counter)
 
                 # And we finally execute our finely wrapped test case
-                runnable()
+                if self.isolate:
+                    self.run_isolated(test_case, runnable)
+                else:
+                    runnable()
 
         except (KeyboardInterrupt, SystemExit):
             # we'll catch and pass a keyboard interrupt so we can cancel in the middle of a run
@@ -162,8 +248,85 @@ class TestRunner(object):
             pass
 
         report = [reporter.report() for reporter in self.test_reporters]
+        if self.affected_tests is not None and not discovered_count:
+            # Nothing to run is a success when we're only running what a change affects.
+            _log.warning("No tests are affected by these changes.")
+            return True
         return all(report)
 
+    def prepare_test_case(self, test_case):
+        """Get a test case ready to run: skip its cached methods and let plugins have their way with it.
+
+        Returns (test_case, runnable), where runnable runs the (possibly narrowed down) test case wrapped in whatever
+        the plugins wrap it in, or None if there's nothing left to run.
+        """
+        if self.result_cache:
+            test_case = self.skip_cached_methods(test_case)
+            if test_case is None:
+                return None
+
+        # We allow our plugins to mutate the test case prior to execution
+        for plugin_mod in self.plugin_modules:
+            if hasattr(plugin_mod, "prepare_test_case"):
+                plugin_mod.prepare_test_case(self.options, test_case)
+
+        if not any(test_case.runnable_test_methods()):
+            return None
+
+        # Now we wrap our test case like an onion. Each plugin given the opportunity to wrap it.
+        runnable = test_case.run
+        for plugin_mod in self.plugin_modules:
+            if hasattr(plugin_mod, "run_test_case"):
+                runnable = functools.partial(plugin_mod.run_test_case, self.options, test_case, runnable)
+        return test_case, runnable
+
+    def skip_cached_methods(self, test_case):
+        """Report the methods that passed under this test case's cache key as cached successes.
+
+        Returns the test case narrowed down to the remaining methods, or None if there are none.
+        """
+        cached_results = self.result_cache.get(self.result_cache.key_for(test_case))
+        method_names = [method.__name__ for method in test_case.runnable_test_methods()]
+        remaining_names = [name for name in method_names if name not in cached_results]
+
+        for name in method_names:
+            if name in cached_results:
+                result_dict = self.result_cache.cached_result(cached_results[name])
+                for reporter in self.test_reporters:
+                    reporter.test_start(result_dict)
+                for reporter in self.test_reporters:
+                    reporter.test_complete(result_dict)
+
+        if not remaining_names:
+            return None
+        if len(remaining_names) == len(method_names):
+            return test_case
+        return self.instantiate_test_case(type(test_case), set(remaining_names))
+
+    def failure_counter(self, result_dict):
+        if not result_dict['success']:
+            self.failure_count += 1
+
+    def run_isolated(self, test_case, runnable):
+        """Run a test case in a forked child, reporting the results it streams back."""
+        forked = isolation.ForkedTestCase(
+            test_case,
+            runnable,
+            memory_limit=self.isolate_memory_limit,
+            cpu_limit=self.isolate_cpu_limit,
+        )
+        for event, result_dict in forked.run():
+            self.report_isolated_event(event, result_dict)
+
+    def report_isolated_event(self, event, result_dict):
+        if event == isolation.EVENT_START:
+            for reporter in self.test_reporters:
+                reporter.test_start(result_dict)
+        else:
+            for reporter in self.test_reporters:
+                reporter.test_complete(result_dict)
+            self.failure_counter(result_dict)
+
     def list_suites(self):
         """List the suites represented by this TestRunner's tests."""
         suites = defaultdict(list)
@@ -4,6 +4,16 @@ See the test_runner_server module.
 """
 
 from test_runner import TestRunner
+from testify import binary_transport
+from testify import isolation
+from testify.utils.connection_pool import ConnectionPool
+import errno
+import os
+import Queue
+import select
+import sys
+import threading
+import urllib
 import urllib2
 try:
     import simplejson as json
@@ -14,6 +24,37 @@ except ImportError:
 import time
 import logging
 
+class ModuleImporter(object):
+    """Imports modules on a thread of its own, so that they're already imported by the time we run their tests.
+
+    We ignore import errors here. A module that fails to import is left out of sys.modules, so importing it again
+    to run its tests raises the error again, and it's reported against those tests as usual.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def import_modules(self, module_paths):
+        """Import each of module_paths we haven't already, in the background."""
+        for module_path in module_paths:
+            if module_path not in sys.modules:
+                self.queue.put(module_path)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            module_path = self.queue.get()
+            if module_path in sys.modules:
+                continue
+            try:
+                __import__(module_path)
+            except Exception, e:
+                logging.debug("Couldn't import %s ahead of time: %r" % (module_path, e))
+
 class TestRunnerClient(TestRunner):
     def __init__(self, *args, **kwargs):
         self.connect_addr = kwargs.pop('connect_addr')
@@ -24,46 +65,236 @@ class TestRunnerClient(TestRunner):
         self.retry_interval = kwargs['options'].retry_interval
         self.reconnect_retry_limit = kwargs['options'].reconnect_retry_limit
 
+        self.batch_size = kwargs['options'].batch_size
+        self.batch_seconds = kwargs['options'].batch_seconds
+        self.prefetch = kwargs['options'].prefetch
+        # How many upcoming test cases to ask the server about, so we can import their modules while we run others.
+        self.import_ahead = kwargs['options'].import_ahead
+        self.importer = ModuleImporter() if self.import_ahead > 0 else None
+        # How many test cases to run at a time, each in a forked child; see run_slots().
+        self.slots = kwargs['options'].slots
+
+        # Keep connections to the server open between requests; the prefetch thread may want one of its own.
+        self.pool = ConnectionPool(self.connect_addr, max_idle=2)
+        self.connection = None
+        if kwargs['options'].transport == 'binary':
+            self.connection = binary_transport.ClientConnection(self.connect_addr, self.runner_id, self.revision)
+
         super(TestRunnerClient, self).__init__(*args, **kwargs)
 
-    def discover(self):
+    def run(self):
+        if self.slots > 1:
+            return self.run_slots()
+        return super(TestRunnerClient, self).run()
+
+    def run_slots(self):
+        """Run up to self.slots test cases at a time, each in a child forked from this process, asking the server for
+        more whenever a slot frees up. The children send us their results (see isolation.ForkedTestCase), and we
+        report them as our own.
+
+        We import each test case's module before forking its child, so that the children share what we've imported
+        rather than each importing it again.
+        """
+        running = {} # The read end of each child's pipe -> its ForkedTestCase.
+        fetched = Queue.Queue()
+        # The fetching thread writes a byte to this once it's put what the server said on fetched, to wake us up.
+        wake_read, wake_write = os.pipe()
+        # Once the loop has exited, whichever of it and a fetching thread is done last closes wake_write.
+        wake_lock = threading.Lock()
+        wake_state = {'exited': False, 'fetch_running': False}
+        fetching = False
         finished = False
-        first_connect = True
-        while not finished:
-            class_path, methods, finished = self.get_next_tests(
-                retry_limit=(self.retry_limit if first_connect else self.reconnect_retry_limit),
-                retry_interval=self.retry_interval,
-            )
-            first_connect = False
-            if class_path and methods:
-                module_path, _, class_name = class_path.partition(' ')
-
-                module = __import__(module_path)
-                for part in module_path.split('.')[1:]:
-                    try:
-                        module = getattr(module, part)
-                    except AttributeError:
-                        logging.error("discovery(%s) failed: module %s has no attribute %r" % (module_path, module, part))
+        retry_limit = self.retry_limit
 
-                klass = getattr(module, class_name)
-                yield klass(name_overrides=methods)
+        def fetch(max_classes, retry_limit):
+            # Whatever happens, the main loop has to hear back from us, or it waits forever.
+            result = [], True, []
+            try:
+                result = self.get_next_tests(retry_limit=retry_limit, retry_interval=self.retry_interval, max_classes=max_classes)
+            except Exception, e:
+                logging.error("Failed to get tests from the server -- bailing: %r" % (e,))
+            finally:
+                fetched.put(result)
+                with wake_lock:
+                    wake_state['fetch_running'] = False
+                    if wake_state['exited']:
+                        os.close(wake_write)
+                    else:
+                        try:
+                            os.write(wake_write, 'x')
+                        except OSError, e:
+                            if e.errno not in (errno.EBADF, errno.EPIPE):
+                                raise
 
-    def get_next_tests(self, retry_interval=2, retry_limit=0):
         try:
-            if self.revision:
-                url = 'http://%s/tests?runner=%s&revision=%s' % (self.connect_addr, self.runner_id, self.revision)
+            while True:
+                if self.failure_limit and self.failure_count >= self.failure_limit:
+                    finished = True
+                free_slots = self.slots - len(running)
+                if free_slots and not (fetching or finished):
+                    fetch_thread = threading.Thread(target=fetch, args=(free_slots, retry_limit))
+                    fetch_thread.daemon = True
+                    wake_state['fetch_running'] = True
+                    fetch_thread.start()
+                    fetching = True
+                    retry_limit = self.reconnect_retry_limit
+                if not (running or fetching):
+                    break
+
+                readable, _, _ = select.select(running.keys() + [wake_read], [], [])
+                for fd in readable:
+                    if fd == wake_read:
+                        os.read(wake_read, 1)
+                        tests, finished, upcoming = fetched.get()
+                        fetching = False
+                        for class_path, methods in tests:
+                            forked = self.start_forked(class_path, methods)
+                            if forked is not None:
+                                running[forked.fileno()] = forked
+                        self.import_ahead_of_time(upcoming)
+                        continue
+
+                    forked = running[fd]
+                    for event, result_dict in forked.read_events():
+                        self.report_isolated_event(event, result_dict)
+                    if forked.eof:
+                        del running[fd]
+                        for event, result_dict in forked.finish():
+                            self.report_isolated_event(event, result_dict)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            for forked in running.itervalues():
+                forked.kill()
+            with wake_lock:
+                wake_state['exited'] = True
+                os.close(wake_read)
+                if not wake_state['fetch_running']:
+                    os.close(wake_write)
+
+        report = [reporter.report() for reporter in self.test_reporters]
+        return all(report)
+
+    def start_forked(self, class_path, methods):
+        """Start running a test case in a forked child, returning its isolation.ForkedTestCase, or None if there's
+        nothing of it to run."""
+        prepared = self.prepare_test_case(self.load_test_case(class_path, methods))
+        if prepared is None:
+            return None
+        test_case, runnable = prepared
+        forked = isolation.ForkedTestCase(
+            test_case,
+            runnable,
+            memory_limit=self.isolate_memory_limit,
+            cpu_limit=self.isolate_cpu_limit,
+        )
+        forked.start()
+        return forked
+
+    def discover(self):
+        tests, finished, upcoming = self.get_next_tests(retry_limit=self.retry_limit, retry_interval=self.retry_interval)
+        while True:
+            # We import the first test case's module ourselves straight away; the rest can come in the background.
+            self.import_ahead_of_time([class_path for class_path, _ in tests[1:]] + upcoming)
+            prefetched = {}
+            prefetch_thread = None
+            if self.prefetch and not finished:
+                # Ask for the next batch while we run this one, so we don't sit idle for a round trip between them.
+                def fetch():
+                    try:
+                        batch = prefetched['batch'] = self.get_next_tests(retry_limit=self.reconnect_retry_limit, retry_interval=self.retry_interval)
+                        self.import_ahead_of_time([class_path for class_path, _ in batch[0]] + batch[2])
+                    except Exception, e:
+                        prefetched['error'] = e
+                prefetch_thread = threading.Thread(target=fetch)
+                prefetch_thread.daemon = True
+                prefetch_thread.start()
+
+            for class_path, methods in tests:
+                yield self.load_test_case(class_path, methods)
+
+            if finished:
+                break
+            if prefetch_thread:
+                prefetch_thread.join()
+                if 'error' in prefetched:
+                    logging.warning("Error while prefetching tests: %r" % (prefetched['error'],))
+            if 'batch' in prefetched:
+                tests, finished, upcoming = prefetched['batch']
             else:
-                url = 'http://%s/tests?runner=%s' % (self.connect_addr, self.runner_id)
-            response = urllib2.urlopen(url)
-            d = json.load(response)
-            return (d.get('class'), d.get('methods'), d['finished'])
-        except urllib2.HTTPError, e:
-            logging.warning("Got HTTP status %d when requesting tests -- bailing" % (e.code))
-            return None, None, True
-        except urllib2.URLError, e:
+                # Not prefetching, or prefetching failed; ask now, letting any error out as it would've been anyway.
+                tests, finished, upcoming = self.get_next_tests(retry_limit=self.reconnect_retry_limit, retry_interval=self.retry_interval)
+
+    def import_ahead_of_time(self, class_paths):
+        """Import the modules of test cases we expect to run later, in the background, with --import-ahead."""
+        if self.importer is not None:
+            self.importer.import_modules([class_path.partition(' ')[0] for class_path in class_paths])
+
+    def load_test_case(self, class_path, methods):
+        module_path, _, class_name = class_path.partition(' ')
+
+        module = __import__(module_path)
+        for part in module_path.split('.')[1:]:
+            try:
+                module = getattr(module, part)
+            except AttributeError:
+                logging.error("discovery(%s) failed: module %s has no attribute %r" % (module_path, module, part))
+
+        klass = getattr(module, class_name)
+        return klass(name_overrides=methods)
+
+    def get_next_tests(self, retry_interval=2, retry_limit=0, max_classes=None):
+        """Ask the server for the next batch of tests, returning (tests, finished, upcoming) where tests is a list of
+        (class_path, methods), and upcoming a list of class paths we're likely to get later on.
+
+        The batch is of up to max_classes test cases if given (to fill that many free slots), or else --batch-size
+        test cases and --batch-seconds of run time.
+        """
+        if max_classes is None:
+            batch_classes = self.batch_size
+            max_seconds = self.batch_seconds if self.batch_size > 1 else None
+        else:
+            batch_classes = max_classes
+            max_seconds = None
+        try:
+            if self.connection:
+                return self.connection.get_tests(batch_classes, max_seconds, self.import_ahead, self.slots)
+            return self.request_tests(batch_classes, max_seconds)
+        except (urllib2.HTTPError, binary_transport.Refused), e:
+            logging.warning("Got status %d when requesting tests -- bailing" % (e.code))
+            return [], True, []
+        except (urllib2.URLError, binary_transport.TransportError), e:
             if retry_limit > 0:
                 logging.warning("Got error %r when requesting tests, retrying %d more times." % (e, retry_limit))
                 time.sleep(retry_interval)
-                return self.get_next_tests(retry_limit=retry_limit-1, retry_interval=retry_interval)
+                return self.get_next_tests(retry_limit=retry_limit-1, retry_interval=retry_interval, max_classes=max_classes)
             else:
-                return None, None, True # Stop trying if we can't connect to the server.
+                return [], True, [] # Stop trying if we can't connect to the server.
+
+    def request_tests(self, max_classes, max_seconds):
+        """Ask for tests over HTTP; see get_next_tests."""
+        return request_tests(self.pool, self.runner_id, self.revision, max_classes, max_seconds, self.import_ahead, self.slots)
+
+def request_tests(pool, runner_id, revision, max_classes=1, max_seconds=None, lookahead=0, slots=1):
+    """Ask the server pool talks to for tests over HTTP, as runner_id (which runs slots test cases at a time),
+    returning (tests, finished, upcoming) where tests is a list of (class_path, methods), and upcoming up to
+    lookahead class paths we're likely to get later on."""
+    params = [('runner', runner_id)]
+    if revision:
+        params.append(('revision', revision))
+    if max_classes > 1:
+        params.append(('max_classes', max_classes))
+        if max_seconds is not None:
+            params.append(('max_seconds', max_seconds))
+    if lookahead > 0:
+        params.append(('lookahead', lookahead))
+    if slots > 1:
+        params.append(('slots', slots))
+    d = json.loads(pool.request('GET', '/tests?%s' % urllib.urlencode(params)))
+    if 'tests' in d:
+        tests = [(test['class'], test['methods']) for test in d['tests']]
+    elif d.get('class') and d.get('methods'):
+        tests = [(d['class'], d['methods'])]
+    else:
+        tests = []
+    return tests, d['finished'], d.get('lookahead', [])
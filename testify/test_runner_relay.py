@@ -0,0 +1,296 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""A relay between a root test server and runners of its own (testify --relay), for runs with more runners than one
+server can keep up with.
+
+A relay leases batches of test cases from the root as if it were a runner,
+hands them out to its own runners as any server would, and forwards their
+results to the root in batches. The root still makes every decision that needs
+the whole run in view: what to rerun, when there have been too many failures,
+and what to report. When one of the relay's runners times out, the relay
+releases what that runner had back to the root, which times it out as it would
+for any runner of its own. The relay sends the root heartbeats, so the root
+only times out what the relay holds if the relay itself goes away.
+"""
+from __future__ import with_statement
+
+import functools
+import itertools
+import Queue
+import sys
+import threading
+import time
+import urllib2
+import zlib
+
+import tornado.ioloop
+
+from testify import binary_transport
+from testify.test_logger import _log
+from testify.test_runner_client import request_tests
+from testify.test_runner_server import TestRunnerServer
+from testify.utils.connection_pool import ConnectionPool
+
+try:
+    import simplejson as json
+    _hush_pyflakes = [json]
+    del _hush_pyflakes
+except ImportError:
+    import json
+
+DEFAULT_LEASE_SIZE = 20
+
+# Forward results to the root in batches of up to this many, sending a batch once its first result has waited
+# RESULT_BATCH_SECONDS.
+RESULT_BATCH_SIZE = 100
+RESULT_BATCH_SECONDS = 0.2
+
+UPSTREAM_HEARTBEAT_SECONDS = 5.0
+# How long to wait on the root for anything but a lease (which waits as long as the root has nothing to hand out).
+UPSTREAM_TIMEOUT = 60.0
+UPSTREAM_RETRY_LIMIT = 3
+UPSTREAM_RETRY_INTERVAL = 2.0
+
+
+class Upstream(object):
+    """A connection to the root server, as the relay's runner id, over HTTP or the binary transport."""
+
+    def __init__(self, addr, runner_id, revision=None, transport='http', timeout=None):
+        self.runner_id = runner_id
+        self.revision = revision
+        self.pool = ConnectionPool(addr, max_idle=1, timeout=timeout)
+        self.connection = None
+        if transport == 'binary':
+            self.connection = binary_transport.ClientConnection(addr, runner_id, revision, timeout=timeout)
+
+    def get_tests(self, max_classes):
+        """Return (tests, finished), where tests is a list of (class_path, methods)."""
+        if self.connection:
+            tests, finished, _ = self.connection.get_tests(max_classes)
+        else:
+            tests, finished, _ = request_tests(self.pool, self.runner_id, self.revision, max_classes)
+        return tests, finished
+
+    def report_results(self, results):
+        """Return a list of {'full_name', 'error'} for the results the root refused."""
+        if self.connection:
+            return self.connection.report_results(results)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress(json.dumps(results)) + compressor.flush()
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        return json.loads(self.pool.request('POST', '/results/batch?runner=%s' % self.runner_id, body, headers))['errors']
+
+    def heartbeat(self):
+        if self.connection:
+            return self.connection.heartbeat()
+        self.pool.request('POST', '/heartbeat?runner=%s' % self.runner_id, '{}')
+
+    def release(self, class_path, methods, reason):
+        if self.connection:
+            return self.connection.release(class_path, methods, reason)
+        body = json.dumps({'class_path': class_path, 'methods': methods, 'reason': reason})
+        self.pool.request('POST', '/release?runner=%s' % self.runner_id, body)
+
+    def close(self):
+        self.pool.close()
+        if self.connection:
+            self.connection.close()
+
+
+def call_upstream(description, function, args=(), retry_limit=UPSTREAM_RETRY_LIMIT):
+    """Call function(*args), retrying on connection trouble, and return what it returns; or log why it failed and return None."""
+    for attempt in xrange(retry_limit + 1):
+        try:
+            return function(*args)
+        except (urllib2.HTTPError, binary_transport.Refused), e:
+            _log.error("The root server refused to %s: %s", description, e)
+            return None
+        except Exception, e:
+            if attempt == retry_limit:
+                _log.error("Couldn't %s: %r", description, e)
+                return None
+            _log.warning("Got error %r trying to %s, retrying.", e, description)
+            time.sleep(UPSTREAM_RETRY_INTERVAL)
+
+
+class TestRunnerRelay(TestRunnerServer):
+    def __init__(self, *args, **kwargs):
+        self.upstream_addr = kwargs.pop('relay_addr')
+        self.relay_id = kwargs.pop('relay_id')
+        self.lease_size = kwargs.pop('lease_size', DEFAULT_LEASE_SIZE)
+        # The root reports every result; ours would only ever see an empty run.
+        kwargs['test_reporters'] = []
+        super(TestRunnerRelay, self).__init__(*args, **kwargs)
+
+        # The root counts failures across the whole run.
+        self.failure_limit = None
+        # One connection waits on the root for leases; the other sends it everything else, so that never waits behind a lease.
+        self.lease_upstream = Upstream(self.upstream_addr, self.relay_id, self.revision, self.transport)
+        self.send_upstream = Upstream(self.upstream_addr, self.relay_id, self.revision, self.transport, timeout=UPSTREAM_TIMEOUT)
+        self.upstream_queue = Queue.Queue() # ('result', result), ('release', class_path, methods, reason) and ('stop',), in order.
+        self.want_lease = threading.Event() # Set to have the lease thread lease more tests.
+        self.lease_pending = False # Whether we've asked for a lease and not yet queued it; only touched on the IOLoop.
+        self.upstream_finished = False # Whether the root has told us there's nothing more to lease.
+        self.lease_seq = itertools.count()
+        self.sending_thread = None
+
+    def queue_tests(self):
+        """Instead of discovering tests, start leasing them from the root (and sending it what we get back)."""
+        self.durations = self.load_durations()
+        # The lease thread may be waiting on the root for a lease when we're done, so don't wait for it to exit.
+        lease_thread = threading.Thread(target=self.lease_tests)
+        lease_thread.daemon = True
+        lease_thread.start()
+        self.sending_thread = threading.Thread(target=self.send_to_upstream)
+        self.sending_thread.daemon = True
+        self.sending_thread.start()
+        self.lease_pending = True
+        self.want_lease.set()
+
+    def check_stock(self):
+        """Lease more tests if we're running low: below half a lease, or fewer than the runners waiting for them."""
+        if self.lease_pending or self.upstream_finished or self.shutting_down:
+            return
+        if self.test_queue.test_count <= max(self.lease_size // 2, self.test_queue.waiting_count()):
+            self.lease_pending = True
+            self.want_lease.set()
+
+    def lease_tests(self):
+        """Lease tests from the root whenever check_stock() asks, until the root says there are no more."""
+        while True:
+            self.want_lease.wait()
+            self.want_lease.clear()
+            if self.upstream_finished:
+                return
+            leased = call_upstream("lease tests", self.lease_upstream.get_tests, (self.lease_size,))
+            tests, finished = leased if leased is not None else ([], True)
+            tornado.ioloop.IOLoop.instance().add_callback(functools.partial(self.add_lease, tests, finished))
+            if finished:
+                return
+
+    def add_lease(self, tests, finished):
+        """Queue up tests leased from the root, on the IOLoop."""
+        self.lease_pending = False
+        for class_path, methods in tests:
+            # Check each lease out under a key of its own, since we may lease more than one chunk of a class.
+            chunk_key = '%s#%d' % (class_path, next(self.lease_seq))
+            self.method_chunks.update(((class_path, method), chunk_key) for method in methods)
+            self.enqueue(0, {'class_path': class_path, 'chunk': chunk_key, 'methods': methods})
+
+        if finished:
+            # While we have anything checked out from the root, it's only done if it's given up (or gone away).
+            self.upstream_finished = True
+            self.shutdown()
+        else:
+            self.check_stock()
+
+    def get_next_test(self, runner_id, on_test_callback, on_empty_callback):
+        super(TestRunnerRelay, self).get_next_test(runner_id, on_test_callback, on_empty_callback)
+        self.check_stock()
+
+    def check_out_class(self, runner, test_dict):
+        super(TestRunnerRelay, self).check_out_class(runner, test_dict)
+        self.check_stock()
+
+    def handle_result(self, class_path, method, d, result):
+        """Forward the result to the root, which decides whether to report it or rerun its method."""
+        self.upstream_queue.put(('result', result))
+        return False
+
+    def check_in_class(self, runner, checkout_key, timed_out=False, finished=False, early_shutdown=False, reason=None):
+        d = self.checked_out.get(checkout_key)
+        if timed_out and d and d['runner'] == runner and d['methods']:
+            # Hand what the runner didn't finish back to the root, to rerun (or not) as it would if we'd stopped
+            # responding, and leave nothing for our own check-in to requeue.
+            reason = reason or self.timeout_reason(runner, checkout_key).strip()
+            self.upstream_queue.put(('release', d['class_path'], sorted(d['methods']), '%s (via relay %s)' % (reason, self.relay_id)))
+            d['methods'] = set()
+        super(TestRunnerRelay, self).check_in_class(runner, checkout_key, timed_out=timed_out, finished=finished, early_shutdown=early_shutdown, reason=reason)
+
+    def tests_finished(self):
+        # Running out of what we've leased doesn't mean the run is over; the root tells us when it is.
+        return False
+
+    def send_to_upstream(self):
+        """Send the root our results (in batches) and releases, in the order they came, and heartbeats in between."""
+        batch = []
+        batch_deadline = None
+        next_heartbeat = time.time()
+        while True:
+            if time.time() >= next_heartbeat:
+                if not self.upstream_finished:
+                    # There'll be another one along soon enough, so don't hold anything up retrying this one.
+                    call_upstream("send a heartbeat", self.send_upstream.heartbeat, retry_limit=0)
+                next_heartbeat = time.time() + UPSTREAM_HEARTBEAT_SECONDS
+
+            wait_until = next_heartbeat if batch_deadline is None else min(batch_deadline, next_heartbeat)
+            try:
+                item = self.upstream_queue.get(timeout=max(wait_until - time.time(), 0))
+            except Queue.Empty:
+                item = None
+
+            if item is not None and item[0] == 'result':
+                batch.append(item[1])
+                if batch_deadline is None:
+                    batch_deadline = time.time() + RESULT_BATCH_SECONDS
+                if len(batch) < RESULT_BATCH_SIZE:
+                    continue
+            elif item is None and (batch_deadline is None or time.time() < batch_deadline):
+                continue
+
+            # The batch is full or due, or something that has to go after it came along.
+            if batch:
+                errors = call_upstream("forward %d results" % len(batch), self.send_upstream.report_results, (batch,)) or []
+                for error in errors:
+                    _log.error("The root server refused the result for %s: %s", error['full_name'], error['error'])
+                batch = []
+                batch_deadline = None
+
+            if item is None or item[0] == 'result':
+                continue
+            elif item[0] == 'release':
+                _, class_path, methods, reason = item
+                call_upstream("release %s" % class_path, self.send_upstream.release, (class_path, methods, reason))
+            elif item[0] == 'stop':
+                return
+
+    def stop_upstream(self):
+        """Send the root whatever we have left for it, and stop talking to it."""
+        self.upstream_finished = True
+        self.want_lease.set()
+        if self.sending_thread:
+            self.upstream_queue.put(('stop',))
+            self.sending_thread.join()
+        self.lease_upstream.close()
+        self.send_upstream.close()
+
+    def status(self):
+        status = super(TestRunnerRelay, self).status()
+        status['relay'] = {
+            'upstream': self.upstream_addr,
+            'upstream_finished': self.upstream_finished,
+            'forwarding': self.upstream_queue.qsize(),
+        }
+        return status
+
+    def run(self):
+        try:
+            return super(TestRunnerRelay, self).run()
+        finally:
+            self.stop_upstream()
+            print >>sys.stderr, "Relayed %d results from %d runners to %s." % (self.result_rate.total, len(self.runners), self.upstream_addr)
+
+# vim: set ts=4 sts=4 sw=4 et:
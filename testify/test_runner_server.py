@@ -1,7 +1,7 @@
 """
 Client-server setup to evenly distribute tests across multiple processes. The server
-discovers all test classes and enqueues them, then clients connect to the server,
-receive tests to run, and send back their results.
+discovers test classes and enqueues them as it finds them, while clients connect to
+the server, receive tests to run, and send back their results.
 
 The server keeps track of the overall status of the run and manages timeouts and retries.
 """
@@ -10,6 +10,12 @@ from __future__ import with_statement
 
 from test_logger import _log
 from test_runner import TestRunner
+import queued_reporter
+import server_journal
+import server_status
+import test_durations
+import test_history
+from utils.timer_wheel import TimerWheel
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
@@ -22,171 +28,981 @@ except ImportError:
     import json
 import logging
 
-import Queue
-import time
+import codecs
+import functools
+import heapq
 import itertools
+import sys
+import threading
+import time
+import zlib
+
+# How many times the best test in the queue may be passed over for one from a module that suits the runner better,
+# before it goes to whichever runner asks next.
+DEFAULT_MAX_AFFINITY_SKIPS = 10
+
+def test_module(test_dict):
+    """Return the module path a test_dict's class is in, which a runner has to import to run it."""
+    return test_dict.get('class_path', '').partition(' ')[0]
 
 class AsyncDelayedQueue(object):
-    def __init__(self):
-        self.data_queue = Queue.PriorityQueue()
-        self.callback_queue = Queue.PriorityQueue()
+    """Pairs queued tests with queued callbacks (runners waiting for a test), on the IOLoop. Thread-safe.
+
+    Tests are kept in heaps per last_runner and per module, and those heaps' tops in lazily cleaned heaps of their
+    own, so picking a test is amortized O(log n) plus a step per module topped by the runner's own requeued test.
+    """
+
+    def __init__(self, max_affinity_skips=DEFAULT_MAX_AFFINITY_SKIPS):
+        self.lock = threading.Lock()
+        self.groups = {} # last_runner -> heap of (priority, seq, test dict)
+        self.tops = [] # heap of (priority, seq, last_runner), each the top of its group when pushed; stale ones are skipped
+        self.seqs_in_tops = set()
+        self.modules = {} # module -> heap of (priority, seq, last_runner, test dict)
+        # Heaps of (priority, seq, module), each the top of its module's heap when pushed; stale ones are skipped.
+        self.unclaimed_tops = [] # for modules we haven't handed anyone tests from
+        self.warm_tops = {} # runner -> heap for the modules we've handed it tests from
+        # seq -> (last_runner, module) for every test in the queue. A test taken from the middle of a group or module
+        # heap stays there until it gets to the top, where we drop it; so the top of each heap is always queued.
+        self.queued = {}
+        self.warm_modules = {} # runner -> set of the modules we've handed it tests from
+        self.warm_runners = {} # module -> set of the runners we've handed tests from it
+        self.claimed_modules = set() # Modules we've handed any runner tests from.
+        self.affinity_skips = {} # seq -> how many times that test has been passed over for a better suited one
+        self.max_affinity_skips = max_affinity_skips
+        self.callbacks = [] # heap of (priority, seq, callback, runner, prefer_runner)
+        self.test_count = 0
+        self.seq = itertools.count()
+        self.match_scheduled = False
         self.finalized = False
 
-    def get(self, c_priority, callback, runner=None):
-        """Queue up a callback to receive a test."""
-        if self.finalized:
+    def get(self, c_priority, callback, runner=None, prefer_runner=None):
+        """Queue up a callback to receive a test, suited to prefer_runner if given."""
+        with self.lock:
+            finalized = self.finalized
+            if not finalized:
+                heapq.heappush(self.callbacks, (c_priority, next(self.seq), callback, runner, prefer_runner))
+                self._schedule_match()
+        if finalized:
             callback(None, None)
-            return
-
-        self.callback_queue.put((c_priority, callback, runner))
-        tornado.ioloop.IOLoop.instance().add_callback(self.match)
 
     def put(self, d_priority, data):
         """Queue up a test to get given to a callback."""
-        self.data_queue.put((d_priority, data))
-        tornado.ioloop.IOLoop.instance().add_callback(self.match)
-
-    def match(self):
-        """Try to pair a test to a callback.
-
-        This loops over each queued callback (and each queued test)
-        trying to find a match. It breaks out of the loop as soon as
-        it finds a valid callback-test match, re-queueing anything it
-        skipped. (In the worst case, this is O(n^2), but most of the
-        time no loop iterations beyond the first will be necessary -
-        the vast majority of the time, the first callback will match
-        the first test).
-        """
-
-        callback = None
-        runner = None
-        data = None
+        with self.lock:
+            self._push_test(d_priority, data)
+            self._schedule_match()
+
+    def mark_warm(self, runner, module):
+        """Note that runner has imported module, so prefers tests from it."""
+        with self.lock:
+            self._mark_warm(runner, module)
+
+    def _mark_warm(self, runner, module):
+        warm = self.warm_modules.setdefault(runner, set())
+        if module in warm:
+            return
+        warm.add(module)
+        self.warm_runners.setdefault(module, set()).add(runner)
+        self.claimed_modules.add(module)
+        if module in self.modules:
+            priority, seq, _, _ = self.modules[module][0]
+            heapq.heappush(self.warm_tops.setdefault(runner, []), (priority, seq, module))
+
+    def _schedule_match(self):
+        if not self.match_scheduled:
+            self.match_scheduled = True
+            tornado.ioloop.IOLoop.instance().add_callback(self.match)
 
-        skipped_callbacks = []
-        while callback is None:
+    def _push_test(self, priority, data):
+        key = data.get('last_runner')
+        module = test_module(data)
+        seq = next(self.seq)
+        entry = (priority, seq, data)
+        group = self.groups.setdefault(key, [])
+        heapq.heappush(group, entry)
+        module_heap = self.modules.setdefault(module, [])
+        heapq.heappush(module_heap, (priority, seq, key, data))
+        self.queued[seq] = (key, module)
+        self.test_count += 1
+        if group[0] is entry:
+            self._push_top(key)
+        if module_heap[0][1] == seq:
+            self._push_module_top(module)
+
+    def _push_top(self, key):
+        priority, seq, _ = self.groups[key][0]
+        if seq not in self.seqs_in_tops:
+            self.seqs_in_tops.add(seq)
+            heapq.heappush(self.tops, (priority, seq, key))
+
+    def _push_module_top(self, module):
+        priority, seq, _, _ = self.modules[module][0]
+        top = (priority, seq, module)
+        if module not in self.claimed_modules:
+            heapq.heappush(self.unclaimed_tops, top)
+        for runner in self.warm_runners.get(module, ()):
+            heapq.heappush(self.warm_tops.setdefault(runner, []), top)
+
+    def _clean_tops(self):
+        """Drop entries from the top of self.tops that are no longer the top of their group."""
+        while self.tops:
+            _, seq, key = self.tops[0]
+            group = self.groups.get(key)
+            if group and group[0][1] == seq:
+                return
+            heapq.heappop(self.tops)
+            self.seqs_in_tops.discard(seq)
+
+    def _best_group(self, excluded_runner):
+        """Return the last_runner key of the group holding the best test excluded_runner may have, or raise KeyError."""
+        self._clean_tops()
+        if not self.tops:
+            raise KeyError(excluded_runner)
+        key = self.tops[0][2]
+        if excluded_runner is None or key != excluded_runner:
+            return key
+
+        # The best test is this runner's own; look at the next best group's top.
+        own_top = heapq.heappop(self.tops)
+        try:
+            self._clean_tops()
+            if not self.tops:
+                raise KeyError(excluded_runner)
+            return self.tops[0][2]
+        finally:
+            heapq.heappush(self.tops, own_top)
 
+    def _best_module_tops(self, tops, excluded_runner, count=1, unclaimed=False):
+        """Return the module heap entries atop the best count modules in tops (only unclaimed ones, if unclaimed) whose
+        tests excluded_runner may have."""
+        found = []
+        passed_over = []
+        try:
+            while tops and len(found) < count:
+                _, seq, module = tops[0]
+                module_heap = self.modules.get(module)
+                if not module_heap or module_heap[0][1] != seq or (unclaimed and module in self.claimed_modules):
+                    heapq.heappop(tops)
+                    continue
+                top = module_heap[0]
+                # A runner's own requeued test hides the rest of its module from it; other runners take those first anyway.
+                if (excluded_runner is None or top[2] != excluded_runner) and not (found and found[-1] is top):
+                    found.append(top)
+                passed_over.append(heapq.heappop(tops))
+            return found
+        finally:
+            for entry in passed_over:
+                heapq.heappush(tops, entry)
+
+    def _remove(self, seq):
+        """Forget the test numbered seq, which we're taking off the queue, and drop it from the top of its heaps."""
+        key, module = self.queued.pop(seq)
+        self.affinity_skips.pop(seq, None)
+        self.test_count -= 1
+
+        group = self.groups[key]
+        if group[0][1] == seq:
+            heapq.heappop(group)
+            while group and group[0][1] not in self.queued:
+                heapq.heappop(group)
+            if group:
+                self._push_top(key)
+            else:
+                del self.groups[key]
+
+        module_heap = self.modules[module]
+        if module_heap[0][1] == seq:
+            heapq.heappop(module_heap)
+            while module_heap and module_heap[0][1] not in self.queued:
+                heapq.heappop(module_heap)
+            if module_heap:
+                self._push_module_top(module)
+            else:
+                del self.modules[module]
+
+    def _take(self, excluded_runner, prefer_runner):
+        """Remove and return (priority, data) for the test to hand out, or raise KeyError if there's nothing we may."""
+        key = self._best_group(excluded_runner)
+        priority, seq, data = self.groups[key][0]
+        if prefer_runner is not None and priority >= 0 and self.affinity_skips.get(seq, 0) < self.max_affinity_skips:
+            if test_module(data) not in self.warm_modules.get(prefer_runner, ()):
+                preferred = (self._best_module_tops(self.warm_tops.get(prefer_runner, []), excluded_runner)
+                             or self._best_module_tops(self.unclaimed_tops, excluded_runner, unclaimed=True) or [None])[0]
+                if preferred is not None and preferred[1] != seq:
+                    self.affinity_skips[seq] = self.affinity_skips.get(seq, 0) + 1
+                    priority, seq, _, data = preferred
+
+        self._remove(seq)
+        if prefer_runner is not None:
+            self._mark_warm(prefer_runner, test_module(data))
+        return priority, data
+
+    def take(self, runner=None, prefer_runner=None):
+        """Immediately remove and return (priority, data) for the best test runner may have, or None if there isn't one."""
+        with self.lock:
             try:
-                c_priority, callback, runner = self.callback_queue.get_nowait()
-            except Queue.Empty:
-                break
+                return self._take(runner, prefer_runner)
+            except KeyError:
+                return None
+
+    def upcoming(self, runner, count):
+        """Return the class paths of up to count tests from modules runner hasn't had tests from, that it's likely to
+        get next: the best from modules nobody has had yet, or else the best test there is."""
+        with self.lock:
+            warm = self.warm_modules.get(runner, ())
+            candidates = [entry[3] for entry in self._best_module_tops(self.unclaimed_tops, runner, count, unclaimed=True)]
+            try:
+                candidates.append(self.groups[self._best_group(runner)][0][2])
+            except KeyError:
+                pass
+        class_paths = []
+        modules = set()
+        for data in candidates:
+            module = test_module(data)
+            if module not in warm and module not in modules and len(class_paths) < count:
+                modules.add(module)
+                class_paths.append(data['class_path'])
+        return class_paths
 
-            skipped_tests = []
-            while data is None:
+    def match(self):
+        """Pair as many queued callbacks with tests as we can, best callback first, and call them."""
+        matches = []
+        with self.lock:
+            self.match_scheduled = False
+            unmatched = []
+            while self.callbacks and self.test_count:
+                entry = heapq.heappop(self.callbacks)
                 try:
-                    d_priority, data = self.data_queue.get_nowait()
-                except Queue.Empty:
-                    break
-
-                if runner is not None and data.get('last_runner') == runner:
-                    skipped_tests.append((d_priority, data))
-                    data = None
-                    continue
-
-            for skipped in skipped_tests:
-                self.data_queue.put(skipped)
-
-            if data is None:
-                skipped_callbacks.append((c_priority, callback, runner))
-                callback = None
-                continue
-
-        for skipped in skipped_callbacks:
-            self.callback_queue.put(skipped)
-
-        if callback is not None:
+                    matches.append((entry[2], self._take(entry[3], entry[4])))
+                except KeyError:
+                    # Only this runner's own tests are left; maybe another runner will take them.
+                    unmatched.append(entry)
+            for entry in unmatched:
+                heapq.heappush(self.callbacks, entry)
+
+        for callback, (d_priority, data) in matches:
             callback(d_priority, data)
-            tornado.ioloop.IOLoop.instance().add_callback(self.match)
 
     def empty(self):
         """Returns whether or not we have any pending tests."""
-        return self.data_queue.empty()
+        return self.test_count == 0
 
     def waiting(self):
         """Returns whether or not we have any pending callbacks."""
-        return self.callback_queue.empty()
+        return not self.callbacks
+
+    def waiting_count(self):
+        """Returns how many callbacks are waiting for a test."""
+        return len(self.callbacks)
+
+    def items(self):
+        """Return a list of the queued tests, in the order they'd be handed out (setting aside last_runner and modules)."""
+        with self.lock:
+            entries = [entry for group in self.groups.itervalues() for entry in group if entry[1] in self.queued]
+        return [data for _, _, data in sorted(entries)]
 
     def finalize(self):
         """Immediately call any pending callbacks with None,None
         and ensure that any future get() calls do the same."""
-        self.finalized = True
-        try:
-            while True:
-                _, callback, _ = self.callback_queue.get_nowait()
-                callback(None, None)
-        except Queue.Empty:
-            pass
+        with self.lock:
+            self.finalized = True
+            callbacks, self.callbacks = self.callbacks, []
+        for entry in sorted(callbacks):
+            entry[2](None, None)
+
+# What we keep of a result to report as a rerun's previous_run: enough for reporters to record it, without its
+# pretty-printed traceback and the like.
+SUMMARY_FIELDS = ('start_time', 'end_time', 'run_time', 'complete', 'success', 'failure', 'error', 'interrupted', 'exception_info', 'runner_id', 'previous_run')
+
+def summarize_result(result):
+    """Return the compact summary of a result dict that we hold onto until its method is rerun."""
+    summary = dict((field, result.get(field)) for field in SUMMARY_FIELDS)
+    summary['method'] = result['method']
+    return summary
+
+def chunk_methods(methods, run_times, target_seconds=None):
+    """Split methods into chunks of about target_seconds each, given the run_times we know for some of them.
+
+    Methods we know nothing about are assumed to take as long as the average method we do know about. Without a
+    target_seconds, every method gets a chunk of its own.
+    """
+    if target_seconds is None:
+        return [[method] for method in methods]
+
+    average = sum(run_times.itervalues()) / len(run_times) if run_times else 0.0
+    chunks = []
+    chunk = []
+    chunk_seconds = 0.0
+    for method in methods:
+        run_time = run_times.get(method, average)
+        if chunk and chunk_seconds + run_time > target_seconds:
+            chunks.append(chunk)
+            chunk = []
+            chunk_seconds = 0.0
+        chunk.append(method)
+        chunk_seconds += run_time
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+# How often we look for timed-out classes, and so roughly how late we can be noticing one.
+TIMER_TICK_SECONDS = 0.1
+
+DEFAULT_HEARTBEAT_TIMEOUT = 30.0
+DEFAULT_HANG_FACTOR = 10.0
 
 class TestRunnerServer(TestRunner):
     def __init__(self, *args, **kwargs):
         self.serve_port = kwargs.pop('serve_port')
+        self.serve_socket = kwargs.pop('serve_socket', None)
+        self.transport = kwargs.pop('transport', 'http')
+        reporter_queue_size = kwargs.pop('reporter_queue_size', queued_reporter.DEFAULT_MAX_SIZE)
+        self.resume_path = kwargs.pop('resume', None)
+        # Keep journaling to the journal we resume from, so we can resume again if need be.
+        self.journal_path = kwargs.pop('journal', None) or self.resume_path
+        self.journal = None # A server_journal.ServerJournal, once we're running, if we've been given a journal_path.
+        self.split_classes = set(kwargs.pop('split_classes', None) or ())
+        self.split_seconds = kwargs.pop('split_seconds', None)
+        self.durations_json = kwargs.pop('durations_json', None)
+        self.durations_db_url = kwargs.pop('durations_db_url', None)
+        # Dispatch the longest test cases first if we've been given somewhere to learn how long they take.
+        self.longest_first = bool(self.durations_json or self.durations_db_url)
+        self.durations = {} # (class_path, method) -> expected run time in seconds; see load_durations().
+        self.predicted_estimates = None # With longest_first, the estimated run time of everything we queued, in dispatch order.
         self.runner_timeout = kwargs['options'].runner_timeout
+        # For runners that send heartbeats: how long we go without one before giving up on the runner, and how many
+        # times longer than usual a method may run before we give up on it.
+        self.heartbeat_timeout = kwargs.pop('heartbeat_timeout', DEFAULT_HEARTBEAT_TIMEOUT)
+        self.hang_factor = kwargs.pop('hang_factor', DEFAULT_HANG_FACTOR)
         self.revision = kwargs['options'].revision
         self.server_timeout = kwargs['options'].server_timeout
         self.shutdown_delay_for_connection_close = kwargs['options'].shutdown_delay_for_connection_close
         self.shutdown_delay_for_outstanding_runners = kwargs['options'].shutdown_delay_for_outstanding_runners
 
         self.test_queue = AsyncDelayedQueue()
-        self.checked_out = {} # Keyed on class path (module class).
+        self.checked_out = {} # Keyed on checkout key: the class path (module class), or chunk key if the class was split.
+        self.checked_out_by_runner = {} # runner_id -> set of the checkout keys it has checked out.
+        self.method_chunks = {} # (class_path, method) -> chunk key, for the methods of classes we've split.
         self.failed_rerun_methods = set() # Set of (class_path, method) who have failed.
         self.timeout_rerun_methods = set() # Set of (class_path, method) who were sent to a client but results never came.
-        self.previous_run_results = {} # Keyed on (class_path, method), values are result dictionaries.
+        self.previous_run_results = {} # Keyed on (class_path, method), values are summaries of results (see summarize_result).
         self.runners = set() # The set of runner_ids who have asked for tests.
         self.runners_outstanding = set() # The set of runners who have posted results but haven't asked for the next test yet.
+        self.heartbeat_runners = set() # The set of runners who have sent heartbeats, whose timeouts heartbeats decide.
+        self.running_methods = {} # runner_id -> {checkout key: (class_path, method, start time)}, from its latest heartbeat.
+        self.runner_slots = {} # runner_id -> how many test cases it runs at a time (see --slots), if more than one.
+        self.timers = TimerWheel(TIMER_TICK_SECONDS) # For timeout_class; see expire_timers().
         self.shutting_down = False # Whether shutdown() has been called.
+        self.stopped = False # Whether we've stopped the IOLoop; see stop().
+        self.first_checkout_time = None # When the first test was handed out.
+        self.shutdown_time = None # When shutdown() was first called.
+        self.result_rate = server_status.ResultRate()
+        self.runner_stats = {} # runner_id -> {'results', 'first_seen', 'last_seen', 'idle_since'}; see status().
+        self.observed_run_time = 0.0 # Total run time of the results we've had, for estimating tests we know nothing about.
+        self.observed_count = 0
+        self.discovering = False # Whether discovery is still finding tests for us to queue; see queue_tests().
+        self.discovery_failure = None # The exception discovery failed with, if it did.
+        self.discovery_priorities = itertools.count() # Queue priorities for tests as they're discovered, in order.
 
         super(TestRunnerServer, self).__init__(*args, **kwargs)
 
+        # Reporters run on a thread of their own, so that slow ones don't hold up the IOLoop (and every runner).
+        self.reporter_queue = queued_reporter.QueuedReporter(self.options, self.test_reporters, max_size=reporter_queue_size)
+        self.test_reporters = [self.reporter_queue]
+
     def get_next_test(self, runner_id, on_test_callback, on_empty_callback):
         """Enqueue a callback (which should take one argument, a test_dict) to be called when the next test is available."""
 
         self.runners.add(runner_id)
+        self.saw_runner(runner_id)
 
         def callback(priority, test_dict):
             if not test_dict:
                 return on_empty_callback()
 
-            if test_dict.get('last_runner', None) != runner_id or (self.test_queue.empty() and len(self.runners) <= 1):
-                self.check_out_class(runner_id, test_dict)
-                on_test_callback(test_dict)
-            else:
-                if self.test_queue.empty():
-                    # Put the test back in the queue, and queue ourselves to pick up the next test queued.
+            if test_dict.get('last_runner', None) == runner_id:
+                # We only get our own test back if we were the only runner when we asked. Run something else if
+                # there's anything else to run; otherwise, rerun it ourselves unless another runner has turned up.
+                taken = self.test_queue.take(runner_id, prefer_runner=runner_id)
+                if taken is not None:
                     self.test_queue.put(priority, test_dict)
-                    self.test_queue.callback_queue.put((-1, callback))
-                else:
-                    # Get the next test, process it, then place the old test back in the queue.
-                    self.test_queue.get(0, callback, runner=runner_id)
+                    priority, test_dict = taken
+                elif len(self.runners) > 1:
+                    # Put the test back in the queue, and queue ourselves (ahead of other runners) to pick up the next test queued.
                     self.test_queue.put(priority, test_dict)
+                    return self.test_queue.get(-1, callback, runner=runner_id, prefer_runner=runner_id)
+
+            self.check_out_class(runner_id, test_dict)
+            on_test_callback(test_dict)
 
-        self.test_queue.get(0, callback, runner=runner_id)
+        # The queue never hands a runner its own tests back, unless we tell it there's nobody else to hand them to.
+        # It prefers tests from modules the runner has already imported, so that it has fewer to import.
+        self.test_queue.get(0, callback, runner=runner_id if len(self.runners) > 1 else None, prefer_runner=runner_id)
+
+    def get_next_tests(self, runner_id, on_tests_callback, on_empty_callback, max_classes=1, max_seconds=None):
+        """Like get_next_test, but check out a batch of tests and call on_tests_callback with the list of their test_dicts.
+
+        We wait for the first test as get_next_test does, then add whatever else is queued right now, up to
+        max_classes classes and (if given) max_seconds of estimated run time. Classes we have no estimate for only
+        count towards max_classes. We don't add anything while other runners are waiting for tests, so that one
+        runner's batch can't leave the others idle.
+        """
+        def on_test_callback(test_dict):
+            batch = [test_dict]
+            budget = None
+            if max_seconds is not None:
+                budget = max_seconds - (self.estimate_run_time(test_dict) or 0.0)
+            while len(batch) < max_classes and self.test_queue.waiting() and (budget is None or budget > 0):
+                taken = self.test_queue.take(runner_id, prefer_runner=runner_id)
+                if taken is None:
+                    break
+                priority, next_dict = taken
+                estimate = self.estimate_run_time(next_dict) or 0.0
+                if budget is not None:
+                    if estimate > budget:
+                        self.test_queue.put(priority, next_dict)
+                        break
+                    budget -= estimate
+                self.check_out_class(runner_id, next_dict)
+                batch.append(next_dict)
+            on_tests_callback(batch)
+
+        self.get_next_test(runner_id, on_test_callback, on_empty_callback)
+
+    def request_tests(self, runner_id, on_response, max_classes=1, max_seconds=None, lookahead=0, slots=1):
+        """Serve a runner's request for tests, whichever transport it came in on, by calling on_response(tests,
+        finished, upcoming) once we have some to hand out, where tests is a list of (class_path, methods), and
+        upcoming is up to lookahead class paths from new modules the runner is likely to get later on (see
+        AsyncDelayedQueue.upcoming), for it to import ahead of time. slots is how many test cases the runner runs
+        at a time.
+
+        Call stop_if_idle() once the response has been sent.
+        """
+        if slots > 1:
+            self.runner_slots[runner_id] = slots
+        else:
+            self.runner_slots.pop(runner_id, None)
+
+        if self.shutting_down:
+            self.runners_outstanding.discard(runner_id)
+            return on_response([], True, [])
+
+        def callback(test_dicts):
+            self.runners_outstanding.discard(runner_id)
+            upcoming = self.test_queue.upcoming(runner_id, lookahead) if lookahead > 0 else []
+            on_response([(test_dict['class_path'], test_dict['methods']) for test_dict in test_dicts], False, upcoming)
+
+        def empty_callback():
+            self.runners_outstanding.discard(runner_id)
+            on_response([], True, [])
+
+        self.get_next_tests(runner_id, callback, empty_callback, max_classes=max_classes, max_seconds=max_seconds)
+
+    def stop_if_idle(self):
+        """Once we're shutting down and every runner has been told so, stop serving."""
+        if self.shutting_down and not self.runners_outstanding:
+            tornado.ioloop.IOLoop.instance().add_callback(self.stop)
+
+    def stop(self):
+        """Stop the IOLoop, on its own thread. Only the first call counts: an extra IOLoop.stop() after the loop has
+        stopped would make the next IOLoop.start() (a server run later on in this process) return right away."""
+        if not self.stopped:
+            self.stopped = True
+            tornado.ioloop.IOLoop.instance().stop()
+
+    def estimate_run_time(self, test_dict):
+        """Return how many seconds we expect the methods in test_dict to take, or None if we don't know."""
+        return test_durations.estimate(self.durations, test_dict['class_path'], test_dict['methods'])
+
+    def load_durations(self):
+        """Gather what we know about how long each test method takes: from the history file, then any JSON result
+        log or reporting database we were given (which win where they overlap)."""
+        durations = {}
+        if self.history:
+            durations.update((key, run_time) for key, (_, run_time) in self.history.load().iteritems())
+        if self.durations_json:
+            try:
+                durations.update(test_durations.load_json_durations(self.durations_json))
+            except IOError, e:
+                _log.warning("Couldn't read test durations from %s: %r", self.durations_json, e)
+        if self.durations_db_url:
+            try:
+                durations.update(test_durations.load_db_durations(self.durations_db_url))
+            except Exception, e:
+                _log.warning("Couldn't read test durations from the reporting database: %r", e)
+        return durations
 
     def report_result(self, runner_id, result):
         class_path = '%s %s' % (result['method']['module'], result['method']['class'])
-        d = self.checked_out.get(class_path)
+        checkout_key = self.method_chunks.get((class_path, result['method']['name']), class_path)
+        d = self.checked_out.get(checkout_key)
 
         if not d:
-            raise ValueError("Class %s not checked out." % class_path)
+            raise ValueError("Class %s not checked out." % checkout_key)
         if d['runner'] != runner_id:
-            raise ValueError("Class %s checked out by runner %s, not %s" % (class_path, d['runner'], runner_id))
+            raise ValueError("Class %s checked out by runner %s, not %s" % (checkout_key, d['runner'], runner_id))
         if result['method']['name'] not in d['methods']:
             raise ValueError("Method %s not checked out by runner %s." % (result['method']['name'], runner_id))
 
-        if result['success']:
-            d['passed_methods'][result['method']['name']] = result
+        method = result['method']['name']
+        self.count_result(runner_id, result)
+        if self.handle_result(class_path, method, d, result):
+            logging.error('Too many failures, shutting down.')
+            return self.early_shutdown()
+
+        running = self.running_methods.get(runner_id, {})
+        if running.get(checkout_key, (None, None))[:2] == (class_path, method):
+            del running[checkout_key]
+            if not running:
+                del self.running_methods[runner_id]
+        self.refresh_timeouts(runner_id)
+
+        d['methods'].remove(method)
+
+        if not d['methods']:
+            self.check_in_class(runner_id, checkout_key, finished=True)
+
+
+    def handle_result(self, class_path, method, d, result):
+        """Report or hold onto a result we've accepted for the checked-out class d. Return whether we've now had
+        too many failures."""
+        if result['success'] or (class_path, method) in self.failed_rerun_methods:
+            # Nothing left to decide about this result (a failure here is the rerun's), so report it now rather
+            # than holding onto it until the class is checked in.
+            self.report_to_reporters(class_path, method, result)
         else:
-            d['failed_methods'][result['method']['name']] = result
+            # Hold onto it until check-in, to see whether we rerun it or (if we're shutting down early) report it.
+            d['failed_methods'][method] = result
+        if not result['success']:
             self.failure_count += 1
-            if self.failure_limit and self.failure_count >= self.failure_limit:
-                logging.error('Too many failures, shutting down.')
-                return self.early_shutdown()
+            return bool(self.failure_limit and self.failure_count >= self.failure_limit)
+        return False
+
+    def release(self, runner_id, class_path, methods, reason):
+        """runner_id (a relay) has given up on running methods of class_path, for the given reason: time out whatever
+        it has checked out that they belong to, as if it had stopped responding."""
+        checkout_keys = set(self.method_chunks.get((class_path, method), class_path) for method in methods)
+        for checkout_key in checkout_keys:
+            d = self.checked_out.get(checkout_key)
+            if d and d['runner'] == runner_id:
+                self.check_in_class(runner_id, checkout_key, timed_out=True, reason=reason)
+
+    def heartbeat(self, runner_id, running=()):
+        """Note that runner_id is alive and has been running each (class_path, method, elapsed) in running for
+        elapsed seconds; a runner with more than one slot may be running several methods at once. From now on,
+        heartbeats decide when runner_id's tests time out; see timeout_for()."""
+        self.activity()
+        self.saw_runner(runner_id)
+        self.heartbeat_runners.add(runner_id)
+        now = time.time()
+        # Go by our own clock rather than trusting the runner's to agree with it.
+        running_methods = dict(
+            (self.method_chunks.get((class_path, method), class_path), (class_path, method, now - (elapsed or 0.0)))
+            for class_path, method, elapsed in running
+        )
+        if running_methods:
+            self.running_methods[runner_id] = running_methods
+        else:
+            self.running_methods.pop(runner_id, None)
+        self.refresh_timeouts(runner_id)
+
+    def method_allowance(self, class_path, method):
+        """Return how long a method may run before we decide it's hung: hang_factor times as long as it usually
+        takes, if we know, but no less than heartbeat_timeout; or runner_timeout if we don't know."""
+        expected = self.durations.get((class_path, method))
+        if expected is None:
+            return self.runner_timeout
+        return max(expected * self.hang_factor, self.heartbeat_timeout)
+
+    def blocking_method(self, runner_id, checkout_key):
+        """Return (class_path, method, deadline) for the method whose running too long would mean checkout_key never
+        finishes on runner_id, or None if there's no such method.
+
+        That's the method of checkout_key itself that runner_id is running, if any. If not, and every one of
+        runner_id's slots is running something, checkout_key can't start until one of them finishes, so it's
+        whichever of those we'll give up on last.
+        """
+        running = self.running_methods.get(runner_id, {})
+        if checkout_key in running:
+            blocking = [running[checkout_key]]
+        elif running and len(running) >= self.runner_slots.get(runner_id, 1):
+            blocking = running.values()
+        else:
+            return None
+        return max(
+            ((class_path, method, start_time + self.method_allowance(class_path, method)) for class_path, method, start_time in blocking),
+            key=lambda (class_path, method, deadline): deadline,
+        )
+
+    def timeout_for(self, runner_id, now, checkout_key):
+        """Return when to give up on checkout_key, which runner_id has checked out, if we hear nothing more from it
+        by then.
+
+        For runners that don't send heartbeats, that's runner_timeout from now. For those that do, it's
+        heartbeat_timeout from now, or sooner if the method holding it up has been running for too long (see
+        blocking_method()).
+        """
+        if runner_id not in self.heartbeat_runners:
+            return now + self.runner_timeout
+        timeout_time = now + self.heartbeat_timeout
+        blocking = self.blocking_method(runner_id, checkout_key)
+        if blocking:
+            timeout_time = min(timeout_time, blocking[2])
+        return timeout_time
+
+    def refresh_timeouts(self, runner_id):
+        """We've heard from runner_id, so give everything it has checked out (including classes it hasn't started yet,
+        if it took a batch) a fresh timeout."""
+        now = time.time()
+        for checkout_key in self.checked_out_by_runner.get(runner_id, ()):
+            d = self.checked_out[checkout_key]
+            timeout_time = self.timeout_for(runner_id, now, checkout_key)
+            d['timeout_time'] = timeout_time
+            if timeout_time < d['timer_time']:
+                # Our timer for it would go off too late.
+                self.schedule_timeout(runner_id, checkout_key)
+
+    def schedule_timeout(self, runner, checkout_key):
+        d = self.checked_out[checkout_key]
+        d['timer_time'] = d['timeout_time']
+        self.timers.schedule(d['timeout_time'], lambda: self.timeout_class(runner, checkout_key))
+
+    def expire_timers(self):
+        """Run the timers that are due; called every TIMER_TICK_SECONDS on the IOLoop."""
+        for callback in self.timers.advance(time.time()):
+            callback()
+
+    def saw_runner(self, runner_id):
+        """Note that runner_id has been in touch, for status()."""
+        now = time.time()
+        stats = self.runner_stats.setdefault(runner_id, {'results': 0, 'first_seen': now, 'idle_since': now})
+        stats['last_seen'] = now
+        return stats
+
+    def count_result(self, runner_id, result):
+        """Count a result towards the rates and run times status() reports."""
+        now = time.time()
+        self.result_rate.add(now)
+        self.saw_runner(runner_id)['results'] += 1
+        if result.get('run_time') is not None:
+            self.observed_run_time += result['run_time']
+            self.observed_count += 1
+
+    def estimate_remaining_time(self, now, active_slots):
+        """Return how many seconds it should take runners with active_slots slots between them to get through what's
+        checked out and queued, or None if there are tests we have no way to estimate.
+
+        Methods we have no durations for are assumed to take as long as the average result has so far, or failing
+        that, the average method in our durations.
+        """
+        if self.observed_count:
+            fallback = self.observed_run_time / self.observed_count
+        elif self.durations:
+            fallback = sum(self.durations.itervalues()) / len(self.durations)
+        else:
+            fallback = None
+
+        def estimate(class_path, methods):
+            seconds = 0.0
+            for method in methods:
+                method_seconds = self.durations.get((class_path, method), fallback)
+                if method_seconds is None:
+                    return None
+                seconds += method_seconds
+            return seconds
+
+        busy = []
+        for runner_id, checkout_keys in self.checked_out_by_runner.iteritems():
+            checked_out = [self.checked_out[checkout_key] for checkout_key in checkout_keys]
+            estimates = [estimate(d['class_path'], d['methods']) for d in checked_out]
+            if None in estimates:
+                return None
+            if runner_id in self.runner_slots:
+                # It only checks out as many as it has slots, and runs them all at once.
+                busy.extend(max(seconds - (now - d['start_time']), 0.0) for d, seconds in zip(checked_out, estimates))
+            else:
+                started = min(d['start_time'] for d in checked_out)
+                busy.append(max(sum(estimates) - (now - started), 0.0))
+
+        queued = [estimate(test_dict['class_path'], test_dict['methods']) for test_dict in self.test_queue.items()]
+        if None in queued:
+            return None
+        return test_durations.predict_wall_time(queued, active_slots, busy=busy)
+
+    def status(self):
+        """Return a dict of what we're up to: the queue, what's checked out and by whom, how fast results are coming
+        in, and when we expect to be done. Served as JSON at /status, and as OpenMetrics at /metrics."""
+        now = time.time()
+        checked_out = [{
+            'key': checkout_key,
+            'class_path': d['class_path'],
+            'runner': d['runner'],
+            'methods': len(d['methods']),
+            'age_seconds': now - d['start_time'],
+            'timeout_seconds': d['timeout_time'] - now,
+        } for checkout_key, d in self.checked_out.iteritems()]
+        checked_out.sort(key=lambda test: -test['age_seconds'])
+
+        runners = {}
+        for runner_id, stats in self.runner_stats.iteritems():
+            busy = bool(self.checked_out_by_runner.get(runner_id))
+            running = None
+            if runner_id in self.running_methods:
+                # The method it's been running longest, if it's running more than one.
+                running = min(self.running_methods[runner_id].itervalues(), key=lambda (class_path, method, start_time): start_time)
+            runners[runner_id] = {
+                'results': stats['results'],
+                'slots': self.runner_slots.get(runner_id, 1),
+                'running': '%s.%s' % running[:2] if running else None,
+                'running_seconds': now - running[2] if running else None,
+                'results_per_second': stats['results'] / (now - stats['first_seen']) if now > stats['first_seen'] else 0.0,
+                'checked_out': len(self.checked_out_by_runner.get(runner_id, ())),
+                'warm_modules': len(self.test_queue.warm_modules.get(runner_id, ())),
+                'idle_seconds': 0.0 if busy else now - stats['idle_since'],
+                'last_seen_seconds': now - stats['last_seen'],
+            }
+
+        # Runners we've heard from lately (or that have something checked out) are the ones we expect to finish the run.
+        active_slots = sum(runner['slots'] for runner in runners.itervalues() if runner['checked_out'] or runner['last_seen_seconds'] < self.runner_timeout)
+
+        return {
+            'time': now,
+            'shutting_down': self.shutting_down,
+            'discovering': self.discovering,
+            'queue': {
+                'tests': self.test_queue.test_count,
+                'waiting_runners': self.test_queue.waiting_count(),
+            },
+            'checked_out': checked_out,
+            'results': {
+                'total': self.result_rate.total,
+                'failures': self.failure_count,
+                'per_second': self.result_rate.per_second(now, self.first_checkout_time),
+            },
+            'reruns': {
+                'failed': len(self.failed_rerun_methods),
+                'timeout': len(self.timeout_rerun_methods),
+            },
+            'runners': runners,
+            'eta_seconds': self.estimate_remaining_time(now, active_slots),
+            'reporter_queue': self.reporter_queue.stats(),
+        }
 
-        d['timeout_time'] = time.time() + self.runner_timeout
+    def prioritize(self, test_dicts):
+        """Return (priority, test_dict) pairs to queue the given test_dicts with.
 
-        d['methods'].remove(result['method']['name'])
+        Normally that's discovery order (which honours --order). With longest_first, it's longest first by estimated
+        run time, with test cases we know nothing about assumed to take as long as the average one we do. Priorities
+        stay non-negative either way, so requeued tests (at -1) still go out before anything else.
+        """
+        if not self.longest_first:
+            return list(enumerate(test_dicts))
+
+        estimates = [self.estimate_run_time(test_dict) for test_dict in test_dicts]
+        known = [estimate for estimate in estimates if estimate is not None]
+        average = sum(known) / len(known) if known else 0.0
+        estimates = [average if estimate is None else estimate for estimate in estimates]
+
+        longest = max(estimates) if estimates else 0.0
+        prioritized = sorted(zip(estimates, test_dicts), key=lambda (estimate, _): -estimate)
+        self.predicted_estimates = [estimate for estimate, _ in prioritized]
+        return [(longest - estimate, test_dict) for estimate, test_dict in prioritized]
+
+    def report_reporter_backlog(self):
+        """Warn if our reporters couldn't keep up with results, so the IOLoop had to wait for them."""
+        stats = self.reporter_queue.stats()
+        if stats['blocked']:
+            _log.warning(
+                "Reporters fell behind: the server waited %.1fs for them to make room for %d of %d reports (--reporter-queue-size %d).",
+                stats['blocked_seconds'], stats['blocked'], stats['queued'], stats['max_size'],
+            )
 
-        if not d['methods']:
-            self.check_in_class(runner_id, class_path, finished=True)
+    def report_prediction(self, actual_seconds):
+        """Say how long we expected the tests to take, given the runners that showed up, and how long they took from
+        the first checkout to shutdown."""
+        runner_count = max(len(self.runners), 1)
+        predicted_seconds = test_durations.predict_wall_time(self.predicted_estimates, runner_count)
+        print >>sys.stderr, "Predicted %.1fs for %d test cases (%.1fs of tests) across %d runners; took %.1fs." % (
+            predicted_seconds,
+            len(self.predicted_estimates),
+            sum(self.predicted_estimates),
+            runner_count,
+            actual_seconds,
+        )
+
+    def split_class(self, class_path, methods):
+        """Return the test_dicts to queue for a class: just one for the whole class, or one per chunk of its methods.
+
+        We split classes named with --split-class, and classes whose methods have taken more than split_seconds in
+        total (going by self.durations). A chunk is checked out, timed out and requeued on its own, under its chunk key,
+        and runs with its own class fixtures.
+        """
+        flagged = class_path in self.split_classes or class_path.partition(' ')[2] in self.split_classes
+        if not flagged and self.split_seconds is None:
+            return [{'class_path': class_path, 'methods': methods}]
+
+        run_times = {}
+        if self.split_seconds is not None:
+            for method in methods:
+                if (class_path, method) in self.durations:
+                    run_times[method] = self.durations[(class_path, method)]
+
+        split = flagged or sum(run_times.itervalues()) > self.split_seconds
+
+        chunks = chunk_methods(methods, run_times, self.split_seconds) if split else [methods]
+        if len(chunks) == 1:
+            return [{'class_path': class_path, 'methods': methods}]
+
+        test_dicts = []
+        for chunk_index, chunk in enumerate(chunks):
+            chunk_key = '%s#%d' % (class_path, chunk_index)
+            for method in chunk:
+                self.method_chunks[(class_path, method)] = chunk_key
+            test_dicts.append({'class_path': class_path, 'chunk': chunk_key, 'methods': chunk})
+        return test_dicts
+
+    def report_to_reporters(self, class_path, method, result):
+        """Pass a result we're done with on to our reporters, along with a summary of the method's previous run."""
+        result['previous_run'] = self.previous_run_results.get((class_path, method), None)
+        if self.journal:
+            self.journal.reported(result)
+        for reporter in self.test_reporters:
+            reporter.test_start(result)
+            reporter.test_complete(result)
+
+    def enqueue(self, priority, test_dict):
+        """Queue a test to be handed out (as opposed to putting back one we've taken off the queue but not handed out)."""
+        if self.journal:
+            self.journal.queue(priority, test_dict)
+        self.test_queue.put(priority, test_dict)
+
+    def resume_from_journal(self):
+        """Pick up where the run journaled at resume_path left off: queue what it hadn't finished, and report what it
+        had, so that our reporters cover the whole run."""
+        state = server_journal.load(self.resume_path)
+        self.failed_rerun_methods = state.failed_rerun_methods
+        self.timeout_rerun_methods = state.timeout_rerun_methods
+        self.previous_run_results = state.previous_run_results
+        for test_dict in state.test_dicts:
+            if test_dict.get('chunk'):
+                self.method_chunks.update(((test_dict['class_path'], method), test_dict['chunk']) for method in test_dict['methods'])
+
+        for result in state.reported_results:
+            if not result['success']:
+                self.failure_count += 1
+            for reporter in self.test_reporters:
+                reporter.test_start(result)
+                reporter.test_complete(result)
+
+        tests = state.tests_to_queue()
+        _log.info("Resuming from %s: %d results already reported, %d test cases left to run.", self.resume_path, len(state.reported_results), len(tests))
+        for priority, test_dict in tests:
+            self.enqueue(priority, test_dict)
+        return state
+
+    def queue_tests(self):
+        """Queue up the tests to hand out: what's left of the run we're resuming, and whatever discovery finds.
+
+        Discovery runs on a thread of its own while we serve runners, and we queue each test case as soon as it's
+        discovered, so runners can start on the first ones while we're still importing the rest. With test_order or
+        longest_first, we need every test case in hand to know which goes first, so we queue them all once discovery
+        is done.
+        """
+        skip_class_paths = set()
+        if self.resume_path:
+            self.durations = self.load_durations()
+            state = self.resume_from_journal()
+            if state.discovered:
+                # The IOLoop isn't running yet, so wait for it to see whether the run we're resuming had already finished.
+                tornado.ioloop.IOLoop.instance().add_callback(self.shutdown_if_finished)
+                return
+            # The run we're resuming died before discovery was done; discover again, for the test cases it hadn't queued.
+            skip_class_paths = set(test_dict['class_path'] for test_dict in state.test_dicts)
+            queued_priorities = [priority for priority, _ in state.queued.itervalues()]
+            self.discovery_priorities = itertools.count(max(queued_priorities) + 1 if queued_priorities else 0)
+
+        # Discovery holds Python's import lock while it imports each test module, and looking up a codec for the first
+        # time imports it, so look up the ones we'll need to serve runners before we start.
+        for encoding in ('latin1', 'utf-8', 'ascii'):
+            codecs.lookup(encoding)
+        self.discovering = True
+        discovery_thread = threading.Thread(target=self.discover_tests, args=(skip_class_paths,))
+        discovery_thread.daemon = True
+        discovery_thread.start()
+
+    def discover_tests(self, skip_class_paths=()):
+        """Discover test cases and hand them to the IOLoop to queue, on the discovery thread. See queue_tests()."""
+        ioloop = tornado.ioloop.IOLoop.instance()
+        queue_as_discovered = not (self.test_order or self.longest_first)
+        held_back = []
+        class_count = 0
+        method_count = 0
+        try:
+            if not self.resume_path:
+                self.durations = self.load_durations()
+            for class_path, methods in self.discover_test_methods():
+                class_count += 1
+                method_count += len(methods)
+                if not methods or class_path in skip_class_paths:
+                    continue
+                if queue_as_discovered:
+                    ioloop.add_callback(functools.partial(self.queue_discovered, [(class_path, methods)]))
+                else:
+                    held_back.append((class_path, methods))
+        except Exception, exc:
+            _log.debug("Test discovery blew up!: %r" % exc)
+            ioloop.add_callback(functools.partial(self.fail_discovery, exc))
+            return
+        ioloop.add_callback(functools.partial(self.finish_discovery, held_back, class_count, method_count))
 
+    def queue_discovered(self, tests):
+        """Queue discovered tests, a list of (class_path, methods), on the IOLoop."""
+        if self.shutting_down:
+            return
+        test_dicts = []
+        for class_path, methods in tests:
+            test_dicts.extend(self.split_class(class_path, methods))
+        if self.longest_first:
+            first_priority = next(self.discovery_priorities)
+            prioritized = [(first_priority + priority, test_dict) for priority, test_dict in self.prioritize(test_dicts)]
+        else:
+            prioritized = [(next(self.discovery_priorities), test_dict) for test_dict in test_dicts]
+        for priority, test_dict in prioritized:
+            self.enqueue(priority, test_dict)
+
+    def finish_discovery(self, held_back, class_count, method_count):
+        """Once discovery is done, on the IOLoop: queue the tests we held back to sort, and shut down if there's
+        nothing left to run."""
+        if self.test_order:
+            held_back = test_history.order_test_cases(held_back, self.test_order, self.history, describe=lambda test: test)
+        self.queue_discovered(held_back)
+        self.discovering = False
+        if self.journal:
+            self.journal.discovered()
+        for reporter in self.test_reporters:
+            reporter.test_counts(class_count, method_count)
+        self.shutdown_if_finished()
+
+    def fail_discovery(self, exc):
+        """Report that discovery failed, on the IOLoop, and give up on the run: it's no good without the rest."""
+        self.discovering = False
+        self.discovery_failure = exc
+        for reporter in self.test_reporters:
+            reporter.test_discovery_failure(exc)
+        self.early_shutdown()
+
+    def shutdown_if_finished(self):
+        if self.tests_finished():
+            self.shutdown()
+
+    def report_results(self, runner_id, results):
+        """report_result() each of a batch of results, returning a list of {'full_name', 'error'} for the ones we refused."""
+        errors = []
+        for result in results:
+            try:
+                self.report_result(runner_id, result)
+            except ValueError, e:
+                errors.append({'full_name': result['method']['full_name'], 'error': str(e)})
+        return errors
 
     def run(self):
         class TestsHandler(tornado.web.RequestHandler):
@@ -194,39 +1010,38 @@ class TestRunnerServer(TestRunner):
             def get(handler):
                 runner_id = handler.get_argument('runner')
 
-                if self.shutting_down:
-                    self.runners_outstanding.discard(runner_id)
-                    return handler.finish(json.dumps({
-                        'finished': True,
-                    }))
-
-                if self.revision and self.revision != handler.get_argument('revision'):
+                if self.revision and not self.shutting_down and self.revision != handler.get_argument('revision'):
                     return handler.send_error(409, reason="Incorrect revision %s -- server is running revision %s" % (handler.get_argument('revision'), self.revision))
 
-                def callback(test_dict):
-                    self.runners_outstanding.discard(runner_id)
+                def on_response(tests, finished, upcoming):
+                    if finished:
+                        return handler.finish(json.dumps({
+                            'finished': True,
+                        }))
+                    tests = [{'class': class_path, 'methods': methods} for class_path, methods in tests]
                     handler.finish(json.dumps({
-                        'class': test_dict['class_path'],
-                        'methods': test_dict['methods'],
+                        # Clients that don't ask for batches only look at the first test.
+                        'class': tests[0]['class'],
+                        'methods': tests[0]['methods'],
+                        'tests': tests,
+                        'lookahead': upcoming,
                         'finished': False,
                     }))
 
-                def empty_callback():
-                    self.runners_outstanding.discard(runner_id)
-                    handler.finish(json.dumps({
-                        'finished': True,
-                    }))
-
-                self.get_next_test(runner_id, callback, empty_callback)
+                try:
+                    max_classes = int(handler.get_argument('max_classes', 1))
+                    max_seconds = handler.get_argument('max_seconds', None)
+                    if max_seconds is not None:
+                        max_seconds = float(max_seconds)
+                    lookahead = int(handler.get_argument('lookahead', 0))
+                    slots = int(handler.get_argument('slots', 1))
+                except ValueError, e:
+                    return handler.send_error(400, reason=str(e))
+                self.request_tests(runner_id, on_response, max_classes=max(max_classes, 1), max_seconds=max_seconds, lookahead=lookahead, slots=slots)
 
             def finish(handler, *args, **kwargs):
                 super(TestsHandler, handler).finish(*args, **kwargs)
-                tornado.ioloop.IOLoop.instance().add_callback(handler.after_finish)
-
-            def after_finish(handler):
-                if self.shutting_down and not self.runners_outstanding:
-                    iol = tornado.ioloop.IOLoop.instance()
-                    iol.add_callback(iol.stop)
+                tornado.ioloop.IOLoop.instance().add_callback(self.stop_if_idle)
 
         class ResultsHandler(tornado.web.RequestHandler):
             def post(handler):
@@ -248,31 +1063,85 @@ class TestRunnerServer(TestRunner):
                 else:
                     return super(ResultsHandler, handler).get_error_html(status_code, **kwargs)
 
-        try:
-            # Enqueue all of our tests.
-            discovered_tests = []
-            try:
-                discovered_tests = self.discover()
-            except Exception, exc:
-                _log.debug("Test discovery blew up!: %r" % exc)
-                raise
-            for test_instance in discovered_tests:
-                test_dict = {
-                    'class_path' : '%s %s' % (test_instance.__module__, test_instance.__class__.__name__),
-                    'methods' : [test.__name__ for test in test_instance.runnable_test_methods()],
-                }
+        class BatchResultsHandler(ResultsHandler):
+            """Takes a JSON list of results, gzipped if Content-Encoding says so, and reports them all in one go."""
+            def post(handler):
+                runner_id = handler.get_argument('runner')
+                self.runners_outstanding.add(runner_id)
+                try:
+                    body = handler.request.body
+                    if handler.request.headers.get('Content-Encoding') == 'gzip':
+                        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                    results = json.loads(body)
+                except (zlib.error, ValueError), e:
+                    return handler.send_error(400, reason="Couldn't read batch of results: %s" % e)
+
+                return handler.finish(json.dumps({'errors': self.report_results(runner_id, results)}))
+
+        class HeartbeatHandler(tornado.web.RequestHandler):
+            """Takes a JSON object of the methods the runner is running ({'running': [[class_path, method, elapsed], ...]}),
+            or of the one method it's running ({'class_path', 'method', 'elapsed'}), or {}."""
+            def post(handler):
+                runner_id = handler.get_argument('runner')
+                try:
+                    body = json.loads(handler.request.body or '{}')
+                    if 'running' in body:
+                        running = [(class_path, method, elapsed) for class_path, method, elapsed in body['running']]
+                    elif body.get('method') is not None:
+                        running = [(body.get('class_path'), body['method'], body.get('elapsed'))]
+                    else:
+                        running = []
+                    self.heartbeat(runner_id, running)
+                except (ValueError, AttributeError, TypeError), e:
+                    return handler.send_error(400)
+                return handler.finish("kthx")
+
+        class ReleaseHandler(tornado.web.RequestHandler):
+            """Takes a JSON object of methods a relay has given up on: {'class_path', 'methods', 'reason'}."""
+            def post(handler):
+                runner_id = handler.get_argument('runner')
+                try:
+                    released = json.loads(handler.request.body)
+                    self.release(runner_id, released['class_path'], released['methods'], released.get('reason'))
+                except (ValueError, KeyError, TypeError), e:
+                    return handler.send_error(400)
+                return handler.finish("kthx")
 
-                if test_dict['methods']:
-                    self.test_queue.put(0, test_dict)
+        class StatusHandler(tornado.web.RequestHandler):
+            def get(handler):
+                handler.set_header('Content-Type', 'application/json')
+                handler.finish(json.dumps(self.status()))
 
-            # Start an HTTP server.
-            application = tornado.web.Application([
-                (r"/tests", TestsHandler),
-                (r"/results", ResultsHandler),
-            ])
+        class MetricsHandler(tornado.web.RequestHandler):
+            def get(handler):
+                handler.set_header('Content-Type', server_status.OPENMETRICS_CONTENT_TYPE)
+                handler.finish(server_status.format_openmetrics(self.status()))
 
-            server = tornado.httpserver.HTTPServer(application)
-            server.listen(self.serve_port)
+        try:
+            if self.journal_path:
+                self.journal = server_journal.ServerJournal(self.journal_path)
+
+            if self.transport == 'binary':
+                from binary_transport import BinaryServer
+                server = BinaryServer(self)
+                if self.serve_socket:
+                    server.listen_unix(self.serve_socket)
+                if self.serve_port:
+                    server.listen(self.serve_port)
+            else:
+                # Start an HTTP server.
+                application = tornado.web.Application([
+                    (r"/tests", TestsHandler),
+                    (r"/results", ResultsHandler),
+                    (r"/results/batch", BatchResultsHandler),
+                    (r"/heartbeat", HeartbeatHandler),
+                    (r"/release", ReleaseHandler),
+                    (r"/status", StatusHandler),
+                    (r"/metrics", MetricsHandler),
+                ])
+
+                server = tornado.httpserver.HTTPServer(application)
+                server.listen(self.serve_port)
 
             def timeout_server():
                 if time.time() > self.last_activity_time + self.server_timeout:
@@ -282,13 +1151,28 @@ class TestRunnerServer(TestRunner):
                     tornado.ioloop.IOLoop.instance().add_timeout(self.last_activity_time + self.server_timeout, timeout_server)
             self.activity()
             timeout_server() # Set the first callback.
+            # One timer wheel for every class's timeout, rather than an IOLoop timeout each.
+            timer_ticker = tornado.ioloop.PeriodicCallback(self.expire_timers, TIMER_TICK_SECONDS * 1000)
+            timer_ticker.start()
+
+            # We're listening already, so runners can start on the first tests we queue while we find the rest.
+            self.queue_tests()
 
             tornado.ioloop.IOLoop.instance().start()
+            # Stop listening, so the IOLoop doesn't keep accepting connections (or ticking our timers) for us after we're done.
+            server.stop()
+            timer_ticker.stop()
+
+            if self.predicted_estimates is not None and self.first_checkout_time is not None:
+                self.report_prediction(self.shutdown_time - self.first_checkout_time)
 
         finally:
             # Report what happened, even if something went wrong.
             report = [reporter.report() for reporter in self.test_reporters]
-            return all(report)
+            self.report_reporter_backlog()
+            if self.journal:
+                self.journal.close()
+            return all(report) and self.discovery_failure is None
 
 
     def activity(self):
@@ -297,40 +1181,60 @@ class TestRunnerServer(TestRunner):
     def check_out_class(self, runner, test_dict):
         self.activity()
 
-        self.checked_out[test_dict['class_path']] = {
+        if self.first_checkout_time is None:
+            self.first_checkout_time = time.time()
+
+        checkout_key = test_dict.get('chunk', test_dict['class_path'])
+        if self.journal:
+            self.journal.checkout(runner, checkout_key)
+        now = time.time()
+        self.checked_out[checkout_key] = {
             'runner' : runner,
             'class_path' : test_dict['class_path'],
+            'chunk' : test_dict.get('chunk'),
             'methods' : set(test_dict['methods']),
-            'failed_methods' : {},
-            'passed_methods' : {},
-            'start_time' : time.time(),
-            'timeout_time' : time.time() + self.runner_timeout,
+            'failed_methods' : {}, # Failures we haven't yet decided whether to rerun.
+            'start_time' : now,
+            'timeout_time' : self.timeout_for(runner, now, checkout_key),
+            'timer_time' : None, # When our timer for timeout_class is set to go off; see schedule_timeout().
         }
+        self.checked_out_by_runner.setdefault(runner, set()).add(checkout_key)
+        self.saw_runner(runner)['idle_since'] = None
+
+        self.timeout_class(runner, checkout_key)
 
-        self.timeout_class(runner, test_dict['class_path'])
+    def check_in_class(self, runner, checkout_key, timed_out=False, finished=False, early_shutdown=False, reason=None):
+        """Check in a class (or chunk of one, if checkout_key is a chunk key): report its results and requeue what needs rerunning.
 
-    def check_in_class(self, runner, class_path, timed_out=False, finished=False, early_shutdown=False):
+        With timed_out, reason (if given) is why we gave up on the runner, for the results we fake.
+        """
         if not timed_out:
             self.activity()
 
         if 1 != len([opt for opt in (timed_out, finished, early_shutdown) if opt]):
             raise ValueError("Must set exactly one of timed_out, finished, or early_shutdown.")
 
-        if class_path not in self.checked_out:
-            raise ValueError("Class path %r not checked out." % class_path)
-        if not early_shutdown and self.checked_out[class_path]['runner'] != runner:
-            raise ValueError("Class path %r not checked out by runner %r." % (class_path, runner))
+        if checkout_key not in self.checked_out:
+            raise ValueError("Class path %r not checked out." % checkout_key)
+        if not early_shutdown and self.checked_out[checkout_key]['runner'] != runner:
+            raise ValueError("Class path %r not checked out by runner %r." % (checkout_key, runner))
 
-        d = self.checked_out.pop(class_path)
+        d = self.checked_out.pop(checkout_key)
+        if self.journal:
+            self.journal.checkin(checkout_key)
+        runner_checkout_keys = self.checked_out_by_runner.get(d['runner'])
+        if runner_checkout_keys is not None:
+            runner_checkout_keys.discard(checkout_key)
+            if not runner_checkout_keys:
+                del self.checked_out_by_runner[d['runner']]
+                if d['runner'] in self.runner_stats:
+                    self.runner_stats[d['runner']]['idle_since'] = time.time()
 
-        for method, result_dict in itertools.chain(
-                    d['passed_methods'].iteritems(),
-                    ((method, result) for (method, result) in d['failed_methods'].iteritems() if early_shutdown or (class_path, method) in self.failed_rerun_methods),
-                ):
-            for reporter in self.test_reporters:
-                result_dict['previous_run'] = self.previous_run_results.get((class_path, method), None)
-                reporter.test_start(result_dict)
-                reporter.test_complete(result_dict)
+        class_path = d['class_path']
+
+        if early_shutdown:
+            for method, result_dict in d['failed_methods'].iteritems():
+                self.report_to_reporters(class_path, method, result_dict)
 
         #Requeue failed tests
         requeue_dict = {
@@ -338,23 +1242,32 @@ class TestRunnerServer(TestRunner):
             'class_path' : d['class_path'],
             'methods' : [],
         }
+        if d['chunk']:
+            requeue_dict['chunk'] = d['chunk']
 
+        # These all failed for the first time (report_result reported the reruns' failures as they came in).
         for method, result_dict in d['failed_methods'].iteritems():
-            if (class_path, method) not in self.failed_rerun_methods:
-                requeue_dict['methods'].append(method)
-                self.failed_rerun_methods.add((class_path, method))
-                result_dict['previous_run'] = self.previous_run_results.get((class_path, method), None)
-                self.previous_run_results[(class_path, method)] = result_dict
+            requeue_dict['methods'].append(method)
+            self.failed_rerun_methods.add((class_path, method))
+            result_dict['previous_run'] = self.previous_run_results.get((class_path, method), None)
+            self.previous_run_results[(class_path, method)] = summarize_result(result_dict)
+            if self.journal:
+                self.journal.rerun('failed', class_path, method, self.previous_run_results[(class_path, method)])
 
         if finished:
             if len(d['methods']) != 0:
-                raise ValueError("check_in_class called with finished=True but this class (%s) still has %d methods without results." % (class_path, len(d['methods'])))
+                raise ValueError("check_in_class called with finished=True but this class (%s) still has %d methods without results." % (checkout_key, len(d['methods'])))
         elif timed_out:
             # Requeue or report timed-out tests.
+            error_message = reason + '\n' if reason else self.timeout_reason(runner, checkout_key)
+            # Whatever it was running of this, we've given up on it.
+            running = self.running_methods.get(runner, {})
+            running.pop(checkout_key, None)
+            if not running:
+                self.running_methods.pop(runner, None)
 
             for method in d['methods']:
                 # Fake the results dict.
-                error_message = "The runner running this method (%s) didn't respond within %ss.\n" % (runner, self.runner_timeout)
                 module, _, classname = class_path.partition(' ')
 
                 result_dict = {
@@ -383,39 +1296,53 @@ class TestRunnerServer(TestRunner):
                 if (class_path, method) not in self.timeout_rerun_methods:
                     requeue_dict['methods'].append(method)
                     self.timeout_rerun_methods.add((class_path, method))
-                    self.previous_run_results[(class_path, method)] = result_dict
+                    self.previous_run_results[(class_path, method)] = summarize_result(result_dict)
+                    if self.journal:
+                        self.journal.rerun('timeout', class_path, method, self.previous_run_results[(class_path, method)])
                 else:
-                    for reporter in self.test_reporters:
-                        reporter.test_start(result_dict)
-                        reporter.test_complete(result_dict)
+                    self.report_to_reporters(class_path, method, result_dict)
 
         if requeue_dict['methods']:
-            self.test_queue.put(-1, requeue_dict)
+            self.enqueue(-1, requeue_dict)
 
-        if self.test_queue.empty() and len(self.checked_out) == 0:
+        if self.tests_finished():
             self.shutdown()
 
-    def timeout_class(self, runner, class_path):
-        """Check that it's actually time to rerun this class; if not, reset the timeout. Check the class in and rerun it."""
-        d = self.checked_out.get(class_path, None)
+    def tests_finished(self):
+        """Return whether every test has been run."""
+        return not self.discovering and self.test_queue.empty() and len(self.checked_out) == 0
+
+    def timeout_reason(self, runner, checkout_key):
+        """Return why we're giving up on checkout_key, which runner has checked out, for the results we fake for it."""
+        if runner not in self.heartbeat_runners:
+            return "The runner running this method (%s) didn't respond within %ss.\n" % (runner, self.runner_timeout)
+        blocking = self.blocking_method(runner, checkout_key)
+        if blocking and time.time() >= blocking[2]:
+            class_path, method, _ = blocking
+            return "The runner running this method (%s) was stuck running %s.%s for over %ss.\n" % (runner, class_path, method, self.method_allowance(class_path, method))
+        return "The runner running this method (%s) didn't send a heartbeat within %ss.\n" % (runner, self.heartbeat_timeout)
+
+    def timeout_class(self, runner, checkout_key):
+        """Check that it's actually time to rerun this class (or chunk); if not, reset the timeout. Check the class in and rerun it."""
+        d = self.checked_out.get(checkout_key, None)
 
         if not d:
             return
 
         if time.time() < d['timeout_time']:
             # We're being called for the first time, or someone has updated timeout_time since the timeout was set (e.g. results came in)
-            tornado.ioloop.IOLoop.instance().add_timeout(d['timeout_time'], lambda: self.timeout_class(runner, class_path))
+            self.schedule_timeout(runner, checkout_key)
             return
 
         try:
-            self.check_in_class(runner, class_path, timed_out=True)
+            self.check_in_class(runner, checkout_key, timed_out=True)
         except ValueError:
             # If another builder has checked out the same class in the mean time, don't throw an error.
             pass
 
     def early_shutdown(self):
-        for class_path in self.checked_out.keys():
-            self.check_in_class(None, class_path, early_shutdown=True)
+        for checkout_key in self.checked_out.keys():
+            self.check_in_class(None, checkout_key, early_shutdown=True)
         self.shutdown()
 
     def shutdown(self):
@@ -424,6 +1351,7 @@ class TestRunnerServer(TestRunner):
             return
 
         self.shutting_down = True
+        self.shutdown_time = time.time()
         self.test_queue.finalize()
         iol = tornado.ioloop.IOLoop.instance()
         # Can't immediately call stop, otherwise the runner currently POSTing its results will get a Connection Refused when it tries to ask for the next test.
@@ -433,10 +1361,13 @@ class TestRunnerServer(TestRunner):
         if iol.running():
             if self.runners_outstanding:
                 # Stop in 5 seconds if all the runners_outstanding don't come back by then.
-                iol.add_timeout(time.time()+self.shutdown_delay_for_outstanding_runners, iol.stop)
+                delay = self.shutdown_delay_for_outstanding_runners
             else:
                 # Give tornado enough time to finish writing to all the clients, then shut down.
-                iol.add_timeout(time.time()+self.shutdown_delay_for_connection_close, iol.stop)
+                delay = self.shutdown_delay_for_connection_close
+            # We may be called from outside the IOLoop's thread, where add_timeout isn't safe (the loop may not notice
+            # the timeout until after it's stopped some other way, and then stop the next server run on it).
+            iol.add_callback(lambda: iol.add_timeout(time.time() + delay, self.stop))
         else:
             _log.error("TestRunnerServer on port %s has been asked to shutdown but its IOLoop is not running."
                 " Perhaps it died an early death due to discovery failure." % self.serve_port
@@ -0,0 +1,179 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Watch mode: rerun only the tests affected by each change to the source tree.
+
+After an initial full run, we wait for .py files under the watched roots to
+change (using inotify via pyinotify if it's installed, polling otherwise),
+reload the changed modules and every module that depends on them, and rerun
+just the test modules among those.
+"""
+import os
+import sys
+import time
+
+try:
+    import pyinotify
+    _hush_pyflakes = [pyinotify]
+    del _hush_pyflakes
+except ImportError:
+    pyinotify = None
+
+from testify.test_logger import _log
+from testify.utils.module_tracker import ModuleTracker
+
+
+def gather_source_files(roots):
+    """Return a dict of path -> mtime for every .py file under the given roots."""
+    mtimes = {}
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            # Skip .svn, .git and other hidden directories.
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+            for filename in filenames:
+                if filename.endswith('.py') and not filename.startswith('.'):
+                    path = os.path.abspath(os.path.join(dirpath, filename))
+                    try:
+                        mtimes[path] = os.path.getmtime(path)
+                    except OSError:
+                        pass
+    return mtimes
+
+
+def module_name_for_path(path):
+    """Guess the module name of a file under the current directory, the same way discovery does."""
+    relative_path = os.path.relpath(os.path.abspath(path), os.getcwd())
+    if relative_path.startswith(os.pardir):
+        return None
+    module_name = os.path.splitext(relative_path)[0].replace(os.sep, '.')
+    if module_name.endswith('.__init__'):
+        module_name = module_name[:-len('.__init__')]
+    return module_name
+
+
+class PollingFileWatcher(object):
+    def __init__(self, roots, poll_interval):
+        self.roots = roots
+        self.poll_interval = poll_interval
+        self.mtimes = gather_source_files(roots)
+
+    def wait(self):
+        """Block until some .py files change, and return their paths."""
+        while True:
+            time.sleep(self.poll_interval)
+            mtimes = gather_source_files(self.roots)
+            changed = [path for path, mtime in mtimes.iteritems() if self.mtimes.get(path) != mtime]
+            self.mtimes = mtimes
+            if changed:
+                return changed
+
+
+class InotifyFileWatcher(object):
+    def __init__(self, roots, poll_interval):
+        self.poll_interval = poll_interval
+        self.watch_manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+        for root in roots:
+            self.watch_manager.add_watch(root, mask, rec=True, auto_add=True)
+        self.changed = set()
+        self.notifier = pyinotify.Notifier(self.watch_manager, self.process_event)
+
+    def process_event(self, event):
+        if event.pathname.endswith('.py'):
+            self.changed.add(os.path.abspath(event.pathname))
+
+    def wait(self):
+        while True:
+            if self.notifier.check_events(timeout=None):
+                self.notifier.read_events()
+                self.notifier.process_events()
+            # Editors often write a file in several steps; let them settle before rerunning.
+            time.sleep(self.poll_interval)
+            if self.notifier.check_events(timeout=0):
+                self.notifier.read_events()
+                self.notifier.process_events()
+            if self.changed:
+                changed, self.changed = sorted(self.changed), set()
+                return changed
+
+
+class TestWatcher(object):
+    """Runs the tests at test_path, then reruns the affected test modules whenever source files change.
+
+    make_runner is called with a test path (or list of module names) and should return a fresh TestRunner, with
+    fresh reporters, for each run.
+    """
+
+    def __init__(self, test_path, make_runner, roots=None, poll_interval=0.5):
+        self.test_path = test_path
+        # We compare module names, so turn a filesystem path like test/foo_test.py into test.foo_test.
+        self.test_module = module_name_for_path(test_path) if os.path.exists(test_path) else test_path
+        self.make_runner = make_runner
+        self.roots = [os.path.abspath(root) for root in (roots or [os.getcwd()])]
+        self.poll_interval = poll_interval
+        self.module_tracker = ModuleTracker()
+
+    def build_file_watcher(self):
+        if pyinotify is not None:
+            return InotifyFileWatcher(self.roots, self.poll_interval)
+        return PollingFileWatcher(self.roots, self.poll_interval)
+
+    def is_test_module(self, module_name):
+        return module_name == self.test_module or module_name.startswith(self.test_module + '.')
+
+    def affected_test_modules(self, changed_paths):
+        """Reload the modules behind the changed files (and their dependents); return the test modules to rerun."""
+        changed_modules = set()
+        new_test_modules = set()
+        for path in changed_paths:
+            module_name = self.module_tracker.module_for_path(path)
+            if module_name:
+                changed_modules.add(module_name)
+            else:
+                # Not imported yet; if it's a new test module, discovery will pick it up.
+                module_name = module_name_for_path(path)
+                if module_name and self.is_test_module(module_name):
+                    new_test_modules.add(module_name)
+
+        affected = self.module_tracker.reload_order(self.module_tracker.dependents(changed_modules))
+        for module_name, e in self.module_tracker.reload_modules(affected):
+            _log.error("Failed to reload %s: %r", module_name, e)
+
+        # Rerun modules, not whole packages.
+        test_modules = set(
+            module_name for module_name in affected
+            if self.is_test_module(module_name) and not hasattr(sys.modules.get(module_name), '__path__')
+        )
+        return sorted(test_modules | new_test_modules)
+
+    def run_once(self, test_path):
+        try:
+            return self.make_runner(test_path).run()
+        finally:
+            self.module_tracker.snapshot()
+
+    def run(self):
+        file_watcher = self.build_file_watcher()
+        self.run_once(self.test_path)
+        try:
+            while True:
+                test_modules = self.affected_test_modules(file_watcher.wait())
+                if test_modules:
+                    print "\nRerunning %s" % ', '.join(test_modules)
+                    self.run_once(test_modules)
+        except KeyboardInterrupt:
+            pass
+
+# vim: set ts=4 sts=4 sw=4 et:
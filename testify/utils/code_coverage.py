@@ -8,6 +8,7 @@ Use coverage.start() to begin collecting information, and coverage.stop() to end
 See https://trac.yelpcorp.com/wiki/TestingCoverage for more information
 """
 
+import os
 import sys
 
 class FakeCoverage:
@@ -36,6 +37,52 @@ except (ImportError, NameError), ex:
 started = False
 coverage_instance = None
 
+class LineCollector(object):
+    """Records which lines of which files execute, attributing them to whichever bucket is current.
+
+    This is a plain sys.settrace tracer rather than the coverage package, because we want to switch buckets
+    (e.g. one per test method) cheaply and don't need any of coverage's reporting. Only files under one of
+    the given roots are traced.
+    """
+
+    def __init__(self, roots):
+        self.roots = tuple(os.path.join(os.path.abspath(root), '') for root in roots)
+        self.lines = {} # bucket -> {filename: set(line numbers)}
+        self.bucket = None
+        self._traced_files = {}
+
+    def _should_trace(self, filename):
+        traced = self._traced_files.get(filename)
+        if traced is None:
+            traced = self._traced_files[filename] = os.path.abspath(filename).startswith(self.roots)
+        return traced
+
+    def _trace_lines(self, frame, event, arg):
+        if event == 'line' and self.bucket is not None:
+            self.lines.setdefault(self.bucket, {}).setdefault(frame.f_code.co_filename, set()).add(frame.f_lineno)
+        return self._trace_lines
+
+    def _trace_calls(self, frame, event, arg):
+        if event == 'call' and self._should_trace(frame.f_code.co_filename):
+            return self._trace_lines
+        return None
+
+    def start(self, bucket):
+        self.bucket = bucket
+        sys.settrace(self._trace_calls)
+
+    def switch(self, bucket):
+        self.bucket = bucket
+
+    def stop(self):
+        sys.settrace(None)
+        self.bucket = None
+
+    def pop_lines(self):
+        """Return (and forget) everything collected so far, as {bucket: {filename: set(line numbers)}}."""
+        lines, self.lines = self.lines, {}
+        return lines
+
 def start(testcase_name = None):
     global started
     global coverage_instance
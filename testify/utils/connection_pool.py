@@ -0,0 +1,103 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keep-alive HTTP connections to a testify server.
+
+urllib2.urlopen opens (and tears down) a TCP connection for every request.
+Runners talk to the server many times a second, so instead we keep a few
+HTTP/1.1 connections open and reuse them.
+
+Errors are raised as urllib2 would raise them -- urllib2.HTTPError for an
+error status, urllib2.URLError when we can't talk to the server at all -- so
+callers keep their existing retry logic.
+"""
+from __future__ import with_statement
+
+import cStringIO
+import httplib
+import socket
+import threading
+import urllib2
+
+
+class ConnectionPool(object):
+    """Idle keep-alive connections to one HOST:PORT, safe to share between threads.
+
+    A connection that has been sitting idle may have been closed by the server; if a request on one fails before we
+    get a response, we retry it once on a fresh connection before giving up.
+    """
+
+    def __init__(self, addr, max_idle=4, timeout=None):
+        self.addr = addr
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.timeout is None:
+            return httplib.HTTPConnection(self.addr)
+        return httplib.HTTPConnection(self.addr, timeout=self.timeout)
+
+    def _checkout(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self._connect(), False
+
+    def _checkin(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response, response.read()
+
+    def request(self, method, path, body=None, headers=None):
+        """Make a request, returning the response body. Raises urllib2.HTTPError or urllib2.URLError as urlopen does."""
+        conn, reused = self._checkout()
+        try:
+            try:
+                response, data = self._send(conn, method, path, body, headers)
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                conn = self._connect()
+                response, data = self._send(conn, method, path, body, headers)
+        except (socket.error, httplib.HTTPException), e:
+            conn.close()
+            raise urllib2.URLError(e)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(conn)
+
+        if response.status >= 400:
+            url = 'http://%s%s' % (self.addr, path)
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, cStringIO.StringIO(data))
+        return data
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+# vim: set ts=4 sts=4 sw=4 et:
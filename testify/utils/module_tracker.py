@@ -0,0 +1,161 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keep track of which imported modules have changed on disk, and reload them.
+
+Used by long-lived testify processes (the daemon, watch mode) that import the
+code under test once and then need to pick up edits to it.
+"""
+import os
+import sys
+import types
+
+
+def source_path(module):
+    """Return the path of the .py file a module was loaded from, or None for builtins and extension modules."""
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+    base, ext = os.path.splitext(path)
+    if ext in ('.pyc', '.pyo'):
+        path = base + '.py'
+    elif ext != '.py':
+        return None
+    return os.path.abspath(path)
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class ModuleTracker(object):
+    """Remembers the source mtime of every module in sys.modules as of the last snapshot()."""
+
+    def __init__(self):
+        self.mtimes = {} # module name -> (source path, mtime)
+
+    def snapshot(self):
+        """Record the current mtime of every imported module's source."""
+        self.mtimes = {}
+        for name, module in sys.modules.items():
+            if module is None:
+                continue
+            path = source_path(module)
+            if path:
+                self.mtimes[name] = (path, get_mtime(path))
+
+    def changed_modules(self):
+        """Return the names of imported modules whose source has changed since snapshot()."""
+        changed = []
+        for name, (path, mtime) in self.mtimes.iteritems():
+            if name in sys.modules and get_mtime(path) != mtime:
+                changed.append(name)
+        return sorted(changed)
+
+    def module_for_path(self, path):
+        """Return the name of the tracked module loaded from path, if any."""
+        path = os.path.abspath(path)
+        for name, (module_path, _) in self.mtimes.iteritems():
+            if module_path == path:
+                return name
+        return None
+
+    def dependencies(self, name):
+        """Return the tracked modules the named module refers to at the top level.
+
+        This catches both `import foo` (a module in its namespace) and `from foo import Bar` (an object whose
+        __module__ is foo), which is as much as we can tell without parsing source.
+        """
+        module = sys.modules.get(name)
+        if module is None:
+            return set()
+        deps = set()
+        for value in vars(module).values():
+            if isinstance(value, types.ModuleType):
+                dep = value.__name__
+            else:
+                dep = getattr(value, '__module__', None)
+            # A package's submodules show up in its namespace, but it doesn't depend on them.
+            if dep and dep != name and dep in self.mtimes and not dep.startswith(name + '.'):
+                deps.add(dep)
+        return deps
+
+    def dependents(self, names):
+        """Return the given modules plus every tracked module that (transitively) depends on them."""
+        reverse_deps = {}
+        for name in self.mtimes:
+            for dep in self.dependencies(name):
+                reverse_deps.setdefault(dep, set()).add(name)
+
+        affected = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name in affected:
+                continue
+            affected.add(name)
+            pending.extend(reverse_deps.get(name, ()))
+        return affected
+
+    def reload_order(self, names):
+        """Order the given modules so that each comes after the ones it depends on."""
+        names = set(names)
+        ordered = []
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for dep in sorted(self.dependencies(name) & names):
+                visit(dep)
+            ordered.append(name)
+
+        for name in sorted(names):
+            visit(name)
+        return ordered
+
+    def reload_modules(self, names):
+        """Reload the named modules in order, skipping (and returning) any that fail to import.
+
+        The tracker's mtimes are updated for the modules that reloaded.
+        """
+        failed = []
+        for name in names:
+            module = sys.modules.get(name)
+            if module is None:
+                continue
+            try:
+                reload(module)
+            except Exception, e:
+                failed.append((name, e))
+                continue
+            path = source_path(module)
+            if path:
+                self.mtimes[name] = (path, get_mtime(path))
+        return failed
+
+    def reload_changed(self):
+        """Reload every module that changed since snapshot(), along with the modules that depend on them.
+
+        Returns (reloaded names, [(name, exception)]).
+        """
+        affected = self.reload_order(self.dependents(self.changed_modules()))
+        failed = self.reload_modules(affected)
+        return affected, failed
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,80 @@
+# Copyright 2012 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A hashed timer wheel, for keeping lots of coarse timeouts cheaply.
+
+Time is cut into ticks, and a timer goes in the slot its tick hashes to.
+Scheduling is O(1), and advancing the wheel by a tick only looks at that tick's
+slot, however many timers there are. Timers fire once their tick has passed, so
+never early and at most a tick late. There's no cancelling: callers check,
+when a timer fires, whether it still matters.
+"""
+from __future__ import with_statement
+
+import itertools
+import math
+import threading
+
+DEFAULT_SLOT_COUNT = 512
+
+
+class TimerWheel(object):
+    def __init__(self, tick, slot_count=DEFAULT_SLOT_COUNT):
+        self.tick = tick
+        self.slots = [[] for _ in xrange(slot_count)]
+        self.next_tick = None # The first tick advance() hasn't gone past yet.
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+    def tick_of(self, when):
+        return int(math.floor(when / self.tick))
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(slot) for slot in self.slots)
+
+    def schedule(self, when, callback):
+        """Have advance() return callback once the time when has passed. May be called from any thread."""
+        with self.lock:
+            tick = self.tick_of(when)
+            if self.next_tick is not None:
+                # Already overdue: fire on the next advance.
+                tick = max(tick, self.next_tick)
+            self.slots[tick % len(self.slots)].append((tick, next(self.seq), callback))
+
+    def advance(self, now):
+        """Remove and return the callbacks due by now, in the order they're due."""
+        now_tick = self.tick_of(now)
+        due = []
+        with self.lock:
+            if self.next_tick is None or now_tick - self.next_tick >= len(self.slots):
+                # We've been around the whole wheel since we last looked (or never looked), so look at every slot.
+                indexes = xrange(len(self.slots))
+            else:
+                indexes = [tick % len(self.slots) for tick in xrange(self.next_tick, now_tick)]
+
+            for index in indexes:
+                slot = self.slots[index]
+                if not slot:
+                    continue
+                # Timers for later trips around the wheel stay put.
+                due.extend(entry for entry in slot if entry[0] < now_tick)
+                self.slots[index] = [entry for entry in slot if entry[0] >= now_tick]
+
+            if self.next_tick is None or now_tick > self.next_tick:
+                self.next_tick = now_tick
+
+        return [callback for _, _, callback in sorted(due)]
+
+# vim: set ts=4 sts=4 sw=4 et: